@@ -7,17 +7,35 @@ Class:
 
 TaskQueue
 
+AsyncTaskQueue
+
+ShardedTaskQueue
+
+MultiQueueWorker
+
 
 Function:
 
 do_task
 
+async_do_task
+
 """
 
 from .queue import TaskQueue
-
-
-def do_task(taskpool, taskid, workfunc, tasklock=True, tasktracing=True):
+from .executor import get_executor, map_items
+from .aio import AsyncTaskQueue, async_do_task
+from .shard import ShardedTaskQueue
+from .worker import MultiQueueWorker
+from . import metrics
+from . import results as _results
+
+
+def do_task(taskpool, taskid, workfunc, tasklock=True, tasktracing=True, 
+            tracingmode='column', executor=None, max_workers=None, 
+            chunksize=1, max_inflight=None, lockttl=None, 
+            visibility_timeout=None, num=None, batch_size=None, stop=None, 
+            chunk=None, partitioned=False):
     """An all-in-one way to finish the task using TaskQueue system
 
     If empty queue or no items getten, return None, If cannot acquire the tasklook, 
@@ -37,31 +55,191 @@ def do_task(taskpool, taskid, workfunc, tasklock=True, tasktracing=True):
 
     tasktracing - (key-word), if True, TaskTracing object will construct
 
+    tracingmode - (key-word), 'column' or 'append', the mode of TaskTracing, 
+                  in append mode outcomes are committed once per batch
+
+    executor - (key-word), a concurrent.futures.Executor object, 'thread' or 
+               'process' to spread the items across it, None to do items one 
+               by one in the current thread. workfunc must be picklable for a 
+               process pool
+
+    max_workers - (key-word), max workers of the executor constructed for 
+                  'thread' or 'process', a thread pool is constructed if 
+                  only max_workers is given
+
+    chunksize - (key-word), amount of items submitted to executor as one job
+
+    max_inflight - (key-word), max amount of jobs submitted to executor and 
+                   not done, default two times of the cpu count
+
+    lockttl - (key-word), lease seconds of the tasklock, the lease is 
+              renewed by a heartbeat thread while doing the items, so the 
+              lock of a crashed worker can be taken over after lockttl 
+              seconds
+
+    visibility_timeout - (key-word), if not None, the items are leased for 
+                         this seconds instead of removed from the queue, the 
+                         items done ok are acked and those done fail are 
+                         nacked, the items not done in time, e.g. the worker 
+                         crashed, go back to the queue
+
+    num - (key-word), max amount of items to get, all of items if None
+
+    batch_size - (key-word), if not None, workfunc takes a list of at most 
+                 batch_size items and returns a list of the same length, 
+                 True for each item done ok, else fail. A batch is one job 
+                 of executor, chunksize is ignored
+
+    stop - (key-word), a threading.Event or the like, if it is set while 
+           doing the items, the items not done yet are put back into the 
+           queue, see TaskQueue.requeue, and the amount of the items done 
+           is returned
+
+    chunk - (key-word), if not None, the items are gotten and done chunk 
+            items at a time, each chunk traced by its own TaskTracing, until 
+            the queue is empty or num items are done, so the memory does not 
+            grow with the queue, see TaskQueue.iter_get
+
+    partitioned - (key-word), if True, the tasklock is not taken, the 
+                  items are gotten partition by partition by 
+                  TaskQueue.get_partition instead, so many workers do the 
+                  task at the same time, the items of a partition by one 
+                  worker at a time. lockttl is the ttl of the partition 
+                  leases. If tasklock is True, the tasklock held by another 
+                  worker of the lock group is still kept: False is returned 
+                  if it is locked, and no more partition is leased once it 
+                  is locked
+
+    The failed items are retried by the retry policy of the task, see 
+    taskqueue.retry.
+
+    The tasklock is held until all of items are done.
+
+    If the task has a result store, see TaskQueue.set_result_ttl, the value 
+    returned by workfunc for every item is saved, and an exception raised 
+    by workfunc fails its items and is saved instead of stopping do_task, 
+    see taskqueue.results.
+
     """
 
-    q = TaskQueue(taskpool, taskid)
+    q = TaskQueue(taskpool, taskid, visibility_timeout=visibility_timeout)
     if q.empty():
         return None
+    group_lock = None
+    if partitioned and tasklock:
+        # the partition leases take the place of the tasklock, which only 
+        # keeps the lock group out
+        group_lock = q.tasklock()
+        if group_lock.locked():
+            return False
+        tasklock = False
     if tasklock:
-        tlock = q.tasklock()
+        tlock = q.tasklock(ttl=lockttl)
         if not tlock.acquire():
             return False
-    items = q.get()
-    if not items:
-        return None
-    count = len(items)
-    # no tracing
+    pool, owned = None, False
+    chunks = []
+    try:
+        # the tasklock is released in finally if any of these raises, e.g. 
+        # an invalid executor
+        if tasklock and lockttl is not None:
+            tlock.start_heartbeat()
+        pool, owned = get_executor(executor, max_workers)
+        if q.result_ttl is not None:
+            workfunc = _results._CapturedWorkfunc(workfunc, 
+                                                  batch_size is not None)
+        if metrics.REGISTRY is not None:
+            # a process pool records into the registry of its processes
+            workfunc = metrics._TimedWorkfunc(workfunc, q.taskid)
+        if partitioned:
+            chunks = q.iter_get(chunk, num, partitioned=True, ttl=lockttl)
+        elif chunk is None:
+            chunks = [q.get(num)]
+        else:
+            chunks = q.iter_get(chunk, num)
+        total = None
+        for items in chunks:
+            if not items:
+                break
+            done = _do_items(q, items, workfunc, pool, tasktracing, 
+                             tracingmode, chunksize, max_inflight, 
+                             visibility_timeout, batch_size, stop)
+            total = (total or 0) + done
+            if stop is not None and stop.is_set():
+                break
+            if group_lock is not None and group_lock.locked():
+                break
+    finally:
+        if not isinstance(chunks, list):
+            # the lease of the last partition is released
+            chunks.close()
+        if owned:
+            pool.shutdown()
+        if tasklock:
+            tlock.release()
+    return total
+
+
+def _do_items(q, items, workfunc, pool, tasktracing, tracingmode, chunksize, 
+              max_inflight, visibility_timeout, batch_size, stop):
+    """Do the items gotten from q, return the amount of items done"""
+
+    results = map_items(workfunc, items, pool, chunksize=chunksize, 
+                        max_inflight=max_inflight, batch_size=batch_size)
+    done = set()
+    outcomes = None if q.result_ttl is None else {}
+    results = _record(results, done, stop, outcomes)
     if tasktracing:
-        tracing = q.tasktracing(items)
-        for i in range(count):
-            r = workfunc(items[i])
-            if r:
-                tracing.ok(i)
-            else:
-                tracing.fail(i)
+        try:
+            tracing = q.tasktracing(items, mode=tracingmode)
+        except Exception:
+            # the items gotten are not lost if the tracing row can not be 
+            # written
+            q.db.rollback()
+            q.requeue(items)
+            raise
+        with tracing:
+            for i, r in results:
+                if r:
+                    tracing.ok(i)
+                else:
+                    tracing.fail(i)
+    elif visibility_timeout is not None:
+        oks, fails = [], []
+        for i, r in results:
+            (oks if r else fails).append(i)
+        q.ack(items, oks)
+        q.retry(items, fails)
+    elif q.retry_policy is not None:
+        q.retry(items, [i for i, r in results if not r])
     else:
-        for item in items:
-            workfunc(item)
-    if tasklock:
-        tlock.release()
-    return count
+        for i, r in results:
+            pass
+    if len(done) < len(items):
+        # stopped
+        q.requeue(items, [i for i in range(len(items)) if i not in done])
+    if outcomes:
+        indexes = sorted(outcomes)
+        _results.save_results(q.db, q.taskid, items.select_ids(indexes), 
+                              [outcomes[i] for i in indexes], q.result_ttl, 
+                              q.codec)
+        q.db.commit()
+        _results.expire_results(q.db)
+    return len(done)
+
+
+def _record(results, done, stop=None, outcomes=None):
+    """Yield the results of map_items, adding their indexes into done, 
+    until stop is set, and the results into outcomes if not None"""
+
+    try:
+        for i, r in results:
+            done.add(i)
+            if outcomes is not None:
+                outcomes[i] = r
+            yield i, r
+            if stop is not None and stop.is_set():
+                return
+    finally:
+        # the jobs submitted and not done are cancelled
+        results.close()
@@ -0,0 +1,726 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio module
+
+The asyncio interface of TaskQueue, TaskLock and TaskTracing. The sqlite3
+work of an AsyncTaskQueue is done in a dedicated thread, which owns the
+connection to the taskpool, so the event loop is never blocked by the
+queuelock waiting or the sqlite3 I/O. Blocking get waits for the
+notification of the producers on the event loop, see taskqueue.notify.
+
+e.g.
+```
+    async with AsyncTaskQueue('/tmp/taskpool', 1) as q:
+        await q.put(['item1', 'item2'])
+        items = await q.get(block=True, timeout=10)
+```
+
+
+Class:
+
+AsyncTaskQueue
+
+AsyncTaskLock
+
+AsyncTaskTracing
+
+AsyncResultHandle
+
+
+Function:
+
+async_do_task
+
+async_wait
+
+map_items
+
+"""
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .queue import TaskQueue
+from .notify import Waiter, NOTIFY_BACKOFF
+from .tasklock import TaskLockBusy
+from .pool import close_all
+from . import results as _results
+
+
+# Default max amount of workfunc coroutines running at the same time
+AIO_CONCURRENCY = 100
+
+
+class AsyncTaskQueue(object):
+    """Asyncio interface of TaskQueue
+
+    Args:
+
+    taskpool - an sqlite3 database path to store the task information
+
+    taskid - taskid in taskqueue table
+
+    Key-word arguments are passed to TaskQueue. The TaskQueue is constructed
+    in the dedicated thread by the first call, so an unrecognized taskid
+    raises KeyError there.
+
+
+    Method:
+
+    async def open(self)
+        Construct the TaskQueue, and return self
+
+    async def get(self, num=None, block=False, timeout=None)
+        Remove items from queue and return them
+
+    async def consume(self, num=100, timeout=None)
+        Iterate over the items asynchronously, waiting for them to be put
+
+    async def put(self, items, delay=None, not_before=None, priority=0,
+                  result=False)
+        Put items into the queue
+
+    async def ack(self, items, indexes=None)
+        Remove the leased items
+
+    async def nack(self, items, indexes=None, delay=0)
+        Put the leased items back to the queue
+
+    async def retry(self, items, indexes=None)
+        Retry the failed items by the retry policy
+
+    async def set_retry_policy(self, policy)
+        Store the retry policy of the task
+
+    async def set_dedup(self, dedup)
+        Store the dedup setting of the task
+
+    async def empty(self)
+        Check if items in the queue
+
+    def tasktracing(self, items, **kwargs)
+        Construct an AsyncTaskTracing object, and return it
+
+    def tasklock(self, ttl=None)
+        Construct an AsyncTaskLock object, and return it
+
+    async def close(self)
+        Close the connection and stop the thread
+
+    It also can be used in async with statement, which opens and closes it.
+
+    """
+
+    def __init__(self, taskpool, taskid, **kwargs):
+        self.taskpool = taskpool
+        self.taskid = taskid
+        self._kwargs = kwargs
+        self._queue = None
+        self._waiter = None
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='taskqueue-aio')
+
+    @property
+    def retry_policy(self):
+        """Retry policy of the queue, None before open"""
+
+        if self._queue is None:
+            return None
+        return self._queue.retry_policy
+
+    @property
+    def result_ttl(self):
+        """Seconds the results are kept, None before open or if no result
+        store"""
+
+        if self._queue is None:
+            return None
+        return self._queue.result_ttl
+
+    async def open(self):
+        """Construct the TaskQueue in the thread, and return self"""
+
+        await self._run(self._open)
+        return self
+
+    async def get(self, num=None, block=False, timeout=None):
+        """Get num of items from the queue, see TaskQueue.get
+
+        While blocking, the event loop runs other coroutines.
+
+        """
+
+        if num is not None and num < 0:
+            raise KeyError("num must be larger than 0")
+        if not block:
+            return await self._call('_get_nowait', num)
+
+        if self._waiter is None:
+            await self.open()
+            # listen before checking, so no put is missed in between
+            self._waiter = Waiter(self.taskpool, self.taskid)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            items = await self._call('_get_nowait', num)
+            if items:
+                self._waiter.reset()
+                return items
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+            await _wait(self._waiter, remaining)
+
+    async def consume(self, num=100, timeout=None):
+        """Iterate over the items of the queue, see TaskQueue.consume"""
+
+        while True:
+            items = await self.get(num, block=True, timeout=timeout)
+            if not items:
+                return
+            for item in items:
+                yield item
+
+    async def put(self, items, delay=None, not_before=None, priority=0,
+                  result=False):
+        """Put items into the queue, see TaskQueue.put
+
+        With result=True, return a list of AsyncResultHandle of the items,
+        None for the items dropped by dedup.
+
+        """
+
+        r = await self._call('put', items, delay=delay,
+                             not_before=not_before, priority=priority,
+                             result=result)
+        if not result:
+            return r
+        return [None if h is None else AsyncResultHandle(self, h) for h in r]
+
+    async def ack(self, items, indexes=None):
+        """Remove the leased items, see TaskQueue.ack"""
+
+        return await self._call('ack', items, indexes)
+
+    async def nack(self, items, indexes=None, delay=0):
+        """Put the leased items back to the queue, see TaskQueue.nack"""
+
+        return await self._call('nack', items, indexes, delay)
+
+    async def retry(self, items, indexes=None):
+        """Retry the failed items by retry_policy, see TaskQueue.retry"""
+
+        return await self._call('retry', items, indexes)
+
+    async def set_dedup(self, dedup):
+        """Store the dedup setting into taskqueue table"""
+
+        await self._call('set_dedup', dedup)
+
+    async def set_retry_policy(self, policy):
+        """Store the retry policy into taskqueue table, None for no retry"""
+
+        await self._call('set_retry_policy', policy)
+
+    async def empty(self):
+        """Check if the queue item is empty"""
+
+        return await self._call('empty')
+
+    def tasktracing(self, items, **kwargs):
+        """Return AsyncTaskTracing object for tracing
+
+        Key-word arguments are passed to TaskQueue.tasktracing.
+
+        """
+
+        return AsyncTaskTracing(self, items, **kwargs)
+
+    def tasklock(self, ttl=None):
+        """Return AsyncTaskLock object, see TaskQueue.tasklock"""
+
+        return AsyncTaskLock(self, ttl)
+
+    async def close(self):
+        """Close the connection of the thread and stop the thread"""
+
+        if self._waiter is not None:
+            self._waiter.close()
+            self._waiter = None
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, fn, *args, **kwargs):
+        """Run fn in the thread and wait for its result"""
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def _call(self, name, *args, **kwargs):
+        """Call the method name of the TaskQueue in the thread"""
+
+        return await self._run(self._call_queue, name, args, kwargs)
+
+    def _call_queue(self, name, args, kwargs):
+        return getattr(self._open(), name)(*args, **kwargs)
+
+    def _open(self):
+        """Construct the TaskQueue if not yet, in the thread"""
+
+        if self._queue is None:
+            self._queue = TaskQueue(self.taskpool, self.taskid, **self._kwargs)
+            self.taskid = self._queue.taskid
+        return self._queue
+
+    def _close(self):
+        if self._queue is not None:
+            pooled = self._queue._pooled
+            self._queue = None
+            # the pooled connections belong to the thread only
+            if pooled:
+                close_all()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+
+class AsyncTaskLock(object):
+    """Asyncio interface of TaskLock
+
+    Args:
+
+    queue - AsyncTaskQueue object
+
+    ttl - (key-word), seconds of the lease, see TaskLock
+
+
+    Method:
+
+    async def acquire(self)
+        If acquire lock successfully, then return True, eles False.
+
+    async def release(self)
+        Release the lock
+
+    async def renew(self)
+        Extend the lease by ttl seconds
+
+    async def start_heartbeat(self, interval=None)
+        Renew the lease in a background thread until released
+
+    async def locked(self)
+        Check if locked
+
+    It also can be used in async with statement, TaskLockBusy is raised if it
+    cannot be acquired.
+
+    """
+
+    def __init__(self, queue, ttl=None):
+        self.queue = queue
+        self.ttl = ttl
+
+    async def acquire(self):
+        """Acquire a lock, see TaskLock.acquire"""
+
+        return await self._call('acquire')
+
+    async def release(self):
+        """Release the lock, see TaskLock.release"""
+
+        await self._call('release')
+
+    async def renew(self):
+        """Extend the lease by ttl seconds, see TaskLock.renew"""
+
+        return await self._call('renew')
+
+    async def start_heartbeat(self, interval=None):
+        """Renew the lease in a background thread, see TaskLock.start_heartbeat"""
+
+        await self._call('start_heartbeat', interval)
+
+    async def locked(self):
+        """check if locked, an expired lease is not locked"""
+
+        return await self._call('locked')
+
+    async def _call(self, name, *args):
+        def call():
+            tlock = self.queue._open().tasklock(ttl=self.ttl)
+            return getattr(tlock, name)(*args)
+        return await self.queue._run(call)
+
+    async def __aenter__(self):
+        if not await self.acquire():
+            raise TaskLockBusy("lock {} is locked".format(self.queue._queue.lockid))
+        if self.ttl is not None:
+            await self.start_heartbeat()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        def release():
+            tlock = self.queue._open().tasklock(ttl=self.ttl)
+            if tlock.locked_by_self:
+                tlock.release()
+        await self.queue._run(release)
+        return False
+
+
+class AsyncTaskTracing(object):
+    """Asyncio interface of TaskTracing
+
+    Args:
+
+    queue - AsyncTaskQueue object
+
+    items - a list of task items to be finish
+
+    Key-word arguments are passed to TaskQueue.tasktracing. The tracing row
+    is inserted by open, or the first call.
+
+
+    Method:
+
+    async def open(self)
+        Construct the TaskTracing, and return self
+
+    async def ok(self, markname)
+        Indicates the item is done ok
+
+    async def fail(self, markname)
+        Indicates the item is done fail
+
+    async def flush(self)
+        Flush the buffered outcomes of append mode
+
+    async def close(self)
+        Flush the buffered outcomes, it is called when leaving the async
+        with statement.
+
+    async def get_tracing(self)
+        Return the 'markname:ok,markname:fail' string of this tracing
+
+    """
+
+    def __init__(self, queue, items, **kwargs):
+        self.queue = queue
+        self.items = items
+        self._kwargs = kwargs
+        self._tracing = None
+
+    async def open(self):
+        """Construct the TaskTracing in the thread, and return self"""
+
+        await self.queue._run(self._open)
+        return self
+
+    async def ok(self, markname):
+        """Indicates the item is done ok"""
+
+        await self._call('ok', markname)
+
+    async def fail(self, markname):
+        """Indicates the item is done fail"""
+
+        await self._call('fail', markname)
+
+    async def flush(self):
+        """Write the buffered outcomes and commit"""
+
+        await self._call('flush')
+
+    async def close(self):
+        """Flush the buffered outcomes"""
+
+        if self._tracing is not None:
+            await self._call('close')
+
+    async def get_tracing(self):
+        """The 'markname:ok,markname:fail' string of this tracing"""
+
+        return await self.queue._run(lambda: self._open().tracing)
+
+    async def _call(self, name, *args):
+        await self.queue._run(lambda: getattr(self._open(), name)(*args))
+
+    def _open(self):
+        if self._tracing is None:
+            self._tracing = self.queue._open().tasktracing(self.items,
+                                                           **self._kwargs)
+        return self._tracing
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+
+class AsyncResultHandle(object):
+    """Asyncio interface of taskqueue.results.ResultHandle
+
+    Args:
+
+    queue - AsyncTaskQueue the item put into
+
+    handle - ResultHandle of the item, read in the thread of queue
+
+
+    Method:
+
+    async def ready(self)
+        Check if the result is saved
+
+    async def wait(self, timeout=None)
+        Wait for the result, return True if ready
+
+    async def result(self, timeout=None)
+        Wait for the result and return it
+
+    """
+
+    def __init__(self, queue, handle):
+        self.queue = queue
+        self.handle = handle
+
+    @property
+    def itemid(self):
+        return self.handle.itemid
+
+    @property
+    def ok(self):
+        """True if done ok, False if failed, None if not ready"""
+
+        return self.handle.ok
+
+    async def ready(self):
+        """Check if the result is saved, see ResultHandle.ready"""
+
+        return await self.queue._run(self.handle.ready)
+
+    async def wait(self, timeout=None):
+        """Wait for timeout seconds for the result, None means forever"""
+
+        return await async_wait([self], timeout)
+
+    async def result(self, timeout=None):
+        """Wait for the result and return it, see ResultHandle.result"""
+
+        if not await self.wait(timeout):
+            raise TimeoutError("no result of item {}".format(self.itemid))
+        # ready, so it is not read again
+        return self.handle.result(0)
+
+
+async def async_wait(handles, timeout=None):
+    """The asyncio version of taskqueue.results.wait
+
+    handles are AsyncResultHandle objects, polled in bulk in the threads of
+    their queues, while the event loop runs other coroutines. Return True
+    if all of them are ready.
+
+    """
+
+    groups = {}
+    for h in handles:
+        groups.setdefault(id(h.queue), (h.queue, []))[1].append(h.handle)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = NOTIFY_BACKOFF[0]
+    while True:
+        pending = 0
+        for queue, group in groups.values():
+            pending += len(group) - await queue._run(_results.fetch, group)
+        if not pending:
+            return True
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+        await asyncio.sleep(delay if remaining is None
+                            else min(delay, remaining))
+        delay = min(delay * 2, NOTIFY_BACKOFF[1])
+
+
+async def async_do_task(taskpool, taskid, workfunc, tasklock=True,
+                        tasktracing=True, tracingmode='column',
+                        concurrency=None, lockttl=None,
+                        visibility_timeout=None, num=None, batch_size=None):
+    """The asyncio version of taskqueue.do_task
+
+    workfunc is a coroutine function taking one item, or a list of at most
+    batch_size items if batch_size is not None, at most concurrency of them,
+    default AIO_CONCURRENCY, run at the same time. The other arguments are
+    the same as do_task. If empty queue or no items getten,
+    return None, if cannot acquire the tasklock, return False. Otherwise
+    return the amount of the item.
+
+    If the task has a result store, the value returned by workfunc for
+    every item, or the exception raised, is saved as do_task does, see
+    taskqueue.results.
+
+    """
+
+    async with AsyncTaskQueue(taskpool, taskid,
+                              visibility_timeout=visibility_timeout) as q:
+        if await q.empty():
+            return None
+        if tasklock:
+            tlock = q.tasklock(ttl=lockttl)
+            if not await tlock.acquire():
+                return False
+            if lockttl is not None:
+                await tlock.start_heartbeat()
+        try:
+            items = await q.get(num)
+            if not items:
+                return None
+            outcomes = None
+            if q.result_ttl is not None:
+                workfunc = _CapturedWorkfunc(workfunc, batch_size is not None)
+                outcomes = {}
+            results = _record(map_items(workfunc, items, concurrency,
+                                        batch_size), outcomes)
+            if tasktracing:
+                async with q.tasktracing(items, mode=tracingmode) as tracing:
+                    async for i, r in results:
+                        if r:
+                            await tracing.ok(i)
+                        else:
+                            await tracing.fail(i)
+            elif visibility_timeout is not None:
+                oks, fails = [], []
+                async for i, r in results:
+                    (oks if r else fails).append(i)
+                await q.ack(items, oks)
+                await q.retry(items, fails)
+            elif q.retry_policy is not None:
+                await q.retry(items, [i async for i, r in results if not r])
+            else:
+                async for i, r in results:
+                    pass
+            if outcomes:
+                await q._run(_save_outcomes, q._open(), items, outcomes)
+        finally:
+            if tasklock:
+                await tlock.release()
+    return len(items)
+
+
+class _CapturedWorkfunc(object):
+    """Coroutine function workfunc returning results._Error instead of
+    raising, see taskqueue.results._CapturedWorkfunc"""
+
+    def __init__(self, workfunc, batch=False):
+        self.workfunc = workfunc
+        self.batch = batch
+
+    async def __call__(self, item):
+        try:
+            return await self.workfunc(item)
+        except Exception as e:
+            error = _results._Error('{}: {}'.format(type(e).__name__, e))
+            if self.batch:
+                return [error] * len(item)
+            return error
+
+
+async def _record(results, outcomes=None):
+    """Yield (index, result) of results, recording them into outcomes if
+    not None"""
+
+    async for i, r in results:
+        if outcomes is not None:
+            outcomes[i] = r
+        yield i, r
+
+
+def _save_outcomes(q, items, outcomes):
+    """Save the results of the items done and expire the old ones, in the
+    thread of the queue"""
+
+    indexes = sorted(outcomes)
+    _results.save_results(q.db, q.taskid, items.select_ids(indexes),
+                          [outcomes[i] for i in indexes], q.result_ttl,
+                          q.codec)
+    q.db.commit()
+    _results.expire_results(q.db)
+
+
+async def map_items(workfunc, items, concurrency=None, batch_size=None):
+    """Run the coroutine function workfunc on every item, yield (index,
+    result) in the order they are done
+
+    At most concurrency workfunc run at the same time, default
+    AIO_CONCURRENCY. Exception raised by workfunc is raised here, and the
+    running ones are cancelled. With batch_size, workfunc takes a list of at
+    most batch_size items and returns a list of results of the same length.
+
+    """
+
+    if concurrency is None:
+        concurrency = AIO_CONCURRENCY
+    if concurrency < 1:
+        raise ValueError("concurrency must be larger than 0")
+    if batch_size is None:
+        size, run = 1, lambda chunk: _run_item(workfunc, chunk)
+    elif batch_size < 1:
+        raise ValueError("batch_size must be larger than 0")
+    else:
+        size, run = batch_size, lambda chunk: _run_batch(workfunc, chunk)
+    count = len(items)
+    start = 0
+    inflight = {}
+    try:
+        while start < count or inflight:
+            while start < count and len(inflight) < concurrency:
+                task = asyncio.ensure_future(run(items[start:start + size]))
+                inflight[task] = start
+                start += size
+            done, _ = await asyncio.wait(inflight,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                first = inflight.pop(task)
+                for j, r in enumerate(task.result()):
+                    yield first + j, r
+    finally:
+        for task in inflight:
+            task.cancel()
+
+
+async def _run_item(workfunc, chunk):
+    return [await workfunc(chunk[0])]
+
+
+async def _run_batch(workfunc, batch):
+    results = list(await workfunc(batch))
+    if len(results) != len(batch):
+        raise ValueError("workfunc returned {} results for {} items".format(
+            len(results), len(batch)))
+    return results
+
+
+async def _wait(waiter, timeout=None):
+    """Waiter.wait on the event loop, return True if notified"""
+
+    delay = waiter.next_delay(timeout)
+    if waiter.sock is None:
+        await asyncio.sleep(delay)
+        return False
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.wait_for(loop.sock_recv(waiter.sock, 64), delay)
+    except asyncio.TimeoutError:
+        return False
+    waiter.drain()
+    return True
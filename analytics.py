@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Tracing analytics module
+
+Summaries of the tasktracing table read from its ok_count and fail_count
+columns by the tasktracing_taskid and tasktracing_start_time indexes, so
+the tracing strings and the tasktracingitem rows are not parsed. The rows
+traced before the count columns were added count as 0 until
+compact_tracing fills them, see taskqueue.retention.
+
+since and until are seconds ago, None means no limit, e.g. since=3600 is
+the last hour.
+
+The summaries are plain reads, they do not commit the connection, so they
+can be called between the writes of the caller.
+
+
+Function:
+
+summary
+
+failures
+
+throughput
+
+"""
+
+
+def summary(db, taskid=None, since=None, until=None):
+    """Return a list of dicts of taskid, tracings, ok, fail, success_rate
+
+    success_rate is ok / (ok + fail), None if no item is done.
+
+    """
+
+    where, args = _filter(taskid, since, until)
+    rows = db.execute("""SELECT taskid, count(*), coalesce(sum(ok_count), 0),
+                          coalesce(sum(fail_count), 0)
+                         FROM tasktracing {}
+                         GROUP BY taskid ORDER BY taskid""".format(where),
+                      args).fetchall()
+    return [{'taskid': t, 'tracings': n, 'ok': ok, 'fail': fail,
+             'success_rate': ok / float(ok + fail) if ok + fail else None}
+            for t, n, ok, fail in rows]
+
+
+def failures(db, taskid=None, since=None, until=None):
+    """Return a dict of taskid to its amount of failed items, the taskids
+    without failure are left out"""
+
+    where, args = _filter(taskid, since, until)
+    rows = db.execute("""SELECT taskid, sum(fail_count) FROM tasktracing {}
+                         GROUP BY taskid HAVING sum(fail_count) > 0
+                         ORDER BY taskid""".format(where), args).fetchall()
+    return dict(rows)
+
+
+def throughput(db, window, taskid=None, since=None, until=None):
+    """Return a list of (window start, ok, fail) of every window seconds
+
+    window start is a 'YYYY-MM-DD HH:MM:SS' localtime string like
+    tasktracing.start_time, the windows without tracing are left out.
+
+    """
+
+    window = int(window)
+    if window < 1:
+        raise ValueError("window must be larger than 0")
+    where, args = _filter(taskid, since, until)
+    rows = db.execute("""SELECT datetime(strftime('%s', start_time) / ? * ?,
+                          'unixepoch') AS w,
+                          coalesce(sum(ok_count), 0), coalesce(sum(fail_count), 0)
+                         FROM tasktracing {}
+                         GROUP BY w ORDER BY w""".format(where),
+                      [window, window] + args).fetchall()
+    return rows
+
+
+def _filter(taskid, since, until):
+    """Return the WHERE clause and its arguments"""
+
+    conds = []
+    args = []
+    if taskid is not None:
+        conds.append('taskid=?')
+        args.append(taskid)
+    if since is not None:
+        conds.append("start_time >= datetime('now', 'localtime', ?)")
+        args.append('{} seconds'.format(-since))
+    if until is not None:
+        conds.append("start_time < datetime('now', 'localtime', ?)")
+        args.append('{} seconds'.format(-until))
+    if not conds:
+        return '', args
+    return 'WHERE ' + ' AND '.join(conds), args
@@ -0,0 +1,748 @@
+# -*- coding: utf-8 -*-
+"""
+Broker module
+
+A BrokerServer is a local process keeping the head of every queue of a
+taskpool in memory, so a put or get through it is a socket round trip
+instead of a sqlite3 transaction. It persists into the taskpool tables
+behind the replies, in group commits:
+
+- a put is added into the memory, answered, then inserted into taskitem
+  table with the next commit, which is at most durability seconds later.
+  The rows of the items in memory are leased by the broker, so the
+  consumers reading the taskpool directly do not get them. The memory of a
+  taskid is only used while its items are gotten through the broker: the
+  puts of a taskid without a get in the last idle seconds are inserted
+  without lease, and the rows in memory of a taskid idle for that long go
+  back to the queue, for the consumers reading the taskpool directly.
+
+- a get is answered from the memory, the rows of the items gotten are
+  removed with the next commit.
+
+- the memory of a taskid is refilled from taskitem table when it is short
+  of the items to get, or of hot_size / 2 items at most every
+  BROKER_REFILL_INTERVAL seconds, so the items put into the taskpool
+  directly, or delayed, are served as well.
+  When the memory is full, the items put are only inserted into taskitem
+  table, until a refill has loaded all of them, so the items keep their
+  order.
+
+A crash loses the puts answered in the last durability seconds, and the
+items gotten in that time are gotten again. With durability 0 the puts are
+answered after they are committed. On start, the rows leased by a previous
+run of the broker on the same address go back to the queue, so the broker
+rebuilds its memory from the taskpool. The items of dedup puts are
+inserted before answering, since the unique index decides which are
+dropped.
+
+The items are kept as serialized by the producers, so the codec of a
+producer is kept as it is without the broker. A put is deduped if its
+"dedup" is true, default the dedup setting of the task, by the hash of the
+serialized item, see TaskQueue.put. The producers with their own dedup_key
+put into the taskpool directly.
+
+A get with "visibility_timeout" is answered from the memory as well, but
+the items gotten are leased to the consumer in taskitem table, committed
+before answering, so they are acked and nacked in the taskpool, see
+taskqueue.lease.
+
+The protocol is newline-delimited json as taskqueue.putd:
+
+    {"op": "put", "taskid": 1, "items": ["\\"item1\\""], "priority": 0,
+     "dedup": false}
+    {"ok": true, "dropped": 0}
+
+    {"op": "get", "taskid": 1, "num": 10, "visibility_timeout": null}
+    {"ok": true, "items": ["\\"item1\\""], "ids": [null], "attempts": [1],
+     "priorities": [0], "dedup_keys": [null], "partition_ids": [null],
+     "leaseid": null}
+
+where the items are serialized by the codec of the queue, base64 encoded
+with "binary": true if the codec serializes into bytes. A put may have
+"visible_at", "delay" or "not_before", see TaskQueue.put.
+
+A TaskQueue constructed with broker=address talks to the broker, and falls
+back to the taskpool directly while the broker is down.
+
+
+Class:
+
+BrokerServer
+
+BrokerClient
+
+"""
+
+import base64
+import hashlib
+import heapq
+import json
+import os
+import selectors
+import socket
+import sqlite3
+import time
+import uuid
+
+from .queue import TaskQueue, QueueLockTimeOut, _visible_at, _dedup_key
+from .notify import notify
+from .pool import connect
+
+
+# Default amount of items of a taskid kept in memory
+BROKER_HOT_SIZE = 1000
+
+# Default max seconds between a put answered and committed
+BROKER_DURABILITY = 0.05
+
+# Default amount of pending puts and gets to commit at once
+BROKER_BATCH = 1000
+
+# Seconds of the lease of the rows in memory, renewed every third of it
+BROKER_LEASE = 60.0
+
+# Min seconds between two refills of a taskid not short of items
+BROKER_REFILL_INTERVAL = 0.5
+
+# Default seconds without a get of a taskid, after which its items in
+# memory go back to the taskpool
+BROKER_IDLE = 1.0
+
+# Seconds for a client to wait for a reply
+BROKER_TIMEOUT = 5.0
+
+# Max seconds of the broker waiting for the queuelock of a refill, less than
+# BROKER_TIMEOUT so the client gets the error instead of a timeout
+BROKER_LOCK_TIMEOUT = 1.0
+
+# Seconds for a client to use the taskpool directly after the broker is
+# found down, before trying the broker again
+BROKER_RETRY = 1.0
+
+# Indexes of the fields of an item in memory, a list ordered by priority
+# then by the order put
+_PRIORITY, _ORDER, _VALUE, _ID, _ATTEMPTS, _GONE, _KEY, _PART = range(8)
+
+
+class _HotQueue(object):
+    """Items of a taskid in memory of the broker"""
+
+    def __init__(self, q):
+        self.q = q
+        self.heap = []
+        # items may be in taskitem table not loaded
+        self.cold = True
+        self.refill_time = 0
+        # items in memory not inserted yet
+        self.inserts = []
+        # ids of the rows of the items gotten
+        self.deletes = []
+        # monotonic time of the last get, None if idle
+        self.get_time = None
+
+
+class BrokerServer(object):
+    """Broker serving the queues of a taskpool from memory
+
+    Args:
+
+    taskpool - an sqlite3 database path to store the task information
+
+    address - path of the unix socket, or (host, port) of the tcp socket
+
+    durability - (key-word), max seconds between a put answered and
+                 committed, 0 to answer after commit, default
+                 BROKER_DURABILITY
+
+    batch - (key-word), commit when this amount of puts and gets pending,
+            default BROKER_BATCH
+
+    hot_size - (key-word), amount of items of a taskid kept in memory,
+               default BROKER_HOT_SIZE
+
+    lock_timeout - (key-word), max seconds to wait for the queuelock of a
+                   refill, default BROKER_LOCK_TIMEOUT
+
+    idle - (key-word), seconds without a get of a taskid, after which its
+           items in memory go back to the taskpool, default BROKER_IDLE
+
+    A request failing, e.g. by the queuelock timeout or a locked taskpool,
+    is answered with an error, and the broker keeps serving.
+
+
+    Method:
+
+    def serve_forever(self)
+        Serve until shutdown is called
+
+    def shutdown(self)
+        Stop serving, the items in memory go back to the taskpool
+
+    def flush(self)
+        Commit the pending puts and gets
+
+    """
+
+    def __init__(self, taskpool, address, durability=None, batch=None,
+                 hot_size=None, lock_timeout=None, idle=None):
+        self.taskpool = taskpool
+        self.address = address
+        self.durability = (BROKER_DURABILITY if durability is None
+                           else durability)
+        self.batch = BROKER_BATCH if batch is None else batch
+        self.hot_size = BROKER_HOT_SIZE if hot_size is None else hot_size
+        self.lock_timeout = (BROKER_LOCK_TIMEOUT if lock_timeout is None
+                             else lock_timeout)
+        self.idle = BROKER_IDLE if idle is None else idle
+        self.leaseid = 'broker-' + hashlib.sha1('{}|{}'.format(
+            os.path.abspath(taskpool), address).encode('utf-8')).hexdigest()[:16]
+        self.db = None
+        self._hot = {}
+        self._order = 0
+        # items inserted without memory, (taskid, value, visible_at,
+        # priority)
+        self._cold = []
+        # dedup puts, (conn, taskid, values, visible_at, priority)
+        self._sync = []
+        # replies sent after commit, (conn, reply)
+        self._deferred = []
+        self._notify = set()
+        self._pending = 0
+        self._pending_time = None
+        self._lease_time = 0
+        self._buffers = {}
+        self._running = False
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(128)
+        self.sock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.sock, selectors.EVENT_READ)
+
+    def serve_forever(self):
+        """Serve until shutdown is called"""
+
+        # the connection is of the serving thread
+        self.db = connect(self.taskpool)
+        # the rows left by a previous run go back to the queue
+        self.release()
+        self._running = True
+        try:
+            while self._running:
+                # wake up now and then to check shutdown and renew the lease
+                timeout = 0.5
+                if self._pending_time is not None:
+                    timeout = max(0, self._pending_time + self.durability
+                                  - time.monotonic())
+                for key, _ in self._selector.select(timeout):
+                    if key.fileobj is self.sock:
+                        self._accept()
+                    else:
+                        self._read(key.fileobj)
+                if self._pending_time is not None and (
+                        self._pending >= self.batch
+                        or time.monotonic() - self._pending_time >= self.durability):
+                    self.flush()
+                elif time.time() - self._lease_time >= BROKER_LEASE / 3:
+                    self.flush()
+                self._release_idle()
+        finally:
+            self.flush()
+            self.release()
+            self.close()
+
+    def shutdown(self):
+        """Stop serving, it can be called by a signal handler"""
+
+        self._running = False
+
+    def flush(self):
+        """Commit the pending puts and gets, and renew the lease when due"""
+
+        now = time.time()
+        renew = now - self._lease_time >= BROKER_LEASE / 3
+        if self._pending_time is None and not renew:
+            return
+        lease_until = now + BROKER_LEASE
+        cur = self.db.cursor()
+        inserted = []
+        replies = []
+        try:
+            for hot in self._hot.values():
+                for entry in hot.inserts:
+                    if entry[_GONE]:
+                        continue
+                    cur.execute("""INSERT INTO taskitem(taskid, item, visible_at,
+                                    leaseid, priority, aged_at)
+                                   VALUES(?, ?, ?, ?, ?, ?)""",
+                                (hot.q.taskid, entry[_VALUE], lease_until,
+                                 self.leaseid, -entry[_PRIORITY], now))
+                    inserted.append((entry, cur.lastrowid))
+                cur.executemany("""DELETE FROM taskitem WHERE id=? AND leaseid=?""",
+                                ((i, self.leaseid) for i in hot.deletes))
+            cur.executemany("""INSERT INTO taskitem(taskid, item, visible_at,
+                                priority, aged_at) VALUES(?, ?, ?, ?, ?)""",
+                            ((taskid, value, visible_at, priority, now)
+                             for taskid, value, visible_at, priority in self._cold))
+            for conn, taskid, values, visible_at, priority in self._sync:
+                c = cur.executemany("""INSERT OR IGNORE INTO taskitem(taskid,
+                                        item, visible_at, priority, aged_at,
+                                        dedup_key) VALUES(?, ?, ?, ?, ?, ?)""",
+                                    ((taskid, v, visible_at, priority, now,
+                                      _dedup_key(v)) for v in values))
+                replies.append((conn, {'ok': True,
+                                       'dropped': len(values) - c.rowcount}))
+            if renew:
+                # no index on leaseid, so it is done only every third of the
+                # lease
+                cur.execute("""UPDATE taskitem SET visible_at=? WHERE leaseid=?""",
+                            (lease_until, self.leaseid))
+            self.db.commit()
+        except sqlite3.Error:
+            # e.g. the taskpool is locked, the pending puts and gets are kept
+            # to be committed by the next flush
+            self.db.rollback()
+            return
+        for entry, rowid in inserted:
+            entry[_ID] = rowid
+        for hot in self._hot.values():
+            hot.inserts = []
+            hot.deletes = []
+        self._cold = []
+        self._sync = []
+        self._pending = 0
+        self._pending_time = None
+        if renew:
+            self._lease_time = now
+        for taskid in self._notify:
+            notify(self.taskpool, taskid)
+        self._notify = set()
+        deferred, self._deferred = self._deferred + replies, []
+        for conn, reply in deferred:
+            self._reply(conn, reply)
+
+    def release(self):
+        """Put the rows leased by the broker back to the queue"""
+
+        self.db.execute("""UPDATE taskitem SET visible_at=0, leaseid=NULL
+                           WHERE leaseid=?""", (self.leaseid, ))
+        self.db.commit()
+        for hot in self._hot.values():
+            hot.heap = []
+            hot.cold = True
+
+    def _release_idle(self):
+        """Put the rows in memory of the idle taskids back to the queue"""
+
+        now = time.monotonic()
+        idle = [hot for hot in self._hot.values()
+                if hot.get_time is not None and now - hot.get_time >= self.idle]
+        if not idle:
+            return
+        # the items in memory not inserted yet are inserted first
+        self.flush()
+        if self._pending_time is not None:
+            return
+        try:
+            for hot in idle:
+                self.db.execute("""UPDATE taskitem SET visible_at=0, leaseid=NULL
+                                   WHERE taskid=? AND leaseid=?""",
+                                (hot.q.taskid, self.leaseid))
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            return
+        for hot in idle:
+            hot.heap = []
+            hot.cold = True
+            hot.get_time = None
+            notify(self.taskpool, hot.q.taskid)
+
+    def close(self):
+        """Close the sockets"""
+
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._selector.close()
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def _queue(self, taskid):
+        hot = self._hot.get(taskid)
+        if hot is None:
+            hot = self._hot[taskid] = _HotQueue(TaskQueue(
+                self.taskpool, taskid, lock_timeout=self.lock_timeout))
+        return hot
+
+    def _put(self, conn, request):
+        hot = self._queue(request['taskid'])
+        values = request['items']
+        if request.get('binary'):
+            values = [base64.b64decode(v) for v in values]
+        visible_at = request.get('visible_at') or _visible_at(
+            request.get('delay'), request.get('not_before'))
+        priority = request.get('priority', 0)
+        taskid = hot.q.taskid
+        self._add_pending(len(values))
+        dedup = request.get('dedup')
+        if dedup is None:
+            dedup = hot.q.dedup
+        if dedup:
+            self._sync.append((conn, taskid, values, visible_at, priority))
+            if not visible_at:
+                hot.cold = True
+                self._notify.add(taskid)
+            return
+        if visible_at or hot.cold or hot.get_time is None or \
+                len(hot.heap) + len(values) > self.hot_size:
+            self._cold.extend((taskid, v, visible_at, priority) for v in values)
+            if not visible_at:
+                hot.cold = True
+                self._notify.add(taskid)
+        else:
+            for v in values:
+                self._order += 1
+                entry = [-priority, self._order, v, None, 1, False, None, None]
+                heapq.heappush(hot.heap, entry)
+                hot.inserts.append(entry)
+            notify(self.taskpool, taskid)
+        reply = {'ok': True, 'dropped': 0}
+        if self.durability:
+            self._reply(conn, reply)
+        else:
+            self._deferred.append((conn, reply))
+
+    def _get(self, conn, request):
+        hot = self._queue(request['taskid'])
+        hot.get_time = time.monotonic()
+        num = request.get('num')
+        visibility_timeout = request.get('visibility_timeout')
+        want = self.hot_size if num is None else num
+        if hot.cold and len(hot.heap) < max(want, self.hot_size // 2):
+            self._refill(hot)
+        elif len(hot.heap) < self.hot_size // 2 and \
+                time.monotonic() - hot.refill_time >= BROKER_REFILL_INTERVAL:
+            self._refill(hot)
+        entries = []
+        while hot.heap and (num is None or len(entries) < num):
+            entries.append(heapq.heappop(hot.heap))
+        leaseid = None
+        if visibility_timeout is not None:
+            leaseid = self._lease(hot, entries, visibility_timeout)
+        else:
+            for entry in entries:
+                if entry[_ID] is None:
+                    entry[_GONE] = True
+                else:
+                    hot.deletes.append(entry[_ID])
+            if entries:
+                self._add_pending(len(entries))
+        binary = any(isinstance(e[_VALUE], bytes) for e in entries)
+        values = [e[_VALUE] for e in entries]
+        if binary:
+            values = [base64.b64encode(v).decode('ascii') for v in values]
+        self._reply(conn, {'ok': True, 'items': values, 'binary': binary,
+                           'ids': [e[_ID] for e in entries],
+                           'attempts': [e[_ATTEMPTS] for e in entries],
+                           'priorities': [-e[_PRIORITY] for e in entries],
+                           'dedup_keys': [_dump_key(e[_KEY]) for e in entries],
+                           'partition_ids': [e[_PART] for e in entries],
+                           'leaseid': leaseid})
+
+    def _lease(self, hot, entries, visibility_timeout):
+        """Lease the entries gotten to the consumer in taskitem table, and
+        commit, return the leaseid"""
+
+        if not entries:
+            return None
+        # the entries not inserted yet are inserted by the flush
+        self.flush()
+        leaseid = uuid.uuid4().hex
+        try:
+            if any(e[_ID] is None for e in entries):
+                raise sqlite3.OperationalError("items not inserted, taskpool "
+                                               "is locked")
+            self.db.executemany("""UPDATE taskitem SET visible_at=?, leaseid=?,
+                                    attempts=? WHERE id=? AND leaseid=?""",
+                                ((time.time() + visibility_timeout, leaseid,
+                                  e[_ATTEMPTS], e[_ID], self.leaseid)
+                                 for e in entries))
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            # the entries are kept in memory, to be gotten again
+            for entry in entries:
+                heapq.heappush(hot.heap, entry)
+            raise
+        return leaseid
+
+    def _refill(self, hot):
+        """Load the ready items of the taskid from taskitem table"""
+
+        # the items put without memory are loaded in order
+        self.flush()
+        q = hot.q
+        n = self.hot_size - len(hot.heap)
+        hot.refill_time = time.monotonic()
+        if n <= 0:
+            return
+        if not q._legacy_items and q.empty():
+            # a read is enough for an empty queue, see TaskQueue.get
+            hot.cold = False
+            return
+        now = time.time()
+        q._queuelock.acquire()
+        try:
+            if q._legacy_items:
+                q._migrate_items()
+            self.db.execute("""UPDATE taskitem SET visible_at=0, leaseid=NULL
+                               WHERE taskid=? AND visible_at>0 AND visible_at<=?""",
+                            (q.taskid, now))
+            # the items of the partitions leased are skipped, see
+            # TaskQueue._get
+            rows = self.db.execute("""SELECT id, item, attempts, priority,
+                                       dedup_key, partition_id
+                                      FROM taskitem
+                                      WHERE taskid=? AND visible_at=0 AND
+                                       (partition_id IS NULL OR
+                                        partition_id NOT IN (
+                                         SELECT partition_id FROM taskpartition
+                                         WHERE taskid=? AND owner IS NOT NULL
+                                          AND expire_time>=?))
+                                      ORDER BY priority DESC, id LIMIT ?""",
+                                   (q.taskid, q.taskid, now, n)).fetchall()
+            self.db.executemany("""UPDATE taskitem SET visible_at=?, leaseid=?
+                                   WHERE id=?""",
+                                ((now + BROKER_LEASE, self.leaseid, r[0])
+                                 for r in rows))
+        except BaseException:
+            self.db.rollback()
+            raise
+        finally:
+            # changes made under queuelock are committed by releasing
+            q._queuelock.release()
+        for rowid, value, attempts, priority, key, part in rows:
+            self._order += 1
+            heapq.heappush(hot.heap, [-priority, self._order, value, rowid,
+                                      attempts + 1, False, key, part])
+        hot.cold = len(rows) == n
+
+    def _add_pending(self, n):
+        self._pending += n
+        if self._pending_time is None:
+            self._pending_time = time.monotonic()
+
+    def _accept(self):
+        try:
+            conn, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        self._buffers[conn] = b''
+        self._selector.register(conn, selectors.EVENT_READ)
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(conn)
+            return
+        buf = self._buffers[conn] + data
+        lines = buf.split(b'\n')
+        self._buffers[conn] = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            if any(conn is c for c, _ in self._deferred) or \
+                    any(conn is c for c, *_ in self._sync):
+                # the replies of a connection are in order
+                self.flush()
+            try:
+                request = json.loads(line.decode('utf-8'))
+                op = request.get('op')
+                if op == 'put':
+                    if not isinstance(request.get('items'), list):
+                        raise ValueError("items list is required")
+                    self._put(conn, request)
+                elif op == 'get':
+                    self._get(conn, request)
+                else:
+                    raise ValueError("invalid op: {}".format(op))
+            except (ValueError, KeyError, TypeError, QueueLockTimeOut,
+                    sqlite3.Error) as e:
+                if isinstance(e, sqlite3.Error):
+                    # the pending puts and gets are in memory, kept to be
+                    # committed by the next flush
+                    self.db.rollback()
+                self._reply(conn, {'ok': False, 'error': str(e),
+                                   'error_type': type(e).__name__})
+
+    def _reply(self, conn, reply):
+        if conn not in self._buffers:
+            return
+        try:
+            conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        except OSError:
+            self._drop(conn)
+
+    def _drop(self, conn):
+        if conn in self._buffers:
+            del self._buffers[conn]
+            self._selector.unregister(conn)
+            conn.close()
+
+
+class BrokerClient(object):
+    """Connection to a BrokerServer
+
+    Args:
+
+    address - path of the unix socket, or (host, port) of the tcp socket
+
+    timeout - (key-word), seconds to wait for a reply, default
+              BROKER_TIMEOUT
+
+    put and get return None if the broker is down, i.e. the connection
+    fails or is closed without a reply, then the broker is not tried again
+    in BROKER_RETRY seconds, so the caller can use the taskpool directly.
+    RuntimeError is raised if the broker fails the request,
+    taskqueue.queue.QueueLockTimeOut if it fails by the queuelock timeout.
+
+    TimeoutError is raised if the request is sent and not answered in
+    timeout seconds, since the broker may have done it, and doing it again
+    on the taskpool would put the items twice or lose the items gotten.
+
+
+    Method:
+
+    def put(self, taskid, values, visible_at=0, priority=0, dedup=None)
+        Put the serialized items, return the amount of items dropped
+
+    def get(self, taskid, num=None, visibility_timeout=None)
+        Return (values, ids, attempts, priorities, dedup_keys,
+        partition_ids, leaseid) of the items gotten
+
+    def close(self)
+        Close the connection
+
+    """
+
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.timeout = BROKER_TIMEOUT if timeout is None else timeout
+        self.sock = None
+        self._file = None
+        self._down_until = 0
+
+    def put(self, taskid, values, visible_at=0, priority=0, dedup=None):
+        request = {'op': 'put', 'taskid': taskid, 'visible_at': visible_at,
+                   'priority': priority}
+        if dedup is not None:
+            request['dedup'] = bool(dedup)
+        if any(isinstance(v, bytes) for v in values):
+            request['binary'] = True
+            values = [base64.b64encode(v).decode('ascii') for v in values]
+        request['items'] = values
+        reply = self._request(request)
+        return None if reply is None else reply['dropped']
+
+    def get(self, taskid, num=None, visibility_timeout=None):
+        reply = self._request({'op': 'get', 'taskid': taskid, 'num': num,
+                               'visibility_timeout': visibility_timeout})
+        if reply is None:
+            return None
+        values = reply['items']
+        if reply.get('binary'):
+            values = [base64.b64decode(v) for v in values]
+        return (values, reply['ids'], reply['attempts'], reply['priorities'],
+                [_load_key(k) for k in reply['dedup_keys']],
+                reply['partition_ids'], reply['leaseid'])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _request(self, request):
+        if self.sock is None:
+            if time.monotonic() < self._down_until:
+                return None
+            try:
+                self._connect()
+            except OSError:
+                self._down()
+                return None
+        try:
+            self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        except OSError:
+            # the line is not sent whole, so the broker does not do it
+            self._down()
+            return None
+        try:
+            line = self._file.readline()
+        except socket.timeout:
+            # a late reply must not be read as the reply of the next request
+            self.close()
+            raise TimeoutError("no reply of broker {} in {} seconds, the "
+                               "request may be done".format(self.address,
+                                                            self.timeout))
+        except OSError:
+            line = b''
+        if not line:
+            # the broker is gone before answering, so the puts are not
+            # committed unless with durability 0, and the gets go back to
+            # the queue when it restarts
+            self._down()
+            return None
+        reply = json.loads(line.decode('utf-8'))
+        if not reply['ok']:
+            if reply.get('error_type') == 'QueueLockTimeOut':
+                raise QueueLockTimeOut(reply['error'])
+            raise RuntimeError(reply['error'])
+        return reply
+
+    def _connect(self):
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self._file = sock.makefile('rb')
+
+    def _down(self):
+        self.close()
+        self._down_until = time.monotonic() + BROKER_RETRY
+
+    def __del__(self):
+        self.close()
+
+
+def _dump_key(key):
+    """Dedup key as json, the bytes keys are base64 encoded"""
+
+    if isinstance(key, bytes):
+        return {'b64': base64.b64encode(key).decode('ascii')}
+    return key
+
+
+def _load_key(key):
+    if isinstance(key, dict):
+        return base64.b64decode(key['b64'])
+    return key
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Codec module
+
+The items of a queue are serialized by the codec of the queue, which is
+stored in the codec column of taskqueue table. NULL means 'json', which is
+the format written by taskqueue-put and the producers of other languages.
+
+Built-in codecs:
+
+'json' - json.dumps and json.loads, stored as TEXT
+
+'pickle' - pickle of the highest protocol, stored as BLOB, any picklable
+           item but only for trusted producers
+
+'raw' - the items are bytes and stored as they are, as BLOB
+
+'msgpack' - msgpack.packb and msgpack.unpackb, stored as BLOB, only if the
+            msgpack package is installed
+
+Other codecs can be added by register_codec, the consumers must register
+them as well before getting the items.
+
+A codec serializes one item, not a list of them, e.g. 'raw'. A copy of a
+list of items, as tasktracing.items column, is written by dumps_items, and
+read back by loads_items.
+
+
+Class:
+
+Codec
+
+
+Function:
+
+register_codec
+
+get_codec
+
+dumps_items
+
+loads_items
+
+"""
+
+import base64
+import json
+import pickle
+
+
+class Codec(object):
+    """Serialization of queue items
+
+    Args:
+
+    name - name of the codec, stored in taskqueue table
+
+    dumps - function serializing an item to str or bytes
+
+    loads - function deserializing what dumps returns
+
+    """
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+_codecs = {}
+
+
+def register_codec(name, dumps, loads):
+    """Register a codec by name, an existing codec of the name is replaced
+
+    Return the Codec object.
+
+    """
+
+    codec = _codecs[name] = Codec(name, dumps, loads)
+    return codec
+
+
+def get_codec(name=None):
+    """Return the Codec object of name, None means 'json'
+
+    Raise ValueError if no such codec, e.g. 'msgpack' without msgpack
+    installed.
+
+    """
+
+    if name is None:
+        name = 'json'
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError("unknown codec: {}".format(name))
+
+
+def dumps_items(codec, items):
+    """Serialize a list of items of codec into json text
+
+    The json codec dumps the list as it is. The items of the other codecs
+    are serialized one by one, as {"codec": name, "items": [...]}, base64
+    encoded with "binary": true if the codec serializes into bytes.
+
+    """
+
+    if codec.name == 'json':
+        return json.dumps(list(items))
+    values = [codec.dumps(item) for item in items]
+    doc = {'codec': codec.name}
+    if any(isinstance(v, bytes) for v in values):
+        doc['binary'] = True
+        values = [base64.b64encode(v).decode('ascii') for v in values]
+    doc['items'] = values
+    return json.dumps(doc)
+
+
+def loads_items(s, codec=None):
+    """Deserialize what dumps_items returns into a list of items
+
+    codec is the Codec object of a value serialized by codec.dumps of the
+    whole list, as written before dumps_items, default json.
+
+    """
+
+    if isinstance(s, bytes):
+        return (codec or get_codec()).loads(s)
+    doc = json.loads(s)
+    if isinstance(doc, list):
+        return doc
+    values = doc['items']
+    if doc.get('binary'):
+        values = [base64.b64decode(v) for v in values]
+    return [get_codec(doc['codec']).loads(v) for v in values]
+
+
+def _raw_dumps(item):
+    if not isinstance(item, (bytes, bytearray, memoryview)):
+        raise TypeError("raw codec needs bytes items, not {}".format(
+            type(item).__name__))
+    return bytes(item)
+
+
+def _raw_loads(s):
+    return bytes(s)
+
+
+register_codec('json', json.dumps, json.loads)
+register_codec('pickle', lambda item: pickle.dumps(item, pickle.HIGHEST_PROTOCOL),
+               pickle.loads)
+register_codec('raw', _raw_dumps, _raw_loads)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+else:
+    register_codec('msgpack', lambda item: msgpack.packb(item, use_bin_type=True),
+                   lambda s: msgpack.unpackb(s, raw=False))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Executor module
+
+This module spreads the items of a task across a concurrent.futures
+executor, a thread pool or a process pool, for do_task.
+
+
+Function:
+
+get_executor
+
+map_items
+
+"""
+
+import os
+from concurrent.futures import (Executor, ThreadPoolExecutor,
+                                ProcessPoolExecutor, wait, FIRST_COMPLETED)
+
+
+def get_executor(executor=None, max_workers=None):
+    """Return (executor, owned)
+
+    Args:
+
+    executor - None, 'thread', 'process' or a concurrent.futures.Executor
+               object. If None and max_workers is None, return (None, False),
+               which means to run in the current thread
+
+    max_workers - max workers of the executor constructed
+
+    owned is True if the executor is constructed here and should be shut
+    down by the caller.
+
+    """
+
+    if isinstance(executor, Executor):
+        return executor, False
+    if executor is None:
+        if max_workers is None:
+            return None, False
+        executor = 'thread'
+    if executor == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers), True
+    if executor == 'process':
+        return ProcessPoolExecutor(max_workers=max_workers), True
+    raise ValueError("invalid executor: {}".format(executor))
+
+
+def map_items(workfunc, items, executor=None, chunksize=1, max_inflight=None,
+              batch_size=None):
+    """Run workfunc on every item, yield (index, result) as they are done
+
+    Without executor, items are done one after another in the current
+    thread and yielded in order. With executor, items are submitted as
+    chunks of chunksize items, at most max_inflight chunks are submitted
+    and not done at the same time, and the results are yielded in the order
+    they are done. Exception raised by workfunc is raised here.
+
+    With batch_size, workfunc takes a list of at most batch_size items and
+    returns a list of results of the same length, one for each item, and a
+    batch is submitted to executor as one chunk.
+
+    Args:
+
+    workfunc - a callable taking one item, it must be picklable for a
+               process pool
+
+    items - a sequence of items
+
+    executor - a concurrent.futures.Executor object or None
+
+    chunksize - amount of items submitted as one job
+
+    max_inflight - max amount of chunks submitted and not done, default two
+                   times of the cpu count
+
+    batch_size - max amount of items passed to workfunc at once, None means
+                 workfunc takes one item
+
+    """
+
+    run = _run_chunk
+    if batch_size is not None:
+        if batch_size < 1:
+            raise ValueError("batch_size must be larger than 0")
+        run, chunksize = _run_batch, batch_size
+
+    if executor is None:
+        if batch_size is None:
+            for i, item in enumerate(items):
+                yield i, workfunc(item)
+            return
+        for start in range(0, len(items), batch_size):
+            results = _run_batch(workfunc, items[start:start + batch_size])
+            for j, r in enumerate(results):
+                yield start + j, r
+        return
+
+    if chunksize < 1:
+        raise ValueError("chunksize must be larger than 0")
+    if max_inflight is None:
+        max_inflight = 2 * (os.cpu_count() or 1)
+    count = len(items)
+    start = 0
+    inflight = {}
+    try:
+        while start < count or inflight:
+            while start < count and len(inflight) < max_inflight:
+                chunk = items[start:start + chunksize]
+                inflight[executor.submit(run, workfunc, chunk)] = start
+                start += len(chunk)
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                first = inflight.pop(future)
+                for j, r in enumerate(future.result()):
+                    yield first + j, r
+    finally:
+        for future in inflight:
+            future.cancel()
+
+
+def _run_chunk(workfunc, chunk):
+    """Run workfunc on a chunk of items in the executor"""
+
+    return [workfunc(item) for item in chunk]
+
+
+def _run_batch(workfunc, batch):
+    """Run workfunc on a batch of items, check a result for every item"""
+
+    results = list(workfunc(batch))
+    if len(results) != len(batch):
+        raise ValueError("workfunc returned {} results for {} items".format(
+            len(results), len(batch)))
+    return results
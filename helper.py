@@ -3,19 +3,135 @@
 
 import sqlite3
 
-def setup_taskqueue_tables(taskpool):
-    """Create taskqueue tables in taskpool sqlite3 file"""
+
+def load_setup_config():
+    """Load setup.json which describe the taskqueue tables"""
 
     import json
     from os.path import abspath, dirname, join
 
-    db = sqlite3.connect(taskpool)
-    with open(join(dirname(abspath(__file__)), 'setup.json'), 
+    with open(join(dirname(abspath(__file__)), 'setup.json'),
               encoding='utf-8') as configf:
-        config = json.load(configf)
+        return json.load(configf)
+
+
+def setup_taskqueue_tables(taskpool):
+    """Create taskqueue tables in taskpool sqlite3 file"""
+
+    db = sqlite3.connect(taskpool)
+    config = load_setup_config()
     for s in config['setup_sql']:
         db.execute(s)
     db.commit()
-    db.close
+    db.close()
     return True
-    
\ No newline at end of file
+
+
+def shard_paths(taskpool, shards):
+    """Return the paths of the shards of taskpool, taskpool.0, taskpool.1 ..."""
+
+    return ['{}.{}'.format(taskpool, i) for i in range(shards)]
+
+
+def setup_sharded_taskpool(taskpools):
+    """Create taskqueue tables in every shard, see taskqueue.shard"""
+
+    for taskpool in taskpools:
+        setup_taskqueue_tables(taskpool)
+    return True
+
+
+def add_sharded_task(taskpools, desc=None, lockid=None):
+    """Add a task into every shard with the same taskid, return the taskid
+
+    A new tasklock is added into the first shard if lockid is None, the
+    lock is used by every shard, see ShardedTaskQueue.tasklock.
+
+    """
+
+    dbs = [sqlite3.connect(p) for p in taskpools]
+    try:
+        for db in dbs:
+            db.execute("""BEGIN IMMEDIATE""")
+        if lockid is None:
+            lockid = dbs[0].execute(
+                """INSERT INTO tasklock(locked, desc, update_time)
+                   VALUES(0, ?, datetime('now', 'localtime'))""",
+                (desc, )).lastrowid
+        # a taskid free in all of the shards
+        taskid = max(db.execute("""SELECT coalesce(max(taskid), 0)
+                                   FROM taskqueue""").fetchone()[0]
+                     for db in dbs) + 1
+        for db in dbs:
+            db.execute("""INSERT INTO taskqueue(taskid, lockid, qlocked, desc,
+                           update_time)
+                          VALUES(?, ?, 0, ?, datetime('now', 'localtime'))""",
+                       (taskid, lockid, desc))
+        for db in dbs:
+            db.commit()
+    except BaseException:
+        for db in dbs:
+            db.rollback()
+        raise
+    finally:
+        for db in dbs:
+            db.close()
+    return taskid
+
+
+def migrate_taskqueue_tables(taskpool):
+    """Migrate an existing taskpool to the current table layout
+
+    Tables and indexes missing in taskpool are created, columns listed in
+    migrate_columns of setup.json are added if missing, migrate_sql of
+    setup.json is executed to drop the obsolete indexes and the triggers to
+    be recreated, then items stored in the legacy taskqueue.items column are
+    moved into taskitem rows, one row per item, keeping them in front of
+    items already stored as rows.
+    It is safe to run it more than once.
+
+    Return the amount of items moved.
+
+    """
+
+    from .queue import TaskQueue
+
+    db = sqlite3.connect(taskpool)
+    config = load_setup_config()
+    _execute_setup_sql(db, config, ('already exists', 'no such column'))
+    for table, column, decl in config['migrate_columns']:
+        columns = [r[1] for r in db.execute(
+            "PRAGMA table_info({})".format(table))]
+        if column not in columns:
+            db.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                table, column, decl))
+    for s in config['migrate_sql']:
+        db.execute(s)
+    # indexes on the columns just added, and triggers dropped to be updated
+    _execute_setup_sql(db, config, ('already exists', ))
+    db.commit()
+    taskids = [r[0] for r in db.execute(
+        """SELECT taskid FROM taskqueue
+           WHERE items IS NOT NULL AND items NOT IN ('', '[]')""")]
+    db.close()
+
+    moved = 0
+    for taskid in taskids:
+        q = TaskQueue(taskpool, taskid)
+        q._queuelock.acquire()
+        try:
+            moved += q._migrate_items()
+        finally:
+            q._queuelock.release()
+    return moved
+
+
+def _execute_setup_sql(db, config, ignored_errors):
+    """Execute setup_sql, skip the statements failing with ignored_errors"""
+
+    for s in config['setup_sql']:
+        try:
+            db.execute(s)
+        except sqlite3.OperationalError as e:
+            if not any(err in str(e) for err in ignored_errors):
+                raise
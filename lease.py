@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Lease module
+
+Items gotten from a TaskQueue with visibility timeout are not removed from
+the taskitem table but leased: they are invisible to other consumers until
+the timeout, and go back to the queue automatically if not acked by then.
+Acking removes the items, nacking puts them back at once or after a delay.
+
+Leased rows have visible_at set to the time they become visible again, the
+rows ready to get have visible_at 0.
+
+
+Class:
+
+LeasedItems
+
+
+Function:
+
+ack
+
+nack
+
+"""
+
+
+class LeasedItems(list):
+    """List of the items gotten from the queue
+
+    It is a list of the items, with more attributes:
+
+    leaseid - id of the lease, None if the items are removed from the queue
+              instead of leased
+
+    ids - taskitem ids of the items, in the same order
+
+    attempts - times each item has been gotten, in the same order
+
+    priorities - priority of each item, in the same order
+
+    dedup_keys - dedup key of each item, in the same order, None if not 
+                 deduped
+
+    partition_ids - partition of each item, in the same order, None if not 
+                    partitioned
+
+    """
+
+    def __init__(self, items, leaseid, ids, attempts=None, priorities=None, 
+                 dedup_keys=None, partition_ids=None):
+        super().__init__(items)
+        self.leaseid = leaseid
+        self.ids = ids
+        self.attempts = attempts
+        self.priorities = priorities
+        self.dedup_keys = dedup_keys
+        self.partition_ids = partition_ids
+
+    def item_partition(self, i):
+        """Return the partition of the item at index i, None if not 
+        partitioned"""
+
+        if self.partition_ids is not None:
+            return self.partition_ids[i]
+        # the items of get_partition are of its partition
+        return getattr(self, 'partition', None)
+
+    def select_ids(self, indexes=None):
+        """Return the taskitem ids of the items at indexes, all if None"""
+
+        if indexes is None:
+            return list(self.ids)
+        return [self.ids[i] for i in indexes]
+
+
+def ack(db, leaseid, ids):
+    """Remove the leased items, without commit
+
+    Items whose lease has expired and been taken by another lease are not
+    touched. Return the amount of items removed.
+
+    """
+
+    cur = db.executemany("""DELETE FROM taskitem WHERE id=? AND leaseid=?""",
+                         ((i, leaseid) for i in ids))
+    return cur.rowcount
+
+
+def nack(db, leaseid, ids, visible_at=0):
+    """Put the leased items back to the queue, without commit
+
+    visible_at is the time the items become visible again, 0 means at once.
+    Return the amount of items put back.
+
+    """
+
+    cur = db.executemany("""UPDATE taskitem SET visible_at=?, leaseid=NULL
+                            WHERE id=? AND leaseid=?""",
+                         ((visible_at, i, leaseid) for i in ids))
+    return cur.rowcount
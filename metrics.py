@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics module
+
+Counters and latency histograms of the hot paths, exported in the
+Prometheus text format, as a file for the textfile collector of
+node_exporter or on a local HTTP endpoint.
+
+Metrics are off by default. The call sites only check REGISTRY, which is
+None while off, so they cost one attribute lookup. Turn them on by enable:
+
+```
+    from taskqueue import metrics
+    registry = metrics.enable()
+    registry.add_collector(metrics.depth_collector('/tmp/taskpool'))
+    metrics.serve(9108)
+```
+
+Metrics recorded:
+
+taskqueue_queuelock_wait_seconds - histogram of _QueueLock.acquire waiting
+
+taskqueue_queuelock_retries_total - counter of failed tries of acquire
+
+taskqueue_queuelock_timeouts_total - counter of QueueLockTimeOut raised
+
+taskqueue_get_seconds, taskqueue_put_seconds - histograms of the latency
+of get without waiting and put, by taskid
+
+taskqueue_items_gotten_total, taskqueue_items_put_total - counters of
+items, by taskid
+
+taskqueue_workfunc_seconds - histogram of workfunc per call in do_task,
+which is an item or a batch, by taskid, not recorded with a process pool
+
+taskqueue_depth - gauge of items in the queue, by taskid and state, read
+by depth_collector when exported
+
+Every process has its own registry, so use a file or port per process.
+
+
+Class:
+
+Registry
+
+
+Function:
+
+enable
+
+disable
+
+write_textfile
+
+serve
+
+depth_collector
+
+"""
+
+import bisect
+import os
+import threading
+import time
+
+
+# Upper bounds in seconds of the histogram buckets
+METRICS_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The registry metrics are recorded into, None means off
+REGISTRY = None
+
+_HELP = {
+    'taskqueue_queuelock_wait_seconds': 'Seconds waiting for the queuelock',
+    'taskqueue_queuelock_retries_total': 'Failed tries to take the queuelock',
+    'taskqueue_queuelock_timeouts_total': 'QueueLockTimeOut raised',
+    'taskqueue_get_seconds': 'Seconds of get without waiting',
+    'taskqueue_put_seconds': 'Seconds of put',
+    'taskqueue_items_gotten_total': 'Items gotten from the queue',
+    'taskqueue_items_put_total': 'Items put into the queue',
+    'taskqueue_workfunc_seconds': 'Seconds of workfunc for an item or a batch',
+    'taskqueue_depth': 'Items in the queue',
+}
+
+
+class Registry(object):
+    """Counters, histograms and gauges of the metrics
+
+    Args:
+
+    buckets - (key-word), upper bounds of the histogram buckets, default
+              METRICS_BUCKETS
+
+
+    Method:
+
+    def inc(self, name, value=1, **labels)
+        Increase a counter
+
+    def observe(self, name, value, **labels)
+        Record a value into a histogram
+
+    def add_collector(self, collector)
+        Add a function returning gauges when exported
+
+    def render(self)
+        Return the metrics in the Prometheus text format
+
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(METRICS_BUCKETS if buckets is None else buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def inc(self, name, value=1, **labels):
+        """Increase the counter name by value"""
+
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record value into the histogram name"""
+
+        key = (name, _labels(labels))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                # counts of the buckets and +Inf, sum
+                h = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            h[0][i] += 1
+            h[1] += value
+
+    def add_collector(self, collector):
+        """Add collector, a function returning a list of (name, labels dict,
+        value) of gauges, called by render"""
+
+        self._collectors.append(collector)
+
+    def counter(self, name, **labels):
+        """Value of the counter, 0 if not recorded"""
+
+        with self._lock:
+            return self._counters.get((name, _labels(labels)), 0)
+
+    def histogram(self, name, **labels):
+        """(count, sum) of the histogram, (0, 0.0) if not recorded"""
+
+        with self._lock:
+            h = self._histograms.get((name, _labels(labels)))
+            if h is None:
+                return 0, 0.0
+            return sum(h[0]), h[1]
+
+    def render(self):
+        """Return the metrics in the Prometheus text format"""
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(h[0]), h[1]))
+                                for k, h in self._histograms.items())
+        gauges = []
+        for collector in self._collectors:
+            gauges.extend((name, _labels(labels), value)
+                          for name, labels, value in collector())
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP {} {}'.format(name, _HELP.get(name, name)))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        for (name, labels), (counts, total) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf', ), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels + (('le', str(bound)), )),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels),
+                                              repr(total)))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels),
+                                                cumulative))
+        for name, labels, value in sorted(gauges):
+            header(name, 'gauge')
+            lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def enable(registry=None):
+    """Turn metrics on, return the registry recording them"""
+
+    global REGISTRY
+    if registry is None:
+        registry = REGISTRY if REGISTRY is not None else Registry()
+    REGISTRY = registry
+    return registry
+
+
+def disable():
+    """Turn metrics off"""
+
+    global REGISTRY
+    REGISTRY = None
+
+
+def write_textfile(path, registry=None):
+    """Write the metrics into path atomically, for the textfile collector"""
+
+    registry = REGISTRY if registry is None else registry
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(registry.render() if registry is not None else '')
+    os.replace(tmp, path)
+
+
+def serve(port, address='127.0.0.1', registry=None):
+    """Serve the metrics on http://address:port/metrics in a daemon thread
+
+    Return the http.server object, call its shutdown to stop.
+
+    """
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            r = REGISTRY if registry is None else registry
+            body = (r.render() if r is not None else '').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
+
+
+def depth_collector(taskpool):
+    """Return a collector of taskqueue_depth of the taskids in taskpool
+
+    The states are 'ready', 'delayed' for the items to be visible later, and
+    'leased'.
+
+    """
+
+    def collect():
+        from .pool import connect
+
+        db = connect(taskpool)
+        now = time.time()
+        rows = db.execute("""SELECT taskid,
+                              sum(visible_at<=?),
+                              sum(visible_at>? AND leaseid IS NULL),
+                              sum(visible_at>? AND leaseid IS NOT NULL)
+                             FROM taskitem GROUP BY taskid""",
+                          (now, now, now)).fetchall()
+        db.commit()
+        gauges = []
+        for taskid, ready, delayed, leased in rows:
+            for state, value in (('ready', ready), ('delayed', delayed),
+                                 ('leased', leased)):
+                gauges.append(('taskqueue_depth',
+                               {'taskid': taskid, 'state': state}, value))
+        return gauges
+
+    return collect
+
+
+class _TimedWorkfunc(object):
+    """workfunc recording its duration per item"""
+
+    def __init__(self, workfunc, taskid):
+        self.workfunc = workfunc
+        self.taskid = taskid
+
+    def __call__(self, item):
+        start = time.perf_counter()
+        try:
+            return self.workfunc(item)
+        finally:
+            r = REGISTRY
+            if r is not None:
+                r.observe('taskqueue_workfunc_seconds',
+                          time.perf_counter() - start, taskid=self.taskid)
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels) + '}'
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Notify module
+
+This module is a local wakeup channel between producers and consumers of a
+taskpool on the same host.
+
+A waiting consumer binds a unix datagram socket in the notify directory of
+the taskpool, the socket is named after the taskid. After putting, the
+producer sends a datagram to every socket of the taskid, which wakes the
+consumers up at once. Where unix sockets are not available, the consumer
+falls back to polling with an adaptive backoff.
+
+
+Class:
+
+Waiter
+
+
+Function:
+
+notify
+
+"""
+
+import hashlib
+import os
+import select
+import socket
+import tempfile
+import time
+import uuid
+
+
+# First and max seconds of polling interval, the interval doubles after each
+# empty poll. The max interval is also used with the socket, to catch the
+# items put by producers not notifying, e.g. on other hosts
+NOTIFY_BACKOFF = (0.001, 0.5)
+
+
+def notify_dir(taskpool):
+    """Return the notify directory of taskpool
+
+    The directory is in the temp directory and named by the hash of the
+    taskpool path, to keep the socket paths short.
+
+    """
+
+    h = hashlib.sha1(os.path.abspath(taskpool).encode('utf-8')).hexdigest()
+    return os.path.join(tempfile.gettempdir(), 'taskqueue-{}'.format(h[:16]))
+
+
+def notify(taskpool, taskid):
+    """Wake up the consumers of taskid waiting on this host
+
+    Return the amount of consumers notified. Sockets left by dead
+    processes are removed.
+
+    """
+
+    if not hasattr(socket, 'AF_UNIX'):
+        return 0
+    d = notify_dir(taskpool)
+    try:
+        names = os.listdir(d)
+    except OSError:
+        return 0
+    prefix = '{}.'.format(taskid)
+    count = 0
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        for name in names:
+            if not name.startswith(prefix):
+                continue
+            path = os.path.join(d, name)
+            try:
+                sock.sendto(b'1', path)
+                count += 1
+            except BlockingIOError:
+                # the consumer has been notified and not waken up yet
+                count += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                _unlink(path)
+            except OSError:
+                pass
+    finally:
+        sock.close()
+    return count
+
+
+class Waiter(object):
+    """Wait for the items put into a taskid
+
+    Args:
+
+    taskpool - an sqlite3 database path to store the task information
+
+    taskid - taskid in taskqueue table
+
+
+    Method:
+
+    def wait(self, timeout)
+        Sleep until notified or timeout seconds passed
+
+    def reset(self)
+        Reset the polling interval after items are gotten
+
+    def next_delay(self, timeout=None)
+        Return the seconds to sleep for the next wait
+
+    def drain(self)
+        Drop the pending notifications
+
+    def close(self)
+        Close and remove the socket
+
+    """
+
+    def __init__(self, taskpool, taskid):
+        self.delay = NOTIFY_BACKOFF[0]
+        self.sock = None
+        self.path = None
+        if not hasattr(socket, 'AF_UNIX'):
+            return
+        d = notify_dir(taskpool)
+        path = os.path.join(d, '{}.{}.{}'.format(taskid, os.getpid(),
+                                                 uuid.uuid4().hex[:8]))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            os.makedirs(d, exist_ok=True)
+            sock.bind(path)
+        except OSError:
+            # no local channel, polling only
+            sock.close()
+            return
+        sock.setblocking(False)
+        self.sock = sock
+        self.path = path
+
+    def wait(self, timeout=None):
+        """Sleep until notified or timeout seconds passed
+
+        Without socket, sleep the polling interval which doubles after each
+        call until reset. Return True if notified.
+
+        """
+
+        delay = self.next_delay(timeout)
+        if self.sock is None:
+            time.sleep(delay)
+            return False
+        r, _, _ = select.select([self.sock], [], [], delay)
+        if not r:
+            return False
+        self.drain()
+        return True
+
+    def next_delay(self, timeout=None):
+        """Return the seconds to sleep for the next wait
+
+        Without socket, it is the polling interval, which doubles after each
+        call until reset.
+
+        """
+
+        if self.sock is None:
+            delay = self.delay
+            self.delay = min(self.delay * 2, NOTIFY_BACKOFF[1])
+        else:
+            delay = NOTIFY_BACKOFF[1]
+        if timeout is not None:
+            delay = min(delay, timeout)
+        return max(delay, 0)
+
+    def drain(self):
+        """Drop all of the pending notifications"""
+
+        try:
+            while True:
+                self.sock.recv(64)
+        except OSError:
+            pass
+
+    def reset(self):
+        """Reset the polling interval"""
+
+        self.delay = NOTIFY_BACKOFF[0]
+
+    def close(self):
+        """Close and remove the socket"""
+
+        if self.sock is not None:
+            self.sock.close()
+            _unlink(self.path)
+            self.sock = None
+
+    def __del__(self):
+        self.close()
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
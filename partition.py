@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Partition module
+
+A TaskLock serializes the whole task, while the items colliding are often
+only those of the same key, e.g. the same database row. With a partitioned
+queue, every item is put into a partition by the crc32 of its key, see
+TaskQueue(partition_key=...), and a consumer leases a partition before
+getting its items, see TaskQueue.get_partition. So many workers do
+different partitions at the same time, and the items of a key are done by
+one worker at a time, in the order they are put.
+
+The leases are rows of taskpartition table, with owner, expire_time and a
+token increased by each taking as the tasklock, so the partition of a
+crashed worker is taken over after ttl seconds. The tasklock, grouping
+tasks by lockid, is still the coarse-grained option.
+
+The plain gets skip the items of the partitions leased by others, so a
+consumer not partitioned does not take the items of a key being done.
+do_task(partitioned=True) does not take the tasklock, but it does not lease
+the partitions while the tasklock of its lock group is held.
+
+The order of a key holds while its items are not retried: a failed item put
+back with a delay is done after the later items of its partition.
+
+
+Class:
+
+PartitionLease
+
+
+Function:
+
+partition_of
+
+"""
+
+import os
+import socket
+import time
+import uuid
+import zlib
+
+from .tasklock import _Heartbeat
+
+
+# Default amount of partitions of a task
+PARTITION_COUNT = 64
+
+# Default seconds of the lease of a partition
+PARTITION_TTL = 60.0
+
+
+def partition_of(key, partitions):
+    """Return the partition of key, as str, bytes or int"""
+
+    if isinstance(key, int):
+        key = str(key)
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return zlib.crc32(key) % partitions
+
+
+class PartitionLease(object):
+    """Lease of a partition of a task
+
+    Args:
+
+    db - taskpool database connection
+
+    taskid - taskid in taskqueue table
+
+    partition - the partition leased
+
+    ttl - (key-word), seconds of the lease, default PARTITION_TTL
+
+    owner - (key-word), identity of the owner, default host:pid:uuid
+
+
+    Method:
+
+    def acquire(self)
+        Take the lease if free, return True if taken
+
+    def release(self)
+        Release the lease
+
+    def renew(self)
+        Extend the lease by ttl seconds
+
+    def start_heartbeat(self, interval=None)
+        Renew the lease in a background thread until released
+
+    It also can be used in with statement, which releases the lease.
+
+    """
+
+    def __init__(self, db, taskid, partition, ttl=None, owner=None):
+        self.db = db
+        self.taskid = taskid
+        self.partition = partition
+        self.ttl = PARTITION_TTL if ttl is None else ttl
+        if owner is None:
+            owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                      uuid.uuid4().hex)
+        self.owner = owner
+        self.token = None
+        self.locked_by_self = False
+        self._heartbeat = None
+
+    def acquire(self):
+        """Take the lease if it is free or expired, without commit
+
+        It is called under the queuelock by TaskQueue.get_partition, which
+        commits it with the items gotten.
+
+        """
+
+        now = time.time()
+        self.db.execute("""INSERT OR IGNORE INTO taskpartition(taskid,
+                            partition_id) VALUES(?, ?)""",
+                        (self.taskid, self.partition))
+        cur = self.db.execute("""UPDATE taskpartition SET owner=?,
+                                  expire_time=?, token=token+1
+                                 WHERE taskid=? AND partition_id=? AND
+                                  (owner IS NULL OR expire_time < ?)""",
+                              (self.owner, now + self.ttl, self.taskid,
+                               self.partition, now))
+        if cur.rowcount != 1:
+            return False
+        self.token = self.db.execute("""SELECT token FROM taskpartition
+                                        WHERE taskid=? AND partition_id=?""",
+                                     (self.taskid, self.partition)).fetchone()[0]
+        self.locked_by_self = True
+        return True
+
+    def release(self):
+        """Release the lease, return False if it has been lost"""
+
+        if not self.locked_by_self:
+            return False
+        self.stop_heartbeat()
+        self.locked_by_self = False
+        cur = self.db.execute("""UPDATE taskpartition SET owner=NULL,
+                                  expire_time=NULL
+                                 WHERE taskid=? AND partition_id=? AND owner=?
+                                  AND token=?""",
+                              (self.taskid, self.partition, self.owner,
+                               self.token))
+        self.db.commit()
+        return cur.rowcount == 1
+
+    def renew(self):
+        """Extend the lease by ttl seconds from now, return False if lost"""
+
+        if not self.locked_by_self:
+            return False
+        if _renew(self.db, (self.taskid, self.partition), self.owner,
+                  self.token, self.ttl):
+            return True
+        self.locked_by_self = False
+        return False
+
+    def start_heartbeat(self, interval=None):
+        """Renew the lease every interval seconds in a background thread
+
+        interval is default one third of ttl.
+
+        """
+
+        if interval is None:
+            interval = self.ttl / 3
+        self.stop_heartbeat()
+        taskpool = self.db.execute("""PRAGMA database_list""").fetchone()[2]
+        self._heartbeat = _PartitionHeartbeat(
+            taskpool, (self.taskid, self.partition), self.owner, self.token,
+            self.ttl, interval)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        """Stop the heartbeat thread if started"""
+
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+class _PartitionHeartbeat(_Heartbeat):
+    """Thread renewing the lease of a partition, lockid is (taskid,
+    partition)"""
+
+    def renew(self, db):
+        return _renew(db, self.lockid, self.owner, self.token, self.ttl)
+
+
+def _renew(db, lockid, owner, token, ttl):
+    """Extend a partition lease owned by owner with token, return True if
+    done"""
+
+    cur = db.execute("""UPDATE taskpartition SET expire_time=?
+                        WHERE taskid=? AND partition_id=? AND owner=? AND
+                         token=?""",
+                     (time.time() + ttl, lockid[0], lockid[1], owner, token))
+    db.commit()
+    return cur.rowcount == 1
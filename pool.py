@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Connection pool module
+
+The TaskQueue objects of a thread share one connection per taskpool, so
+constructing a TaskQueue does not open a new sqlite3 connection. The
+connections are opened in WAL mode with the pragmas in POOL_PRAGMAS, and
+keep POOL_CACHED_STATEMENTS prepared statements.
+
+The task metadata is cached per process. A cached entry is dropped when
+the schema version of the taskpool changes, or the version in taskmeta
+table changes, which is increased by triggers when taskqueue or tasklock
+rows are changed, see setup.json.
+
+
+Function:
+
+connect
+
+close_all
+
+get_taskmeta
+
+invalidate
+
+"""
+
+import os
+import sqlite3
+import threading
+
+
+# Pragmas executed on opening a connection
+POOL_PRAGMAS = ('PRAGMA journal_mode=WAL',
+                'PRAGMA synchronous=NORMAL',
+                'PRAGMA temp_store=MEMORY')
+
+# Amount of prepared statements kept by a connection
+POOL_CACHED_STATEMENTS = 256
+
+_local = threading.local()
+
+_meta_lock = threading.Lock()
+_meta_cache = {}
+
+
+def connect(taskpool, timeout=5.0, pooled=True):
+    """Return a connection to taskpool
+
+    Args:
+
+    taskpool - an sqlite3 database path to store the task information
+
+    timeout - busy timeout in seconds
+
+    pooled - if True, the connection is shared in the current thread and
+             must not be closed by the caller, else a new connection is
+             returned
+
+    """
+
+    if not pooled:
+        return _open(taskpool, timeout)
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    # a forked child must not use the connections of its parent
+    path = os.path.abspath(taskpool)
+    key = (path, os.getpid())
+    entry = conns.get(key)
+    if entry is not None and entry[2] != _inode(path):
+        # the taskpool file has been replaced
+        entry[0].close()
+        invalidate(path)
+        entry = None
+    if entry is None:
+        db = _open(taskpool, timeout)
+        entry = conns[key] = [db, timeout, _inode(path)]
+    elif entry[1] != timeout:
+        entry[0].execute("PRAGMA busy_timeout={:d}".format(int(timeout * 1000)))
+        entry[1] = timeout
+    return entry[0]
+
+
+def close_all():
+    """Close the pooled connections of the current thread"""
+
+    conns = getattr(_local, 'conns', None)
+    if not conns:
+        return
+    for key, (db, timeout, inode) in list(conns.items()):
+        if key[1] == os.getpid():
+            db.close()
+    conns.clear()
+
+
+def get_taskmeta(db, taskpool, taskid):
+    """Return the cached metadata of taskid as a dict, None if no such task
+
+    See taskqueue.queue.get_taskinfo for the keys.
+
+    """
+
+    from .queue import get_taskinfo
+
+    try:
+        version = db.execute("""SELECT version, (SELECT schema_version FROM
+                                 pragma_schema_version) FROM taskmeta""").fetchone()
+    except sqlite3.OperationalError:
+        # taskpool not migrated yet, no cache
+        version = None
+    path = os.path.abspath(taskpool)
+    if version is not None:
+        version = version + (_inode(path), )
+    key = (path, str(taskid))
+    with _meta_lock:
+        entry = _meta_cache.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    r = get_taskinfo(db, taskid)
+    meta = None if r is None else dict(zip(r.keys(), r))
+    if meta is not None and version is not None:
+        with _meta_lock:
+            _meta_cache[key] = (version, meta)
+    return meta
+
+
+def invalidate(taskpool=None, taskid=None):
+    """Drop the cached metadata of taskid, all of tasks if None"""
+
+    with _meta_lock:
+        if taskpool is None:
+            _meta_cache.clear()
+            return
+        path = os.path.abspath(taskpool)
+        for key in list(_meta_cache):
+            if key[0] == path and (taskid is None or key[1] == str(taskid)):
+                del _meta_cache[key]
+
+
+def _open(taskpool, timeout):
+    db = sqlite3.connect(taskpool, timeout=timeout,
+                         cached_statements=POOL_CACHED_STATEMENTS)
+    for s in POOL_PRAGMAS:
+        db.execute(s)
+    return db
+
+
+def _inode(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
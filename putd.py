@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Put daemon module
+
+A long-lived daemon accepting puts on a unix socket, so that other
+languages can put items without starting a python interpreter for every
+put. The puts coming in are coalesced into group commits: they are
+committed together when PUTD_BATCH items are pending or the oldest put has
+waited PUTD_INTERVAL seconds, then every put is answered.
+
+The protocol is newline-delimited json. Every request is a line of a json
+object:
+
+    {"taskid": 1, "items": ["item1", "item2"]}
+
+with optional keys "delay", "not_before" and "priority", see
+TaskQueue.put. Every request is answered by a line after it is committed:
+
+    {"ok": true, "count": 2, "dropped": 0}
+
+where count is the amount of items put, dropped is the amount of items
+dropped by dedup, see TaskQueue.put.
+
+or, if it fails:
+
+    {"ok": false, "error": "unrecognized taskid: 1"}
+
+e.g. in php:
+```
+<?php
+    $sock = stream_socket_client("unix:///tmp/taskqueue-put.sock");
+    fwrite($sock, json_encode(array('taskid' => 1, 'items' => $items)) . "\\n");
+    $reply = json_decode(fgets($sock), true);
+?>
+```
+
+
+Class:
+
+PutServer
+
+
+Function:
+
+socket_put
+
+"""
+
+import json
+import os
+import selectors
+import socket
+import time
+
+from .queue import TaskQueue, _visible_at
+from .notify import notify
+
+
+# Default amount of pending items to commit at once
+PUTD_BATCH = 1000
+
+# Default max seconds for a put to wait for the group commit
+PUTD_INTERVAL = 0.005
+
+
+class PutServer(object):
+    """Daemon accepting puts on a unix socket
+
+    Args:
+
+    taskpool - an sqlite3 database path to store the task information
+
+    address - path of the unix socket
+
+    batch - (key-word), commit when this amount of items pending, default
+            PUTD_BATCH
+
+    interval - (key-word), commit when the oldest put has waited this
+               seconds, default PUTD_INTERVAL
+
+
+    Method:
+
+    def serve_forever(self)
+        Serve until shutdown is called
+
+    def shutdown(self)
+        Stop serving after committing the pending puts
+
+    """
+
+    def __init__(self, taskpool, address, batch=None, interval=None):
+        self.taskpool = taskpool
+        self.address = address
+        self.batch = PUTD_BATCH if batch is None else batch
+        self.interval = PUTD_INTERVAL if interval is None else interval
+        self._queues = {}
+        self._pending = []
+        self._pending_items = 0
+        self._pending_time = None
+        self._buffers = {}
+        self._running = False
+        if os.path.exists(address):
+            os.unlink(address)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(address)
+        self.sock.listen(128)
+        self.sock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.sock, selectors.EVENT_READ)
+
+    def serve_forever(self):
+        """Serve until shutdown is called"""
+
+        self._running = True
+        try:
+            while self._running:
+                # wake up now and then to check shutdown
+                timeout = 0.5
+                if self._pending_time is not None:
+                    timeout = max(0, self._pending_time + self.interval
+                                  - time.monotonic())
+                for key, _ in self._selector.select(timeout):
+                    if key.fileobj is self.sock:
+                        self._accept()
+                    else:
+                        self._read(key.fileobj)
+                if self._pending and (
+                        self._pending_items >= self.batch
+                        or time.monotonic() - self._pending_time >= self.interval):
+                    self.commit()
+        finally:
+            self.commit()
+            self.close()
+
+    def shutdown(self):
+        """Stop serving, it can be called by a signal handler"""
+
+        self._running = False
+
+    def commit(self):
+        """Commit the pending puts and answer them"""
+
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self._pending_items = 0
+        self._pending_time = None
+        done = []
+        db = None
+        for conn, request in pending:
+            try:
+                q = self._queue(request['taskid'])
+                visible_at = _visible_at(request.get('delay'),
+                                         request.get('not_before'))
+                dropped = q._put(request['items'], visible_at,
+                                 request.get('priority', 0), commit=False)
+                db = q.db
+                done.append((conn, {'ok': True, 'dropped': dropped,
+                                    'count': len(request['items']) - dropped},
+                             q.taskid if not visible_at else None))
+            except Exception as e:
+                done.append((conn, {'ok': False, 'error': str(e)}, None))
+        error = None
+        if db is not None:
+            try:
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                error = str(e)
+        for taskid in set(t for c, r, t in done if t is not None and error is None):
+            notify(self.taskpool, taskid)
+        for conn, reply, taskid in done:
+            if error is not None and reply['ok']:
+                reply = {'ok': False, 'error': error}
+            self._reply(conn, reply)
+
+    def close(self):
+        """Close the sockets"""
+
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._selector.close()
+        try:
+            os.unlink(self.address)
+        except OSError:
+            pass
+
+    def _queue(self, taskid):
+        q = self._queues.get(taskid)
+        if q is None:
+            q = self._queues[taskid] = TaskQueue(self.taskpool, taskid)
+        return q
+
+    def _accept(self):
+        try:
+            conn, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        self._buffers[conn] = b''
+        self._selector.register(conn, selectors.EVENT_READ)
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(conn)
+            return
+        buf = self._buffers[conn] + data
+        lines = buf.split(b'\n')
+        self._buffers[conn] = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if 'taskid' not in request or not isinstance(request.get('items'), list):
+                    raise ValueError("taskid and items list are required")
+            except ValueError as e:
+                self._reply(conn, {'ok': False, 'error': str(e)})
+                continue
+            self._pending.append((conn, request))
+            self._pending_items += len(request['items'])
+            if self._pending_time is None:
+                self._pending_time = time.monotonic()
+
+    def _reply(self, conn, reply):
+        if conn not in self._buffers:
+            return
+        try:
+            conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        except OSError:
+            self._drop(conn)
+
+    def _drop(self, conn):
+        if conn in self._buffers:
+            del self._buffers[conn]
+            self._selector.unregister(conn)
+            conn.close()
+
+
+def socket_put(address, taskid, items, **kwargs):
+    """Put items through the daemon listening on address
+
+    Key-word arguments are delay, not_before and priority of TaskQueue.put.
+    Return the amount of items put, not including the items dropped by
+    dedup, raise RuntimeError if failed.
+
+    """
+
+    request = dict(kwargs, taskid=taskid, items=list(items))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        f = sock.makefile('rb')
+        line = f.readline()
+        f.close()
+    finally:
+        sock.close()
+    if not line:
+        raise RuntimeError("no reply from {}".format(address))
+    reply = json.loads(line.decode('utf-8'))
+    if not reply['ok']:
+        raise RuntimeError(reply['error'])
+    return reply['count']
@@ -3,6 +3,8 @@
 Queue module
 
 This module implement a simeple queue data structrue basing on sqlite3.
+Each item is stored as a row of the taskitem table, ordered by its priority
+from high to low, then by its id.
 
 
 Class:
@@ -11,19 +13,47 @@ TaskQueue
 
 """
 
+import hashlib
 import sqlite3
 import json
 import time
+import uuid
+import warnings
 from .tracing import TaskTracing
 from .tasklock import TaskLock
+from .notify import Waiter, notify
+from .lease import LeasedItems, ack, nack
+from .retry import RetryPolicy, retry
+from .pool import connect, get_taskmeta
+from .codec import get_codec
+from .partition import PartitionLease, partition_of, PARTITION_COUNT
+from .results import ResultHandle
+from . import metrics
 
 
-# Max try-time of queuelock to acquire the lock
-QUEUE_LOCK_TRY_TIME = 10
+# Max seconds of queuelock trying to acquire the lock
+QUEUE_LOCK_TIMEOUT = 10
+
+# Deprecated alias of QUEUE_LOCK_TIMEOUT, the tries were one second apart, 
+# so the amount of tries is the seconds. It is still used if set
+QUEUE_LOCK_TRY_TIME = QUEUE_LOCK_TIMEOUT
+_QUEUE_LOCK_TRY_TIME = QUEUE_LOCK_TRY_TIME
+
+# First and max seconds to sleep between two tries of acquiring queuelock,
+# the sleep doubles after each failed try
+QUEUE_LOCK_BACKOFF = (0.0001, 0.05)
+
+# Seconds of sqlite3 waiting for a locked database before raising 
+# sqlite3.OperationalError
+QUEUE_BUSY_TIMEOUT = 5.0
 
 
 class TaskQueue(object):
-    def __init__(self, taskpool, taskid):
+    def __init__(self, taskpool, taskid, lockmode='update', lock_timeout=None, 
+                 busy_timeout=None, visibility_timeout=None, retry_policy=None, 
+                 aging=None, pooled=True, codec=None, dedup=None, 
+                 dedup_key=None, broker=None, partition_key=None, 
+                 partitions=None, result_ttl=None):
         """
         Args:
 
@@ -31,108 +61,867 @@ class TaskQueue(object):
         
         taskid - taskid in taskqueue table
 
+        lockmode - (key-word), how queuelock is taken, 'update' or 
+                   'immediate', see _QueueLock
+
+        lock_timeout - (key-word), max seconds to wait for queuelock, 
+                       default QUEUE_LOCK_TIMEOUT
+
+        busy_timeout - (key-word), sqlite3 busy timeout in seconds, 
+                       default QUEUE_BUSY_TIMEOUT
+
+        visibility_timeout - (key-word), if not None, get leases the items 
+                             for this seconds instead of removing them, they 
+                             are removed by ack and go back to the queue by 
+                             nack or when the lease expires, see 
+                             taskqueue.lease
+
+        retry_policy - (key-word), taskqueue.retry.RetryPolicy object of the 
+                       failed items, default the policy stored in taskqueue 
+                       table
+
+        aging - (key-word), if not None, the priority of the items waiting 
+                in the queue is increased by 1 every aging seconds, so items 
+                of low priority are not starved
+
+        pooled - (key-word), if True, the connection to taskpool is shared 
+                 with the other TaskQueue objects of the thread, and the 
+                 task metadata is cached, see taskqueue.pool
+
+        codec - (key-word), name of the codec serializing the items, 
+                default the codec stored in taskqueue table, see 
+                taskqueue.codec
+
+        dedup - (key-word), if True, put drops the items whose key is the 
+                same as an item pending or leased in the queue, default 
+                the dedup setting stored in taskqueue table
+
+        dedup_key - (key-word), function returning the key of an item, as 
+                    str, bytes or int, default the hash of the serialized 
+                    item. Dedup is enabled if given, unless dedup is False
+
+        broker - (key-word), address of a taskqueue.broker.BrokerServer of 
+                 taskpool, a unix socket path or (host, port), to put and 
+                 get through it. The taskpool is used directly while the 
+                 broker is down. A 
+                 request the broker does not answer in time raises 
+                 TimeoutError, see taskqueue.broker.BrokerClient
+
+        partition_key - (key-word), function returning the partition key 
+                        of an item, as str, bytes or int. The items put are 
+                        assigned to partitions by it, to be gotten by 
+                        get_partition, see taskqueue.partition
+
+        partitions - (key-word), amount of partitions, default the amount 
+                     stored in taskqueue table, or PARTITION_COUNT
+
+        result_ttl - (key-word), if not None, do_task saves the result of 
+                     every item for this seconds, to be read by the handles 
+                     returned by put, default the result_ttl stored in 
+                     taskqueue table, see taskqueue.results
+
         Method:
 
-        def get(self, num=None)
+        def get(self, num=None, block=False, timeout=None)
             Remove items from queue and return them
 
-        def put(self, items)
+        def consume(self, num=100, timeout=None)
+            Iterate over the items, waiting for them to be put
+
+        def iter_get(self, chunk=1000, num=None, partitioned=False, ttl=None)
+            Iterate over the items of the queue in chunks
+
+        def get_partition(self, num=None, ttl=None)
+            Lease a partition and get its items
+
+        def put(self, items, delay=None, not_before=None, priority=0, 
+                result=False)
             Put items into the queue
 
+        def ack(self, items, indexes=None)
+            Remove the leased items
+
+        def nack(self, items, indexes=None, delay=0)
+            Put the leased items back to the queue
+
+        def retry(self, items, indexes=None)
+            Retry the failed items by the retry policy
+
+        def requeue(self, items, indexes=None)
+            Put the items not done back to the queue
+
+        def set_retry_policy(self, policy)
+            Store the retry policy of the task
+
+        def set_codec(self, codec)
+            Store the codec of the task
+
+        def set_dedup(self, dedup)
+            Store the dedup setting of the task
+
+        def set_partitions(self, partitions)
+            Store the amount of partitions of the task
+
+        def set_result_ttl(self, ttl)
+            Store the seconds the results of the task are kept
+
         def empty(self)
             Check if items in the queue
 
-        def tasktracing(self, items)
+        def tasktracing(self, items, **kwargs)
             Construct a taskqueue.tracing.TaskTracing object, and return it
 
-        def tasklock(self)
-            Construct a taskqueue.tracing.TaskLock object, and return it
+        def tasklock(self, ttl=None)
+            Construct a taskqueue.tasklock.TaskLock object, and return it
 
         """
 
-        self.db = sqlite3.connect(taskpool)
-        self._taskinfo = get_taskinfo(self.db, taskid)
-        if self._taskinfo is None:
+        if busy_timeout is None:
+            busy_timeout = QUEUE_BUSY_TIMEOUT
+        self.taskpool = taskpool
+        self._pooled = pooled
+        self.db = connect(taskpool, busy_timeout, pooled)
+        self._meta = get_taskmeta(self.db, taskpool, taskid)
+        if self._meta is None:
             raise KeyError('unrecognized taskid: {}'.format(taskid))
-        self.taskid = self._taskinfo['taskid']
-        self.lockid = self._taskinfo['lockid']
-        self._queuelock = _QueueLock(self.db, self.taskid)
+        self.taskid = self._meta['taskid']
+        self.lockid = self._meta['lockid']
+        self._queuelock = _QueueLock(self.db, self.taskid, lockmode, 
+                                     lock_timeout)
+        self.visibility_timeout = visibility_timeout
+        if retry_policy is None:
+            retry_policy = RetryPolicy.from_taskinfo(self._meta)
+        self.retry_policy = retry_policy
+        self.aging = aging
+        self.codec = get_codec(self._meta['codec'] if codec is None else codec)
+        if dedup is None:
+            dedup = dedup_key is not None or bool(self._meta['dedup'])
+        self.dedup = dedup
+        self.dedup_key = dedup_key
+        self.partition_key = partition_key
+        if partitions is None:
+            partitions = self._meta['partitions'] or PARTITION_COUNT
+        self.partitions = partitions
+        if result_ttl is None:
+            result_ttl = self._meta['result_ttl']
+        self.result_ttl = result_ttl
+        self._broker = None
+        if broker is not None:
+            from .broker import BrokerClient
+            self._broker = BrokerClient(broker)
+        self._aged_time = 0
         self._tasklock = None
+        self._waiter = None
+        # items left in the legacy taskqueue.items column are moved into 
+        # taskitem rows by the first get
+        self._legacy_items = self._meta['items'] not in (None, '', '[]')
 
-    def get(self, num=None):
+    @property
+    def _taskinfo(self):
+        """Task information read from taskpool, not cached"""
+
+        return get_taskinfo(self.db, self.taskid)
+
+    def get(self, num=None, block=False, timeout=None):
         """Get num of items from the queue
         
         If num is None or num > len(items), then all of items will be return, 
         else num of items will be return. num must be > 0, otherwise raise
         KeyError.
 
+        If block is True and the queue is empty, wait until items are put or 
+        timeout seconds passed, timeout None means to wait forever. The 
+        consumer is woken up at once by the producers on the same host, see 
+        taskqueue.notify. Return [] if no items getten.
+
+        The items are returned as a taskqueue.lease.LeasedItems list, with 
+        visibility_timeout they are leased to be acked or nacked.
+
         """
 
         if num is not None and num < 0:
             raise KeyError("num must be larger than 0")
+        if not block:
+            return self._get_nowait(num)
+
+        if self._waiter is None:
+            # listen before checking, so no put is missed in between
+            self._waiter = Waiter(self.taskpool, self.taskid)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            items = self._get_nowait(num)
+            if items:
+                self._waiter.reset()
+                return items
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+            self._waiter.wait(remaining)
+
+    def consume(self, num=100, timeout=None):
+        """Iterate over the items of the queue
+        
+        Items are gotten num at a time with blocking get, the iteration stops 
+        when no items are put in timeout seconds, timeout None means never.
+
+        """
 
+        while True:
+            items = self.get(num, block=True, timeout=timeout)
+            if not items:
+                return
+            for item in items:
+                yield item
+
+    def iter_get(self, chunk=1000, num=None, partitioned=False, ttl=None):
+        """Iterate over the items of the queue, chunk items at a time
+        
+        Every chunk is gotten when the previous one is asked for, so only 
+        one chunk is in memory, unlike get() which returns the whole queue. 
+        The chunks are taskqueue.lease.LeasedItems lists, to be acked or 
+        traced one by one. The iteration stops when the queue is empty, or 
+        after num items if num is not None. chunk None means all of items 
+        at a time.
+
+        If partitioned, every chunk is gotten by get_partition, its lease 
+        is renewed by a heartbeat while the chunk is done, and released 
+        when the next chunk is asked for.
+
+        """
+
+        if chunk is not None and chunk < 1:
+            raise KeyError("chunk must be larger than 0")
+        count = 0
+        while num is None or count < num:
+            n = chunk
+            if num is not None:
+                n = num - count if chunk is None else min(chunk, num - count)
+            if not partitioned:
+                items = self.get(n)
+                if not items:
+                    return
+                count += len(items)
+                yield items
+                continue
+            items = self.get_partition(n, ttl)
+            if not items:
+                return
+            lease = items.partition_lease
+            lease.start_heartbeat()
+            try:
+                count += len(items)
+                yield items
+            finally:
+                lease.release()
+
+    def get_partition(self, num=None, ttl=None):
+        """Lease a partition not leased by others and get num of its items
+        
+        The partition of the first ready item, by priority then by order, 
+        whose partition is free is leased for ttl seconds, default 
+        PARTITION_TTL. The items are of that partition, in order, a 
+        taskqueue.lease.LeasedItems list with the partition in its 
+        partition attribute, and the taskqueue.partition.PartitionLease in 
+        its partition_lease attribute, which must be released after the 
+        items are done. Return [] if no such partition. The items put 
+        without partition_key are not gotten.
+
+        """
+
+        if num is not None and num < 0:
+            raise KeyError("num must be larger than 0")
+        if self.empty():
+            return []
         self._queuelock.acquire()
-        items = self._get()
-        if num is None:
-            num = len(items)
-        r, items_left = items[:num], items[num:]
-        self._put(items_left)
-        self._queuelock.release()
+        try:
+            if self._legacy_items:
+                self._migrate_items()
+            items = self._get_partition(num, ttl)
+        except BaseException:
+            self.db.rollback()
+            raise
+        finally:
+            # changes made under queuelock are committed by releasing
+            self._queuelock.release()
         return items
 
-    def put(self, items):
+    def _get_nowait(self, num=None):
+        """Get num of items from the queue without waiting"""
+
+        reg = metrics.REGISTRY
+        if reg is None:
+            return self._get_once(num)
+        start = time.perf_counter()
+        items = self._get_once(num)
+        reg.observe('taskqueue_get_seconds', time.perf_counter() - start, 
+                    taskid=self.taskid)
+        if items:
+            reg.inc('taskqueue_items_gotten_total', len(items), 
+                    taskid=self.taskid)
+        return items
+
+    def _get_once(self, num=None):
+        """Take queuelock and get num of items from the queue"""
+
+        if self._broker is not None:
+            r = self._broker.get(self.taskid, num, self.visibility_timeout)
+            if r is not None:
+                values, ids, attempts, priorities, keys, parts, leaseid = r
+                loads = self.codec.loads
+                return LeasedItems([loads(v) for v in values], leaseid, ids, 
+                                   attempts, priorities, keys, parts)
+
+        # a read is enough for an empty queue, it saves taking queuelock 
+        # which is a write and would starve the producers
+        if self.empty():
+            return []
+
+        self._queuelock.acquire()
+        try:
+            if self._legacy_items:
+                self._migrate_items()
+            items = self._get(num)
+        except BaseException:
+            self.db.rollback()
+            raise
+        finally:
+            # changes made under queuelock are committed by releasing
+            self._queuelock.release()
+        return items
+
+    def put(self, items, delay=None, not_before=None, priority=0, 
+            result=False):
         """Put items into the queue
         
         Args:
 
-        items - items must be iterable, we use json.loads(items) to serialize it
+        items - items must be iterable, each of them is serialized by the 
+                codec of the queue, json.dumps by default
+
+        delay - (key-word), seconds before the items can be gotten
+
+        not_before - (key-word), unix time before which the items can not 
+                     be gotten
+
+        priority - (key-word), items of higher priority are gotten first, 
+                   items of the same priority are gotten in order
+
+        result - (key-word), if True, return a list of 
+                 taskqueue.results.ResultHandle of the items, None for the 
+                 items dropped by dedup. Raise ValueError if result_ttl of 
+                 the queue is not set
+
+        Every item is appended as a row, so putting does not need to touch 
+        the items already in the queue and no queuelock is needed.
+
+        With dedup, the key of every item is stored in the unique index 
+        taskitem_dedup, the items whose key is already in the queue are 
+        dropped by the index, which is also correct for concurrent 
+        producers. Return the amount of items dropped.
 
         """
 
-        self._queuelock.acquire()
-        item_list = self._get()
-        item_list.extend(items)
-        self._put(item_list)
-        self._queuelock.release()
+        if result and self.result_ttl is None:
+            raise ValueError("no result store of task {}".format(self.taskid))
+        reg = metrics.REGISTRY
+        if reg is not None:
+            start = time.perf_counter()
+        if reg is not None or self._broker is not None:
+            items = list(items)
+        visible_at = _visible_at(delay, not_before)
+        dropped = None
+        handles = [] if result else None
+        if (self._broker is not None and self.partition_key is None and 
+                self.dedup_key is None and not result):
+            # the broker notifies the consumers, it does not keep partitions 
+            # nor return the ids of the items, and it dedups by the hash of 
+            # the serialized items only
+            dropped = self._broker.put(self.taskid, 
+                                       [self.codec.dumps(i) for i in items], 
+                                       visible_at, priority, self.dedup)
+        if dropped is None:
+            dropped = self._put(items, visible_at, priority, ids=handles)
+            if not visible_at:
+                notify(self.taskpool, self.taskid)
+        if reg is not None:
+            reg.observe('taskqueue_put_seconds', time.perf_counter() - start, 
+                        taskid=self.taskid)
+            reg.inc('taskqueue_items_put_total', len(items) - dropped, 
+                    taskid=self.taskid)
+        if result:
+            return [None if i is None else ResultHandle(self, i) 
+                    for i in handles]
+        return dropped
+
+    def ack(self, items, indexes=None):
+        """Remove the leased items, which are done
+        
+        Args:
+
+        items - taskqueue.lease.LeasedItems returned by get
+
+        indexes - indexes of the items to ack, all of items if None
+
+        Return the amount of items removed, items whose lease has expired 
+        and which are leased again are not removed.
+
+        """
+
+        r = ack(self.db, items.leaseid, items.select_ids(indexes))
+        self.db.commit()
+        return r
+
+    def nack(self, items, indexes=None, delay=0):
+        """Put the leased items back to the queue
+        
+        Args:
+
+        items - taskqueue.lease.LeasedItems returned by get
+
+        indexes - indexes of the items to nack, all of items if None
+
+        delay - seconds before the items are visible again
+
+        Return the amount of items put back.
+
+        """
+
+        visible_at = time.time() + delay if delay else 0
+        r = nack(self.db, items.leaseid, items.select_ids(indexes), visible_at)
+        self.db.commit()
+        if not delay:
+            notify(self.taskpool, self.taskid)
+        return r
+
+    def requeue(self, items, indexes=None):
+        """Put the items gotten and not done back to the queue at once
+        
+        Args:
+
+        items - taskqueue.lease.LeasedItems returned by get
+
+        indexes - indexes of the items not done, all of items if None
+
+        Leased items are nacked, items removed from the queue are put again 
+        with their priority, partition and dedup key, and with their id if 
+        still free, so they keep their place in the queue and the handles 
+        of their results, see TaskQueue.put. Return the amount of items put 
+        back.
+
+        """
+
+        if indexes is None:
+            indexes = range(len(items))
+        if items.leaseid is not None:
+            return self.nack(items, indexes)
+        now = time.time()
+        dumps = self.codec.dumps
+        rows = []
+        for i in indexes:
+            s = dumps(items[i])
+            key = None if items.dedup_keys is None else items.dedup_keys[i]
+            if key is None and self.dedup:
+                key = _dedup_key(s) if self.dedup_key is None else self.dedup_key(items[i])
+            part = items.item_partition(i)
+            if part is None and self.partition_key is not None:
+                part = partition_of(self.partition_key(items[i]), 
+                                    self.partitions)
+            rows.append((None if items.ids is None else items.ids[i], 
+                         self.taskid, s, 
+                         0 if items.attempts is None else items.attempts[i], 
+                         0 if items.priorities is None else items.priorities[i], 
+                         now, key, part))
+        cur = self.db.executemany("""INSERT OR IGNORE INTO taskitem(id, taskid, 
+                                      item, attempts, priority, aged_at, 
+                                      dedup_key, partition_id) 
+                                     VALUES((SELECT CASE WHEN EXISTS(
+                                              SELECT 1 FROM taskitem 
+                                              WHERE id=?1) 
+                                             THEN NULL ELSE ?1 END), 
+                                            ?, ?, ?, ?, ?, ?, ?)""", rows)
+        count = cur.rowcount
+        self.db.commit()
+        notify(self.taskpool, self.taskid)
+        return count
+
+    def retry(self, items, indexes=None):
+        """Retry the failed items by retry_policy
+        
+        Args:
+
+        items - taskqueue.lease.LeasedItems returned by get
+
+        indexes - indexes of the failed items, all of items if None
+
+        The items are put back with a delay, or moved to the dead letter 
+        taskid after max attempts. Without retry_policy, leased items are 
+        nacked and removed items are dropped. Return (amount of items to 
+        retry, amount of dead items).
+
+        """
+
+        if indexes is None:
+            indexes = range(len(items))
+        if self.retry_policy is None:
+            return self.nack(items, indexes), 0
+        r = retry(self.db, self.taskid, items, indexes, self.retry_policy, 
+                  codec=self.codec)
+        self.db.commit()
+        return r
+
+    def set_retry_policy(self, policy):
+        """Store the retry policy into taskqueue table, None for no retry"""
+
+        if policy is None:
+            policy = RetryPolicy()
+        self.db.execute("""UPDATE taskqueue SET max_attempts=?, retry_delay=?, 
+                            retry_backoff=?, retry_max_delay=?, dead_taskid=?, 
+                            update_time=datetime('now', 'localtime') 
+                           WHERE taskid=?""", 
+                        (policy.max_attempts, policy.delay, policy.backoff, 
+                         policy.max_delay, policy.dead_taskid, self.taskid))
+        self.db.commit()
+        self.retry_policy = None if policy.max_attempts is None else policy
+
+    def set_codec(self, codec):
+        """Store the codec into taskqueue table, None for 'json'
+        
+        The items are not converted, so raise ValueError if the queue has 
+        items, including the leased and delayed ones.
+
+        """
+
+        codec = get_codec(codec)
+        if self._legacy_items or self.db.execute(
+                """SELECT 1 FROM taskitem WHERE taskid=? LIMIT 1""", 
+                (self.taskid, )).fetchone() is not None:
+            raise ValueError("can not change the codec of a queue with items")
+        self.db.execute("""UPDATE taskqueue SET codec=?, 
+                            update_time=datetime('now', 'localtime') 
+                           WHERE taskid=?""", 
+                        (None if codec.name == 'json' else codec.name, 
+                         self.taskid))
+        self.db.commit()
+        self.codec = codec
+
+    def set_dedup(self, dedup):
+        """Store the dedup setting into taskqueue table
+        
+        The items already in the queue have no key, so they are not 
+        compared with the items put later.
+
+        """
+
+        self.db.execute("""UPDATE taskqueue SET dedup=?, 
+                            update_time=datetime('now', 'localtime') 
+                           WHERE taskid=?""", 
+                        (1 if dedup else 0, self.taskid))
+        self.db.commit()
+        self.dedup = bool(dedup)
+
+    def set_partitions(self, partitions):
+        """Store the amount of partitions into taskqueue table, None for 
+        PARTITION_COUNT
+        
+        The partition of a key changes with the amount, so raise ValueError 
+        if the queue has items of partitions.
+
+        """
+
+        if self.db.execute("""SELECT 1 FROM taskitem 
+                              WHERE taskid=? AND partition_id IS NOT NULL 
+                              LIMIT 1""", (self.taskid, )).fetchone() is not None:
+            raise ValueError("can not change the partitions of a queue with items")
+        self.db.execute("""UPDATE taskqueue SET partitions=?, 
+                            update_time=datetime('now', 'localtime') 
+                           WHERE taskid=?""", (partitions, self.taskid))
+        self.db.commit()
+        self.partitions = PARTITION_COUNT if partitions is None else partitions
+
+    def set_result_ttl(self, ttl):
+        """Store the seconds the results of the task are kept into 
+        taskqueue table, None disables the result store
+        
+        The results saved are kept until they expire.
+
+        """
+
+        self.db.execute("""UPDATE taskqueue SET result_ttl=?, 
+                            update_time=datetime('now', 'localtime') 
+                           WHERE taskid=?""", (ttl, self.taskid))
+        self.db.commit()
+        self.result_ttl = ttl
 
     def empty(self):
         """Check if the queue item is empty"""
 
-        return not bool(self._get())
+        if self._legacy_items:
+            return False
+        # visible_at is 0 for the ready items
+        return self.db.execute("""SELECT 1 FROM taskitem 
+                                  WHERE taskid=? AND visible_at<=? LIMIT 1""", 
+                               (self.taskid, time.time())).fetchone() is None
+
+    def tasktracing(self, items, **kwargs):
+        """Return tasktracing object for tracing
+        
+        Key-word arguments are passed to taskqueue.tracing.TaskTracing, the 
+        failed items are retried by retry_policy of the queue.
+
+        """
+        
+        kwargs.setdefault('retry_policy', self.retry_policy)
+        kwargs.setdefault('codec', self.codec.name)
+        return TaskTracing(self.db, self.taskid, items, **kwargs)
 
-    def tasktracing(self, items):
-        """Return tasktracing object for tracing"""
+    def tasklock(self, ttl=None):
+        """Return tasklock object, if no lock raise ValueError
         
-        return TaskTracing(self.db, self.taskid, items)
+        ttl is the lease seconds of the lock, see taskqueue.tasklock.TaskLock. 
+        The returned object can be used in with statement.
 
-    def tasklock(self):
-        """Return tasklock object, if no lock raise ValueError"""
+        """
 
         if self._tasklock is None:
-            self._tasklock = TaskLock(self.db, self.taskid, self.lockid)
+            self._tasklock = TaskLock(self.db, self.taskid, self.lockid, ttl=ttl, 
+                                      check=not self._meta['lock_found'])
+        elif ttl is not None:
+            self._tasklock.ttl = ttl
         return self._tasklock
 
-    def _put(self, items):
-        """Put items into queue without checking tasklock and without concatenation"""
+    def _put(self, items, visible_at=0, priority=0, commit=True, 
+             partition=None, ids=None):
+        """Append items into queue without checking queuelock
+        
+        The items are put into partition if not None, else into the 
+        partitions of their partition_key if given. Return the amount of 
+        items dropped by dedup.
 
-        s = json.dumps(items)
-        self.db.execute("""UPDATE taskqueue SET items=?, 
-                            update_time=datetime('now', 'localtime') 
-                           WHERE taskid=?""", (s, self.taskid))
-        self.db.commit()
+        If ids is a list, the taskitem id of every item, None if dropped, 
+        is appended to it, which inserts the items one by one.
+
+        """
+
+        if ids is not None:
+            return self._put_ids(items, visible_at, priority, commit, 
+                                 partition, ids)
+        now = time.time()
+        dumps = self.codec.dumps
+        if partition is None and self.partition_key is not None:
+            key, partitions = self.partition_key, self.partitions
+            part = lambda item: partition_of(key(item), partitions)
+        else:
+            part = lambda item: partition
+        if not self.dedup:
+            self.db.executemany("""INSERT INTO taskitem(taskid, item, visible_at, 
+                                    priority, aged_at, partition_id) 
+                                   VALUES(?, ?, ?, ?, ?, ?)""", 
+                                ((self.taskid, dumps(item), visible_at, 
+                                  priority, now, part(item)) for item in items))
+            dropped = 0
+        else:
+            rows = []
+            for item in items:
+                s = dumps(item)
+                key = _dedup_key(s) if self.dedup_key is None else self.dedup_key(item)
+                rows.append((self.taskid, s, visible_at, priority, now, key, 
+                             part(item)))
+            cur = self.db.executemany("""INSERT OR IGNORE INTO taskitem(taskid, 
+                                          item, visible_at, priority, aged_at, 
+                                          dedup_key, partition_id) 
+                                         VALUES(?, ?, ?, ?, ?, ?, ?)""", 
+                                      rows)
+            dropped = len(rows) - cur.rowcount
+        if commit:
+            self.db.commit()
+        return dropped
+
+    def _put_ids(self, items, visible_at, priority, commit, partition, ids):
+        """_put collecting the taskitem ids of the items into ids"""
+
+        now = time.time()
+        dumps = self.codec.dumps
+        dropped = 0
+        for item in items:
+            s = dumps(item)
+            key = None
+            if self.dedup:
+                key = _dedup_key(s) if self.dedup_key is None else self.dedup_key(item)
+            part = partition
+            if part is None and self.partition_key is not None:
+                part = partition_of(self.partition_key(item), self.partitions)
+            cur = self.db.execute("""INSERT OR IGNORE INTO taskitem(taskid, 
+                                      item, visible_at, priority, aged_at, 
+                                      dedup_key, partition_id) 
+                                     VALUES(?, ?, ?, ?, ?, ?, ?)""", 
+                                  (self.taskid, s, visible_at, priority, now, 
+                                   key, part))
+            if cur.rowcount == 1:
+                ids.append(cur.lastrowid)
+            else:
+                ids.append(None)
+                dropped += 1
+        if commit:
+            self.db.commit()
+        return dropped
+
+    def _get_partition(self, num=None, ttl=None):
+        """Lease a free partition and get num of its items without checking 
+        queuelock and without commit"""
+
+        now = time.time()
+        self._ready(now)
+        # the ready items are scanned by the taskitem_ready index, skipping 
+        # the partitions leased
+        r = self.db.execute("""SELECT partition_id FROM taskitem 
+                               WHERE taskid=? AND visible_at=0 AND 
+                                partition_id IS NOT NULL AND 
+                                partition_id NOT IN (
+                                 SELECT partition_id FROM taskpartition 
+                                 WHERE taskid=? AND owner IS NOT NULL AND 
+                                  expire_time>=?)
+                               ORDER BY priority DESC, id LIMIT 1""", 
+                            (self.taskid, self.taskid, now)).fetchone()
+        if r is None:
+            return []
+        lease = PartitionLease(self.db, self.taskid, r[0], ttl=ttl)
+        if not lease.acquire():
+            return []
+        items = self._get(num, r[0])
+        items.partition = r[0]
+        items.partition_lease = lease
+        return items
+
+    def _get(self, num=None, partition=None):
+        """Remove num of items from queue and return them without checking 
+        queuelock and without commit, all of items if num is None
+        
+        With visibility_timeout the items are leased instead of removed. 
+        With partition, only the items of the partition are gotten, which 
+        are made ready by _get_partition. Without, the items of the 
+        partitions leased by others are skipped, so their keys are still 
+        done by one consumer at a time.
+
+        """
 
-    def _get(self):
-        """Get all items without checking tasklock"""
+        if num is None:
+            num = -1
+        now = time.time()
+        if partition is not None:
+            # the index taskitem_partition is in this order
+            rows = self.db.execute("""SELECT id, item, attempts, priority, 
+                                       dedup_key, partition_id 
+                                      FROM taskitem 
+                                      WHERE taskid=? AND partition_id=? AND 
+                                       visible_at=0 
+                                      ORDER BY priority DESC, id LIMIT ?""", 
+                                   (self.taskid, partition, num)).fetchall()
+            return self._take(rows, now)
+        self._ready(now)
+        # the index taskitem_ready is in this order, only num rows are read 
+        # besides those of the partitions leased
+        rows = self.db.execute("""SELECT id, item, attempts, priority, 
+                                   dedup_key, partition_id 
+                                  FROM taskitem 
+                                  WHERE taskid=? AND visible_at=0 AND 
+                                   (partition_id IS NULL OR 
+                                    partition_id NOT IN (
+                                     SELECT partition_id FROM taskpartition 
+                                     WHERE taskid=? AND owner IS NOT NULL AND 
+                                      expire_time>=?)) 
+                                  ORDER BY priority DESC, id LIMIT ?""", 
+                               (self.taskid, self.taskid, now, num)).fetchall()
+        return self._take(rows, now)
+
+    def _ready(self, now):
+        """Make the items whose visible time is due ready, and age the 
+        items, without commit"""
+
+        # only the items due are scanned by the index
+        self.db.execute("""UPDATE taskitem SET visible_at=0, leaseid=NULL 
+                           WHERE taskid=? AND visible_at>0 AND visible_at<=?""", 
+                        (self.taskid, now))
+        if self.aging is not None and now - self._aged_time >= self.aging:
+            self._age(now)
+
+    def _take(self, rows, now):
+        """Remove or lease the rows selected, return the items"""
+
+        if not rows:
+            return []
+        loads = self.codec.loads
+        items = [loads(r[1]) for r in rows]
+        ids = [r[0] for r in rows]
+        attempts = [r[2] + 1 for r in rows]
+        priorities = [r[3] for r in rows]
+        keys = [r[4] for r in rows]
+        parts = [r[5] for r in rows]
+        if self.visibility_timeout is None:
+            self.db.executemany("""DELETE FROM taskitem WHERE id=?""", 
+                                ((i, ) for i in ids))
+            return LeasedItems(items, None, ids, attempts, priorities, keys, 
+                               parts)
+        leaseid = uuid.uuid4().hex
+        self.db.executemany("""UPDATE taskitem SET visible_at=?, leaseid=?, 
+                                attempts=attempts+1 WHERE id=?""", 
+                            ((now + self.visibility_timeout, leaseid, i) 
+                             for i in ids))
+        return LeasedItems(items, leaseid, ids, attempts, priorities, keys, 
+                           parts)
+
+    def _age(self, now):
+        """Increase the priority of the items waiting longer than aging 
+        seconds, without checking queuelock and without commit
+        
+        It scans the ready items of the task, so it is done at most once 
+        every aging seconds.
+
+        """
+
+        self.db.execute("""UPDATE taskitem SET priority=priority+1, aged_at=? 
+                           WHERE taskid=? AND visible_at=0 AND aged_at<=?""", 
+                        (now, self.taskid, now - self.aging))
+        self._aged_time = now
+
+    def _migrate_items(self):
+        """Move items in the legacy taskqueue.items column into taskitem rows 
+        without checking queuelock and without commit
+        
+        The moved items are given ids smaller than any existing row, so they 
+        are still in front of the items put after them, and the results 
+        saved for these ids are deleted. Return the amount of items moved.
+
+        """
 
         s = self.db.execute("""SELECT items FROM taskqueue 
                                WHERE taskid=? LIMIT 1""", 
                             (self.taskid, )).fetchone()[0]
-        if s == '':
-            s = '[]'
-        return json.loads(s)
+        items = json.loads(s) if s else []
+        first_id = self.db.execute("""SELECT min(id) FROM taskitem""").fetchone()[0]
+        if first_id is None:
+            first_id = len(items) + 1
+        base = first_id - len(items)
+        self.db.executemany("""INSERT INTO taskitem(id, taskid, item) 
+                               VALUES(?, ?, ?)""", 
+                            ((base + i, self.taskid, self.codec.dumps(item)) 
+                             for i, item in enumerate(items)))
+        # the ids may be of items done before, their results are not of 
+        # the moved items
+        self.db.execute("""DELETE FROM taskresult 
+                           WHERE itemid>=? AND itemid<?""", (base, first_id))
+        self.db.execute("""UPDATE taskqueue SET items='[]', 
+                            update_time=datetime('now', 'localtime') 
+                           WHERE taskid=?""", (self.taskid, ))
+        self._legacy_items = False
+        return len(items)
 
     def __del__(self):
-        self.db.close()
+        if getattr(self, '_waiter', None) is not None:
+            self._waiter.close()
+        if not getattr(self, '_pooled', True):
+            self.db.close()
 
 
 class _QueueLock(object):
@@ -145,35 +934,84 @@ class _QueueLock(object):
     lockdb - taskpool database connection
 
     taskid - taskid in taskqueue table
+
+    mode - 'update' takes the qlocked flag with one conditional UPDATE, 
+           'immediate' also holds a sqlite3 write transaction (BEGIN 
+           IMMEDIATE) from acquire to release, no extra commit is needed to 
+           take and release the lock
+
+    timeout - max seconds to try, default QUEUE_LOCK_TIMEOUT, or the 
+              deprecated QUEUE_LOCK_TRY_TIME if it is set
+
+    The changes made under the lock are committed by release.
     
     """
 
-    def __init__(self, lockdb, taskid):
+    def __init__(self, lockdb, taskid, mode='update', timeout=None):
+        if mode not in ('update', 'immediate'):
+            raise ValueError("invalid queuelock mode: {}".format(mode))
         self.db = lockdb
         self.taskid = taskid
+        self.mode = mode
+        self.timeout = _lock_timeout() if timeout is None else timeout
 
     def acquire(self):
         """acquire the lock
         
         If the qlocked is not locked by other process, then return True,
-        else first try taskqueue.queue.QUEUE_LOCK_TRY_TIME times 
-        untill get the lock, finally if still cannot get the lock raise 
+        else keep trying with a backoff sleep, starting from 
+        QUEUE_LOCK_BACKOFF[0] seconds and doubling up to QUEUE_LOCK_BACKOFF[1],
+        finally if still cannot get the lock after timeout seconds raise 
         taskqueue.queue.QueueLockTimeOut.
 
         """
 
-        i = QUEUE_LOCK_TRY_TIME
-        while i > 0:
-            if not self.locked():
-                self.lock()
-                return True
-            time.sleep(1)
-            i -= 1
-        raise QueueLockTimeOut("failed after 10 times trying.")
+        start = time.monotonic()
+        deadline = start + self.timeout
+        delay, max_delay = QUEUE_LOCK_BACKOFF
+        tries = 0
+        while True:
+            try:
+                if self._try_lock():
+                    if metrics.REGISTRY is not None:
+                        self._record(start, tries)
+                    return True
+            except sqlite3.OperationalError as e:
+                # database locked longer than the busy timeout
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                self.db.rollback()
+            tries += 1
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            time.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, max_delay)
+        if metrics.REGISTRY is not None:
+            self._record(start, tries, timeout=True)
+        raise QueueLockTimeOut("failed after trying for {} seconds."
+                               .format(self.timeout))
+
+    def _record(self, start, tries, timeout=False):
+        """Record the waiting of acquire into the metrics"""
+
+        reg = metrics.REGISTRY
+        if reg is None:
+            return
+        reg.observe('taskqueue_queuelock_wait_seconds', 
+                    time.monotonic() - start, taskid=self.taskid)
+        if tries:
+            reg.inc('taskqueue_queuelock_retries_total', tries, 
+                    taskid=self.taskid)
+        if timeout:
+            reg.inc('taskqueue_queuelock_timeouts_total', taskid=self.taskid)
 
     def release(self):
         """Release qlocked"""
 
+        if self.mode == 'immediate':
+            self.db.commit()
+            return
         self.db.execute("""UPDATE taskqueue SET qlocked=?, 
                             update_time=datetime('now', 'localtime') 
                            WHERE taskid=?""", (0, self.taskid))
@@ -185,18 +1023,39 @@ class _QueueLock(object):
         qlocked = self.db.execute("""SELECT qlocked FROM taskqueue 
                                      WHERE taskid=? LIMIT 1""", 
                                      (self.taskid, )).fetchone()[0]
-        assert qlocked in (0, 1), "invalid qlocked type: {}".format(qlocked)
+        assert qlocked in (0, 1, None), "invalid qlocked type: {}".format(qlocked)
         if qlocked == 1:
             return True
         return False
 
     def lock(self):
-        """make locked"""
+        """make locked
+        
+        Return True if qlocked is changed from unlocked to locked by this 
+        call, else False.
 
-        self.db.execute("""UPDATE taskqueue SET qlocked=?, 
-                            update_time=datetime('now', 'localtime') 
-                           WHERE taskid=?""", (1, self.taskid))
+        """
+
+        cur = self.db.execute("""UPDATE taskqueue SET qlocked=?, 
+                                  update_time=datetime('now', 'localtime') 
+                                 WHERE taskid=? AND 
+                                  (qlocked=0 OR qlocked IS NULL)""", 
+                              (1, self.taskid))
         self.db.commit()
+        return cur.rowcount == 1
+
+    def _try_lock(self):
+        """Try to take the lock once"""
+
+        if self.mode == 'update':
+            return self.lock()
+        self.db.execute("""BEGIN IMMEDIATE""")
+        # the write transaction excludes other writers, qlocked is still 
+        # checked for the processes locking in update mode
+        if self.locked():
+            self.db.rollback()
+            return False
+        return True
 
 
 class QueueLockTimeOut(RuntimeError):
@@ -205,16 +1064,47 @@ class QueueLockTimeOut(RuntimeError):
     pass
 
 
+def _lock_timeout():
+    """Default seconds of queuelock"""
+
+    if QUEUE_LOCK_TRY_TIME != _QUEUE_LOCK_TRY_TIME:
+        warnings.warn("QUEUE_LOCK_TRY_TIME is deprecated, use "
+                      "QUEUE_LOCK_TIMEOUT", DeprecationWarning, stacklevel=3)
+        return QUEUE_LOCK_TRY_TIME
+    return QUEUE_LOCK_TIMEOUT
+
+
+def _visible_at(delay=None, not_before=None):
+    """Return visible_at of the items put with delay and not_before"""
+
+    visible_at = 0
+    if delay:
+        visible_at = time.time() + delay
+    if not_before is not None:
+        visible_at = max(visible_at, not_before)
+    return visible_at
+
+
+def _dedup_key(s):
+    """Key of a serialized item for dedup"""
+
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    return hashlib.sha1(s).digest()
+
+
 def get_taskinfo(db, taskid):
     """Get task information"""
 
-    ori_row_factory = db.row_factory
-    db.row_factory = sqlite3.Row
-    r = db.execute("""SELECT taskid, que.lockid, que.items, que.qlocked, 
-                        que.desc AS queue_desc, locked, current_taskid, 
-                        lck.desc AS lock_desc 
-                      FROM taskqueue AS que LEFT JOIN tasklock AS lck 
-                      ON que.lockid = lck.lockid WHERE taskid = ? LIMIT 1""", 
-                  (taskid, )).fetchone()
-    db.row_factory = ori_row_factory
-    return r
+    cur = db.cursor()
+    cur.row_factory = sqlite3.Row
+    return cur.execute("""SELECT taskid, que.lockid, que.items, que.qlocked, 
+                            que.desc AS queue_desc, locked, current_taskid, 
+                            lck.desc AS lock_desc, 
+                            lck.lockid IS NOT NULL AS lock_found, 
+                            max_attempts, retry_delay, retry_backoff, 
+                            retry_max_delay, dead_taskid, codec, dedup, 
+                            partitions, result_ttl 
+                          FROM taskqueue AS que LEFT JOIN tasklock AS lck 
+                          ON que.lockid = lck.lockid WHERE taskid = ? LIMIT 1""", 
+                       (taskid, )).fetchone()
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Results module
+
+An optional store of the results of the items, so the producers can get
+back what the workfunc returns. It is enabled per task by
+TaskQueue.set_result_ttl. Then do_task saves the return value of workfunc
+for every item, or the exception raised, which fails the item instead of
+stopping do_task, into taskresult table, keyed by the taskitem id of the
+item and kept for result_ttl seconds. The values are serialized by the
+codec of the queue.
+
+TaskQueue.put(items, result=True) returns a ResultHandle for every item, to
+wait on:
+
+```
+    handles = q.put(items, result=True)
+    results.wait(handles, timeout=60)
+    values = [h.result() for h in handles]
+```
+
+The results are looked up by the primary key, and the expired ones are
+removed by do_task in batches of RESULT_EXPIRE_BATCH through the
+taskresult_expire index, see expire_results.
+
+A result is saved when its item is done, and replaced by every attempt
+retried, an item put back by a retry or a requeue keeps its taskitem id.
+
+
+Class:
+
+ResultHandle
+
+ResultError
+
+
+Function:
+
+fetch
+
+wait
+
+save_results
+
+expire_results
+
+"""
+
+import time
+
+from .notify import NOTIFY_BACKOFF
+
+
+# Status of a result, workfunc returned a true value, a false value, or
+# raised an exception
+RESULT_OK = 1
+RESULT_FAIL = 0
+RESULT_ERROR = 2
+
+# Max amount of expired results removed at a time
+RESULT_EXPIRE_BATCH = 1000
+
+# Max amount of results read by a query of fetch
+_FETCH_CHUNK = 500
+
+
+class ResultError(RuntimeError):
+    """Raise by ResultHandle.result if workfunc raised an exception"""
+
+    pass
+
+
+class ResultHandle(object):
+    """Handle of the result of an item put
+
+    Args:
+
+    queue - TaskQueue the item put into
+
+    itemid - taskitem id of the item
+
+
+    Method:
+
+    def ready(self)
+        Check if the result is saved
+
+    def wait(self, timeout=None)
+        Wait for the result, return True if ready
+
+    def result(self, timeout=None)
+        Wait for the result and return it
+
+    """
+
+    def __init__(self, queue, itemid):
+        self.queue = queue
+        self.itemid = itemid
+        self.status = None
+        self.value = None
+        self.error = None
+
+    def ready(self):
+        """Check if the result is saved, it is read once saved"""
+
+        if self.status is None:
+            fetch([self])
+        return self.status is not None
+
+    def wait(self, timeout=None):
+        """Wait for timeout seconds for the result, None means forever
+
+        Return True if the result is ready.
+
+        """
+
+        return wait([self], timeout)
+
+    def result(self, timeout=None):
+        """Wait for the result and return the value returned by workfunc
+
+        Raise ResultError if workfunc raised an exception, TimeoutError if
+        not ready in timeout seconds, or the result has expired.
+
+        """
+
+        if not self.wait(timeout):
+            raise TimeoutError("no result of item {}".format(self.itemid))
+        if self.status == RESULT_ERROR:
+            raise ResultError(self.error)
+        return self.value
+
+    @property
+    def ok(self):
+        """True if done ok, False if failed, None if not ready"""
+
+        if self.status is None:
+            return None
+        return self.status == RESULT_OK
+
+
+def fetch(handles):
+    """Read the results of the handles not ready yet, in bulk
+
+    Return the amount of handles ready.
+
+    """
+
+    pending = {}
+    for h in handles:
+        if h.status is None and h.itemid is not None:
+            pending.setdefault((id(h.queue.db), h.queue.codec.name), []).append(h)
+    for group in pending.values():
+        db = group[0].queue.db
+        loads = group[0].queue.codec.loads
+        for start in range(0, len(group), _FETCH_CHUNK):
+            chunk = dict((h.itemid, h) for h in group[start:start + _FETCH_CHUNK])
+            rows = db.execute("""SELECT itemid, status, result, error
+                                 FROM taskresult WHERE itemid IN ({})""".format(
+                                     ','.join('?' * len(chunk))),
+                              list(chunk)).fetchall()
+            for itemid, status, result, error in rows:
+                h = chunk[itemid]
+                h.value = None if result is None else loads(result)
+                h.error = error
+                h.status = status
+        # a read transaction must not be left open
+        db.commit()
+    return sum(1 for h in handles if h.status is not None)
+
+
+def wait(handles, timeout=None):
+    """Wait for timeout seconds for all of the results, None means forever
+
+    The store is polled in bulk with a backoff from NOTIFY_BACKOFF[0] to
+    NOTIFY_BACKOFF[1] seconds. Return True if all of them are ready.
+
+    """
+
+    handles = list(handles)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = NOTIFY_BACKOFF[0]
+    while fetch(handles) < len(handles):
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+        time.sleep(delay if remaining is None else min(delay, remaining))
+        delay = min(delay * 2, NOTIFY_BACKOFF[1])
+    return True
+
+
+def save_results(db, taskid, ids, results, ttl, codec):
+    """Save the results of the items of ids, without commit
+
+    results are the values returned by workfunc, or _Error of the
+    exceptions, in the same order as ids. The items without id, e.g.
+    gotten from a broker, are skipped.
+
+    """
+
+    now = time.time()
+    rows = []
+    for itemid, r in zip(ids, results):
+        if itemid is None:
+            continue
+        if isinstance(r, _Error):
+            rows.append((itemid, taskid, RESULT_ERROR, None, r.error, now + ttl))
+            continue
+        try:
+            value = codec.dumps(r)
+        except Exception as e:
+            rows.append((itemid, taskid, RESULT_ERROR, None,
+                         'unserializable result: {!r}'.format(e), now + ttl))
+            continue
+        rows.append((itemid, taskid, RESULT_OK if r else RESULT_FAIL, value,
+                     None, now + ttl))
+    db.executemany("""INSERT OR REPLACE INTO taskresult(itemid, taskid, status,
+                       result, error, expire_at) VALUES(?, ?, ?, ?, ?, ?)""",
+                   rows)
+
+
+def expire_results(db, batch=None):
+    """Remove a batch of the expired results and commit, return the amount"""
+
+    if batch is None:
+        batch = RESULT_EXPIRE_BATCH
+    cur = db.execute("""DELETE FROM taskresult WHERE itemid IN (
+                         SELECT itemid FROM taskresult WHERE expire_at<?
+                         LIMIT ?)""", (time.time(), batch))
+    db.commit()
+    return cur.rowcount
+
+
+class _Error(object):
+    """Exception raised by workfunc, which is a failed result"""
+
+    def __init__(self, error):
+        self.error = error
+
+    def __bool__(self):
+        return False
+
+
+class _CapturedWorkfunc(object):
+    """workfunc returning _Error instead of raising, picklable for a process
+    pool"""
+
+    def __init__(self, workfunc, batch=False):
+        self.workfunc = workfunc
+        self.batch = batch
+
+    def __call__(self, item):
+        try:
+            return self.workfunc(item)
+        except Exception as e:
+            error = _Error('{}: {}'.format(type(e).__name__, e))
+            if self.batch:
+                return [error] * len(item)
+            return error
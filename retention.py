@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Tracing retention module
+
+The tasktracing and tasktracingitem tables grow with every do_task. The
+rows can be removed by age or by amount, see prune_tracing, and the
+outcome rows of append mode can be folded into the tracing column, see
+compact_tracing. Both work in batches of TRACING_PRUNE_BATCH rows, one
+transaction a batch, so they do not hold the write lock of the taskpool for
+long, and can be run by a TracingPruner thread in the background. The
+items stored by reference, see taskqueue.tracing, are removed with the
+last tracing row referencing them.
+
+The pages freed are reused by sqlite3, the file is not shrunk unless
+VACUUM is run.
+
+
+Class:
+
+TracingPruner
+
+
+Function:
+
+prune_tracing
+
+compact_tracing
+
+"""
+
+import threading
+
+from .pool import connect
+
+
+# Max amount of tracing rows removed or compacted in a transaction
+TRACING_PRUNE_BATCH = 1000
+
+# Default seconds between two runs of TracingPruner
+TRACING_PRUNE_INTERVAL = 60.0
+
+# Condition of the rows with items to drop by compact_tracing
+_DROP_ITEMS = 'OR items IS NOT NULL OR items_hash IS NOT NULL'
+
+
+def prune_tracing(db, max_age=None, max_rows=None, taskid=None, batch=None):
+    """Remove a batch of the oldest tracing rows and commit
+
+    Args:
+
+    db - taskpool database connection
+
+    max_age - (key-word), remove the rows started more than max_age seconds
+              ago
+
+    max_rows - (key-word), keep at most max_rows newest rows
+
+    taskid - (key-word), only the rows of taskid, all of rows if None
+
+    batch - (key-word), max amount of rows to remove, default
+            TRACING_PRUNE_BATCH
+
+    Return the amount of rows removed, call it again while it returns
+    batch.
+
+    """
+
+    if batch is None:
+        batch = TRACING_PRUNE_BATCH
+    where, args = _taskid_filter(taskid)
+    ids = []
+    if max_age is not None:
+        ids = [r[0] for r in db.execute(
+            """SELECT id FROM tasktracing
+               WHERE {} start_time < datetime('now', 'localtime', ?)
+               ORDER BY start_time LIMIT ?""".format(where),
+            args + ['{} seconds'.format(-max_age), batch])]
+    if max_rows is not None and len(ids) < batch:
+        r = db.execute("""SELECT start_time, id FROM tasktracing WHERE {} 1
+                          ORDER BY start_time DESC, id DESC LIMIT 1 OFFSET ?"""
+                       .format(where), args + [max_rows]).fetchone()
+        if r is not None:
+            # the newest row to remove, and the older ones
+            ids.extend(row[0] for row in db.execute(
+                """SELECT id FROM tasktracing
+                   WHERE {} (start_time < ? OR (start_time = ? AND id <= ?))
+                   ORDER BY start_time LIMIT ?""".format(where),
+                args + [r[0], r[0], r[1], batch - len(ids)])
+                if row[0] not in ids)
+    _delete(db, ids)
+    db.commit()
+    return len(ids)
+
+
+def compact_tracing(db, max_age, drop_items=False, taskid=None, batch=None):
+    """Compact a batch of the tracing rows older than max_age seconds and
+    commit
+
+    The outcome rows of append mode are folded into the tracing column and
+    removed, and ok_count and fail_count are filled for the rows traced
+    before they were added. With drop_items, the items column and the
+    reference to the items are cleared as well. Return the amount of rows
+    compacted, call it again while it returns batch.
+
+    """
+
+    if batch is None:
+        batch = TRACING_PRUNE_BATCH
+    where, args = _taskid_filter(taskid)
+    rows = db.execute("""SELECT id, tracing FROM tasktracing_view
+                         WHERE id IN (SELECT id FROM tasktracing
+                          WHERE {} start_time < datetime('now', 'localtime', ?)
+                           AND (ok_count IS NULL OR tracing IS NULL {})
+                          ORDER BY start_time LIMIT ?)""".format(
+                              where, _DROP_ITEMS if drop_items else ''),
+                      args + ['{} seconds'.format(-max_age), batch]).fetchall()
+    hashes = _items_hashes(db, [r[0] for r in rows]) if drop_items else []
+    for tracingid, tracing in rows:
+        marks = tracing.split(',') if tracing else []
+        ok = sum(1 for m in marks if m.endswith(':ok'))
+        db.execute("""UPDATE tasktracing SET tracing=?, ok_count=?, fail_count=?
+                      {} WHERE id=?""".format(
+                          ', items=NULL, items_hash=NULL' if drop_items else ''),
+                   (tracing or '', ok, len(marks) - ok, tracingid))
+        db.execute("""DELETE FROM tasktracingitem WHERE tracingid=?""",
+                   (tracingid, ))
+    _delete_items(db, hashes)
+    db.commit()
+    return len(rows)
+
+
+class TracingPruner(threading.Thread):
+    """Thread pruning and compacting the tracing rows in the background
+
+    Args:
+
+    taskpool - an sqlite3 database path to store the task information
+
+    max_age - (key-word), see prune_tracing
+
+    max_rows - (key-word), see prune_tracing
+
+    compact_age - (key-word), compact the rows older than this seconds,
+                  None means no compaction, see compact_tracing
+
+    drop_items - (key-word), see compact_tracing
+
+    interval - (key-word), seconds between two runs, default
+               TRACING_PRUNE_INTERVAL
+
+    pause - (key-word), seconds to sleep between two batches, to let the
+            other writers go
+
+    The thread has its own connection. Call stop to stop it.
+
+    """
+
+    def __init__(self, taskpool, max_age=None, max_rows=None, compact_age=None,
+                 drop_items=False, interval=None, pause=0.01):
+        super().__init__(daemon=True)
+        self.taskpool = taskpool
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.compact_age = compact_age
+        self.drop_items = drop_items
+        self.interval = TRACING_PRUNE_INTERVAL if interval is None else interval
+        self.pause = pause
+        self.pruned = 0
+        self.compacted = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        db = connect(self.taskpool, pooled=False)
+        try:
+            while True:
+                self.run_once(db)
+                if self._stop_event.wait(self.interval):
+                    break
+        finally:
+            db.close()
+
+    def run_once(self, db):
+        """Prune and compact in batches until done or stopped"""
+
+        if self.max_age is not None or self.max_rows is not None:
+            while not self._stop_event.is_set():
+                n = prune_tracing(db, self.max_age, self.max_rows)
+                self.pruned += n
+                if n < TRACING_PRUNE_BATCH:
+                    break
+                self._stop_event.wait(self.pause)
+        if self.compact_age is not None:
+            while not self._stop_event.is_set():
+                n = compact_tracing(db, self.compact_age, self.drop_items)
+                self.compacted += n
+                if n < TRACING_PRUNE_BATCH:
+                    break
+                self._stop_event.wait(self.pause)
+
+    def stop(self):
+        self._stop_event.set()
+        if self is not threading.current_thread():
+            self.join()
+
+
+def _taskid_filter(taskid):
+    if taskid is None:
+        return '', []
+    return 'taskid=? AND', [taskid]
+
+
+def _delete(db, ids):
+    """Remove the tracing rows of ids, their outcome rows and the items
+    referenced by them only"""
+
+    hashes = _items_hashes(db, ids)
+    db.executemany("""DELETE FROM tasktracingitem WHERE tracingid=?""",
+                   ((i, ) for i in ids))
+    db.executemany("""DELETE FROM tasktracing WHERE id=?""",
+                   ((i, ) for i in ids))
+    _delete_items(db, hashes)
+
+
+def _items_hashes(db, ids):
+    """Return the hashes of the items referenced by the tracing rows of ids"""
+
+    hashes = set()
+    for i in ids:
+        r = db.execute("""SELECT items_hash FROM tasktracing WHERE id=?""",
+                       (i, )).fetchone()
+        if r is not None and r[0] is not None:
+            hashes.add(r[0])
+    return hashes
+
+
+def _delete_items(db, hashes):
+    """Remove the items of hashes not referenced by any tracing row, which
+    is checked by the tasktracing_items_hash index"""
+
+    db.executemany("""DELETE FROM tasktracingitems WHERE hash=? AND
+                       NOT EXISTS (SELECT 1 FROM tasktracing
+                                   WHERE items_hash=?)""",
+                   ((h, h) for h in hashes))
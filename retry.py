@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Retry module
+
+The items done fail are put back into the queue with a delay growing by the
+attempts, until max_attempts is reached, then they are moved to the dead
+letter taskid, or dropped if no dead letter taskid.
+
+The retry policy of a task is stored in the columns max_attempts,
+retry_delay, retry_backoff, retry_max_delay and dead_taskid of taskqueue
+table. max_attempts NULL means no retry.
+
+
+Class:
+
+RetryPolicy
+
+
+Function:
+
+retry
+
+"""
+
+import json
+import time
+from .codec import get_codec
+
+
+class RetryPolicy(object):
+    """Retry policy of a task
+
+    Args:
+
+    max_attempts - max times an item is done, None means no retry
+
+    delay - seconds before the first retry
+
+    backoff - the delay is multiplied by backoff for each more attempt
+
+    max_delay - max seconds of the delay, None means no limit
+
+    dead_taskid - taskid to move the items to after max_attempts, None
+                  means to drop them
+
+    """
+
+    def __init__(self, max_attempts=None, delay=0, backoff=2.0, max_delay=None,
+                 dead_taskid=None):
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.dead_taskid = dead_taskid
+
+    @classmethod
+    def from_taskinfo(cls, taskinfo):
+        """Construct from the taskinfo row, return None if no retry"""
+
+        if taskinfo['max_attempts'] is None:
+            return None
+        return cls(taskinfo['max_attempts'], taskinfo['retry_delay'] or 0,
+                   taskinfo['retry_backoff'] or 1.0,
+                   taskinfo['retry_max_delay'], taskinfo['dead_taskid'])
+
+    def next_delay(self, attempts):
+        """Seconds to delay an item which has been done attempts times"""
+
+        delay = self.delay * self.backoff ** max(attempts - 1, 0)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
+    def exhausted(self, attempts):
+        """Check if an item done attempts times should not retry any more"""
+
+        return self.max_attempts is not None and attempts >= self.max_attempts
+
+
+def retry(db, taskid, items, indexes, policy, now=None, codec=None):
+    """Retry the failed items at indexes by policy, without commit
+
+    Args:
+
+    db - taskpool database connection
+
+    taskid - taskid the items gotten from
+
+    items - taskqueue.lease.LeasedItems gotten from the queue
+
+    indexes - indexes of the failed items
+
+    policy - RetryPolicy object
+
+    now - (key-word), current unix time
+
+    codec - (key-word), taskqueue.codec.Codec object of the queue, to put 
+            the removed items again, default json
+
+    Leased items are updated in place, items already removed from the queue
+    are put again with their id and dedup key. The dead items are put into
+    the dead letter taskid by its codec, see _put_dead. Return (amount of
+    items to retry, amount of dead items).
+
+    """
+
+    if now is None:
+        now = time.time()
+    dumps = json.dumps if codec is None else codec.dumps
+    later, dead = [], []
+    for i in indexes:
+        attempts = items.attempts[i]
+        if policy.exhausted(attempts):
+            dead.append(i)
+        else:
+            later.append((i, now + policy.next_delay(attempts)))
+
+    if items.leaseid is not None:
+        db.executemany("""UPDATE taskitem SET visible_at=?, leaseid=NULL
+                          WHERE id=? AND leaseid=?""",
+                       ((visible_at, items.ids[i], items.leaseid)
+                        for i, visible_at in later))
+        # the dead items are removed, and put into the dead letter taskid
+        # below, only those still leased
+        removed = []
+        for i in dead:
+            cur = db.execute("""DELETE FROM taskitem WHERE id=? AND leaseid=?""",
+                             (items.ids[i], items.leaseid))
+            if cur.rowcount == 1:
+                removed.append(i)
+        dead = removed
+    else:
+        # the items of a partition are put back into it, with their dedup
+        # key, so a duplicate put is dropped while they wait, and with their
+        # id if still free, so the result of every attempt replaces the one
+        # of the handle, see taskqueue.results
+        db.executemany("""INSERT OR IGNORE INTO taskitem(id, taskid, item,
+                           visible_at, attempts, priority, aged_at,
+                           dedup_key, partition_id)
+                          VALUES((SELECT CASE WHEN EXISTS(SELECT 1 FROM
+                                  taskitem WHERE id=?1) THEN NULL ELSE ?1 END),
+                                 ?, ?, ?, ?, ?, ?, ?, ?)""",
+                       ((_item_id(items, i), taskid, dumps(items[i]),
+                         visible_at, items.attempts[i], _priority(items, i),
+                         now, _dedup_key(items, i), items.item_partition(i))
+                        for i, visible_at in later))
+    if policy.dead_taskid is not None and dead:
+        _put_dead(db, policy.dead_taskid, items, dead, now)
+    return len(later), len(dead)
+
+
+def _put_dead(db, dead_taskid, items, indexes, now):
+    """Put the items at indexes into the dead letter taskid, without commit
+
+    They are serialized by the codec of dead_taskid. If it dedups, the
+    dedup key of an item is kept, or the hash of the serialized item, see
+    taskqueue.queue.TaskQueue.put, and the duplicates are dropped.
+
+    """
+
+    from .queue import _dedup_key as _hash_key
+
+    r = db.execute("""SELECT codec, dedup FROM taskqueue WHERE taskid=?""",
+                   (dead_taskid, )).fetchone()
+    dumps = get_codec(None if r is None else r[0]).dumps
+    dedup = r is not None and bool(r[1])
+    rows = []
+    for i in indexes:
+        value = dumps(items[i])
+        key = None
+        if dedup:
+            key = _dedup_key(items, i)
+            if key is None:
+                key = _hash_key(value)
+        rows.append((dead_taskid, value, items.attempts[i], _priority(items, i),
+                     now, key))
+    db.executemany("""INSERT OR IGNORE INTO taskitem(taskid, item, attempts,
+                       priority, aged_at, dedup_key) VALUES(?, ?, ?, ?, ?, ?)""",
+                   rows)
+
+
+def _dedup_key(items, i):
+    if getattr(items, 'dedup_keys', None) is None:
+        return None
+    return items.dedup_keys[i]
+
+
+def _item_id(items, i):
+    if items.ids is None:
+        return None
+    return items.ids[i]
+
+
+def _priority(items, i):
+    if items.priorities is None:
+        return 0
+    return items.priorities[i]
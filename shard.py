@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Shard module
+
+SQLite allows one writer a database file at a time, so all of the
+producers and consumers of a taskpool are serialized by its write lock. A
+ShardedTaskQueue spreads a logical queue over K taskpool files, the shards,
+each holding a taskqueue row of the same taskid, so K writers can work at
+the same time.
+
+Items are put into a shard by sharding:
+
+'hash' - by the crc32 of the shard key of the item, the same key always
+         goes to the same shard
+
+'round_robin' - every put goes to the next shard, a put of many items is
+                spread over the shards
+
+A consumer has a home shard, default its pid modulo K. A get takes items
+from the home shard, and steals from the other shards in turn when the home
+shard has no ready items, so no shard is left undone while a consumer is
+idle.
+
+Ordering: the items of a shard are gotten by priority then in the order
+they are put, as in a TaskQueue. There is no order between the shards, so
+items of different shards may be gotten in any order. With 'hash', the items
+of the same key are in one shard, so they keep their order. Dedup is also
+done per shard, which is the whole queue only with 'hash' sharding by the
+dedup key.
+
+Create the shards with helper.setup_sharded_taskpool and the task with
+helper.add_sharded_task.
+
+
+Class:
+
+ShardedTaskQueue
+
+"""
+
+import itertools
+import os
+import select
+import time
+import zlib
+
+from .queue import TaskQueue
+from .notify import Waiter, NOTIFY_BACKOFF
+
+
+class ShardedTaskQueue(object):
+    """A queue over many taskpool files
+
+    Args:
+
+    taskpools - list of the sqlite3 database paths of the shards, in the
+                same order for every producer and consumer
+
+    taskid - taskid in taskqueue table of every shard
+
+    sharding - (key-word), 'hash' or 'round_robin', see the module document
+
+    shard_key - (key-word), function returning the shard key of an item, as
+                str, bytes or int, default the serialized item
+
+    home - (key-word), index of the home shard of the consumer, default the
+           pid modulo the amount of shards
+
+    Other key-word arguments are passed to TaskQueue of every shard.
+
+
+    Method:
+
+    def shard_of(self, item)
+        Return the index of the shard of item by hash sharding
+
+    def get(self, num=None, block=False, timeout=None)
+        Get items of the home shard, or steal from the other shards
+
+    def consume(self, num=100, timeout=None)
+        Iterate over the items of all of the shards
+
+    def put(self, items, **kwargs)
+        Put items into the shards
+
+    def ack(self, items, indexes=None)
+    def nack(self, items, indexes=None, delay=0)
+    def retry(self, items, indexes=None)
+    def requeue(self, items, indexes=None)
+        Same as TaskQueue, done in the shard the items are gotten from
+
+    def empty(self)
+        Check if no ready items in any shard
+
+    def tasktracing(self, items, **kwargs)
+        TaskTracing of the items in their shard
+
+    def tasklock(self, ttl=None)
+        The tasklock of the logical queue, stored in the first shard
+
+    """
+
+    def __init__(self, taskpools, taskid, sharding='hash', shard_key=None,
+                 home=None, **kwargs):
+        if not taskpools:
+            raise ValueError("no shards")
+        if sharding not in ('hash', 'round_robin'):
+            raise ValueError("invalid sharding: {}".format(sharding))
+        self.taskpools = list(taskpools)
+        self.shards = [TaskQueue(p, taskid, **kwargs) for p in self.taskpools]
+        self.taskid = self.shards[0].taskid
+        self.sharding = sharding
+        self.shard_key = shard_key
+        self.home = (os.getpid() if home is None else home) % len(self.shards)
+        # producers of a process start at different shards
+        self._next = itertools.count(os.getpid())
+        self._waiters = None
+
+    def shard_of(self, item):
+        """Return the index of the shard of item by its shard key"""
+
+        if self.shard_key is None:
+            key = self.shards[0].codec.dumps(item)
+        else:
+            key = self.shard_key(item)
+        if isinstance(key, int):
+            key = str(key)
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return zlib.crc32(key) % len(self.shards)
+
+    def get(self, num=None, block=False, timeout=None):
+        """Get num of items from the home shard, or steal them from the
+        other shards in turn if the home shard is empty
+
+        The items are of one shard, a taskqueue.lease.LeasedItems list with
+        the index of the shard in its shard attribute. See TaskQueue.get for
+        the arguments.
+
+        """
+
+        if not block:
+            return self._get_nowait(num)
+        if self._waiters is None:
+            # listen before checking, so no put is missed in between
+            self._waiters = [Waiter(p, self.taskid) for p in self.taskpools]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = NOTIFY_BACKOFF[0]
+        while True:
+            items = self._get_nowait(num)
+            if items:
+                return items
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+            socks = [w.sock for w in self._waiters if w.sock is not None]
+            if len(socks) == len(self._waiters):
+                wait = NOTIFY_BACKOFF[1]
+            else:
+                # a shard without socket is polled
+                wait = delay
+                delay = min(delay * 2, NOTIFY_BACKOFF[1])
+            if remaining is not None:
+                wait = min(wait, remaining)
+            if not socks:
+                time.sleep(max(wait, 0))
+                continue
+            r, _, _ = select.select(socks, [], [], max(wait, 0))
+            for waiter in self._waiters:
+                if waiter.sock in r:
+                    waiter.drain()
+
+    def consume(self, num=100, timeout=None):
+        """Iterate over the items of all of the shards, see TaskQueue.consume"""
+
+        while True:
+            items = self.get(num, block=True, timeout=timeout)
+            if not items:
+                return
+            for item in items:
+                yield item
+
+    def _get_nowait(self, num=None):
+        n = len(self.shards)
+        for i in range(n):
+            shard = (self.home + i) % n
+            items = self.shards[shard].get(num)
+            if items:
+                items.shard = shard
+                return items
+        return []
+
+    def put(self, items, **kwargs):
+        """Put items into the shards, see TaskQueue.put for the key-word
+        arguments
+
+        With 'hash', the items are grouped by their shards and every group is
+        put in one transaction of its shard, with 'round_robin' all of the
+        items are put into the next shard. Return the amount of items
+        dropped by dedup, or with result=True the list of ResultHandle of
+        the items in their order, None for the items dropped.
+
+        """
+
+        if self.sharding == 'round_robin':
+            shard = next(self._next) % len(self.shards)
+            return self.shards[shard].put(items, **kwargs)
+        groups = {}
+        for i, item in enumerate(items):
+            groups.setdefault(self.shard_of(item), []).append((i, item))
+        if kwargs.get('result'):
+            handles = [None] * sum(len(group) for group in groups.values())
+            for shard, group in sorted(groups.items()):
+                r = self.shards[shard].put([item for i, item in group], 
+                                           **kwargs)
+                for (i, item), handle in zip(group, r):
+                    handles[i] = handle
+            return handles
+        dropped = 0
+        for shard, group in sorted(groups.items()):
+            dropped += self.shards[shard].put([item for i, item in group], 
+                                              **kwargs)
+        return dropped
+
+    def ack(self, items, indexes=None):
+        return self.shards[items.shard].ack(items, indexes)
+
+    def nack(self, items, indexes=None, delay=0):
+        return self.shards[items.shard].nack(items, indexes, delay)
+
+    def retry(self, items, indexes=None):
+        return self.shards[items.shard].retry(items, indexes)
+
+    def requeue(self, items, indexes=None):
+        return self.shards[items.shard].requeue(items, indexes)
+
+    def empty(self):
+        """Check if no ready items in any shard"""
+
+        return all(q.empty() for q in self.shards)
+
+    def tasktracing(self, items, **kwargs):
+        """Return TaskTracing of items, stored in the shard of items"""
+
+        return self.shards[items.shard].tasktracing(items, **kwargs)
+
+    def tasklock(self, ttl=None):
+        """Return the tasklock of the logical queue
+
+        The lock row of the first shard is the lock of the queue, so the
+        workers of the queue exclude each other as with a TaskQueue.
+
+        """
+
+        return self.shards[0].tasklock(ttl)
+
+    def close(self):
+        """Close the waiters"""
+
+        for waiter in self._waiters or ():
+            waiter.close()
+        self._waiters = None
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Supervisor module
+
+A Supervisor preforks worker processes doing the items of one or more
+taskids, see taskqueue.worker.MultiQueueWorker, and keeps them running:
+
+- a worker exiting or crashing is replaced by a new one
+
+- a worker is recycled after doing max_items items, or when its memory is
+  over max_memory bytes
+
+- the amount of workers is scaled between workers and max_workers by the
+  amount of ready items, scale_items items a worker
+
+- on shutdown, e.g. SIGTERM, every worker is stopped gracefully: the item
+  being done is finished, the items not done are put back into the queue
+  and the tasklock is released. Workers not stopped in grace seconds are
+  killed, their leased items go back to the queue by visibility timeout.
+
+The workfunc is imported in the supervisor before forking, so the workers
+start warm. See the taskqueue-worker script for the command line.
+
+
+Class:
+
+Supervisor
+
+
+Function:
+
+load_workfunc
+
+"""
+
+import errno
+import importlib
+import math
+import os
+import signal
+import sys
+import threading
+import time
+
+from .worker import MultiQueueWorker
+from .pool import connect
+
+
+# Seconds between the checks of the workers and the backlog
+SUPERVISOR_INTERVAL = 1.0
+
+# Default seconds for the workers to stop gracefully before killed
+SUPERVISOR_GRACE = 30.0
+
+# Default amount of ready items a worker when scaling
+SUPERVISOR_SCALE_ITEMS = 1000
+
+# Min seconds between starts of a worker slot, to avoid busy restarting
+# workers crashing at once
+SUPERVISOR_RESTART_DELAY = 1.0
+
+
+class Supervisor(object):
+    """Prefork supervisor of worker processes
+
+    Args:
+
+    taskpool - an sqlite3 database path to store the task information
+
+    taskids - list of taskids to do, None means all of taskids
+
+    workfunc - a callback function to finish the task, see do_task
+
+    workers - (key-word), min amount of workers
+
+    max_workers - (key-word), max amount of workers, default workers, which
+                  means no scaling
+
+    scale_items - (key-word), amount of ready items a worker when scaling,
+                  default SUPERVISOR_SCALE_ITEMS
+
+    max_items - (key-word), recycle a worker after this amount of items,
+                None means never
+
+    max_memory - (key-word), recycle a worker if its resident memory is
+                 larger than this bytes, None means never
+
+    grace - (key-word), seconds for the workers to stop gracefully,
+            default SUPERVISOR_GRACE
+
+    Other key-word arguments are passed to MultiQueueWorker.
+
+
+    Method:
+
+    def run(self)
+        Start the workers and supervise them until shutdown
+
+    def shutdown(self)
+        Stop the workers, it can be called by a signal handler
+
+    def backlog(self)
+        Return the amount of ready items of the taskids
+
+    """
+
+    def __init__(self, taskpool, taskids, workfunc, workers=1,
+                 max_workers=None, scale_items=None, max_items=None,
+                 max_memory=None, grace=None, **kwargs):
+        if workers < 1:
+            raise ValueError("workers must be larger than 0")
+        self.taskpool = taskpool
+        self.taskids = None if taskids is None else list(taskids)
+        self.workfunc = workfunc
+        self.min_workers = workers
+        self.max_workers = workers if max_workers is None else max(max_workers,
+                                                                   workers)
+        self.scale_items = (SUPERVISOR_SCALE_ITEMS if scale_items is None
+                            else scale_items)
+        self.max_items = max_items
+        self.max_memory = max_memory
+        self.grace = SUPERVISOR_GRACE if grace is None else grace
+        self.kwargs = kwargs
+        self.workers = {}
+        self._stopping = set()
+        self._last_start = 0
+        self._running = False
+
+    def run(self):
+        """Start the workers and supervise them until shutdown is called"""
+
+        self._running = True
+        try:
+            while self._running:
+                self._reap()
+                desired = self.desired_workers()
+                active = [pid for pid in self.workers if pid not in self._stopping]
+                if len(active) < desired:
+                    if time.monotonic() - self._last_start >= SUPERVISOR_RESTART_DELAY \
+                            or not self.workers:
+                        for i in range(desired - len(active)):
+                            self._spawn()
+                elif len(active) > desired:
+                    # scale down, one at a time
+                    self._stop(active[-1])
+                time.sleep(SUPERVISOR_INTERVAL / 10 if self._stopping
+                           else SUPERVISOR_INTERVAL)
+        finally:
+            self._stop_all()
+
+    def shutdown(self):
+        """Stop serving, the workers are stopped by run"""
+
+        self._running = False
+
+    def backlog(self):
+        """Return the amount of ready items of the taskids"""
+
+        db = connect(self.taskpool)
+        now = time.time()
+        if self.taskids is None:
+            r = db.execute("""SELECT count(*) FROM taskitem
+                              WHERE visible_at<=?""", (now, )).fetchone()
+        else:
+            r = db.execute("""SELECT count(*) FROM taskitem
+                              WHERE taskid IN ({}) AND visible_at<=?""".format(
+                                  ','.join('?' * len(self.taskids))),
+                           list(self.taskids) + [now]).fetchone()
+        db.commit()
+        return r[0]
+
+    def desired_workers(self):
+        """Amount of workers for the backlog"""
+
+        if self.max_workers == self.min_workers:
+            return self.min_workers
+        n = int(math.ceil(self.backlog() / float(self.scale_items)))
+        return min(max(n, self.min_workers), self.max_workers)
+
+    def _spawn(self):
+        self._last_start = time.monotonic()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return pid
+        code = 1
+        try:
+            code = self._work()
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def _work(self):
+        """Run in the worker process, return the exit code"""
+
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        # ctrl-c is sent to the process group, the supervisor stops us
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        done = 0
+        with MultiQueueWorker(self.taskpool, self.workfunc,
+                              taskids=self.taskids, stop=stop,
+                              **self.kwargs) as worker:
+            while not stop.is_set():
+                n = worker.run_once()
+                done += n
+                if self.max_items is not None and done >= self.max_items:
+                    break
+                if self.max_memory is not None and _rss() > self.max_memory:
+                    break
+                if not n:
+                    worker._wait(SUPERVISOR_INTERVAL)
+        return 0
+
+    def _stop(self, pid):
+        """Ask a worker to stop gracefully"""
+
+        if pid in self._stopping:
+            return
+        self._stopping.add(pid)
+        self.workers[pid] = time.monotonic()
+        _kill(pid, signal.SIGTERM)
+
+    def _reap(self):
+        """Remove the exited workers, kill those stopping over grace"""
+
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                self.workers.clear()
+                self._stopping.clear()
+                break
+            if not pid:
+                break
+            self.workers.pop(pid, None)
+            self._stopping.discard(pid)
+        now = time.monotonic()
+        for pid in list(self._stopping):
+            if now - self.workers.get(pid, now) > self.grace:
+                _kill(pid, signal.SIGKILL)
+
+    def _stop_all(self):
+        """Stop all of the workers and wait for them"""
+
+        for pid in list(self.workers):
+            self._stop(pid)
+        while self.workers:
+            self._reap()
+            time.sleep(SUPERVISOR_INTERVAL / 10)
+
+
+def load_workfunc(path):
+    """Import 'module:func' and return the function
+
+    func may be a dotted name of an attribute of the module.
+
+    """
+
+    module, sep, name = path.partition(':')
+    if not sep or not module or not name:
+        raise ValueError("workfunc must be 'module:func': {}".format(path))
+    obj = importlib.import_module(module)
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def _kill(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except OSError:
+        pass
+
+
+def _rss():
+    """Resident memory of the current process in bytes"""
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # peak resident memory, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -3,16 +3,33 @@
 Task lock
 
 This module implement a primitive lock for some tasks which need to separate
-other processes to avoid getting items from the queue to do the jobs which 
+other processes to avoid getting items from the queue to do the jobs which
 need to avoid colliding, e.g. update some row in the database table.
 
+A lock may be taken as a lease with ttl seconds. The lease carries the owner
+identity and expires unless the owner renews it, so that the lock of a
+crashed worker can be taken over by another one. Each acquiring increases
+the token of the lock, which can be used as a fencing token by the resources
+protected by the lock.
+
 """
 
+import os
+import socket
 import sqlite3
+import threading
+import time
+import uuid
+from .pool import connect
+
+
+# Default ttl seconds of the lease, None means the lock never expires
+TASK_LOCK_TTL = None
+
 
 class TaskLock(object):
     """Lock object for doing task
-    
+
     Args:
 
     lockdb - taskpool database connection
@@ -21,6 +38,12 @@ class TaskLock(object):
 
     lockid - lockid in tasklock table
 
+    ttl - (key-word), seconds of the lease, default TASK_LOCK_TTL
+
+    owner - (key-word), identity of the owner, default host:pid:uuid
+
+    check - (key-word), if True, raise KeyError if no such lock
+
 
     Method:
 
@@ -30,71 +53,217 @@ class TaskLock(object):
     def release(self)
         Release the lock
 
+    def renew(self)
+        Extend the lease by ttl seconds
+
+    def start_heartbeat(self, interval=None)
+        Renew the lease in a background thread until released
+
+    It also can be used in with statement, TaskLockBusy is raised if it
+    cannot be acquired.
+
     """
 
-    def __init__(self, lockdb, taskid, lockid):
+    def __init__(self, lockdb, taskid, lockid, ttl=None, owner=None,
+                 check=True):
         self.db = lockdb
         self.taskid = taskid
         self.lockid = lockid
-        if get_tasklockinfo(self.db, lockid) is None:
+        if check and get_tasklockinfo(self.db, lockid) is None:
             raise KeyError("no such lock: {}".format(lockid))
+        self.ttl = TASK_LOCK_TTL if ttl is None else ttl
+        if owner is None:
+            owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                      uuid.uuid4().hex)
+        self.owner = owner
+        self.token = None
         self.locked_by_self = None
+        self._heartbeat = None
 
     def acquire(self):
         """Acquire a lock
-        
+
+        The lock is free if it is not locked or its lease is expired.
         If success return True, else False.
 
         """
 
-        if self.locked():
-            self.locked_by_self = False
-            return False
-        else:
-            self.lock()
+        if self.lock():
             self.locked_by_self = True
             return True
+        self.locked_by_self = False
+        return False
 
     def release(self):
         """Release the lock
 
-        If this lock is not owned by your this process or not locked, 
+        If this lock is not owned by your this process or not locked,
         raise RuntimeError.
 
         """
 
         if not self.locked_by_self:
             raise RuntimeError("can not release the lock which is not owned by this process")
-        if not self.locked():
-            raise RuntimeError("can not release the lock which is not locked")
-        self.db.execute("""UPDATE tasklock SET locked=?, 
-                            update_time=datetime('now', 'localtime') 
-                           WHERE lockid=?""", (0, self.lockid))
+        self.stop_heartbeat()
+        self.locked_by_self = False
+        cur = self.db.execute("""UPDATE tasklock SET locked=?, owner=NULL,
+                                  expire_time=NULL,
+                                  update_time=datetime('now', 'localtime')
+                                 WHERE lockid=? AND locked=1 AND owner=? AND
+                                  token=?""",
+                              (0, self.lockid, self.owner, self.token))
         self.db.commit()
+        if cur.rowcount != 1:
+            raise RuntimeError("can not release the lock which is not locked")
+
+    def renew(self):
+        """Extend the lease by ttl seconds from now
+
+        Return False if the lease is lost, e.g. expired and taken over by
+        another owner, else True.
+
+        """
+
+        if not self.locked_by_self:
+            return False
+        if _renew(self.db, self.lockid, self.owner, self.token, self.ttl):
+            return True
+        self.locked_by_self = False
+        return False
+
+    def start_heartbeat(self, interval=None):
+        """Renew the lease every interval seconds in a background thread
+
+        interval is default one third of ttl. The thread stops when the
+        lock is released or the lease is lost.
+
+        """
+
+        if self.ttl is None:
+            raise ValueError("heartbeat needs a lock with ttl")
+        if interval is None:
+            interval = self.ttl / 3
+        self.stop_heartbeat()
+        taskpool = self.db.execute("""PRAGMA database_list""").fetchone()[2]
+        self._heartbeat = _Heartbeat(taskpool, self.lockid, self.owner,
+                                     self.token, self.ttl, interval)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        """Stop the heartbeat thread if started"""
+
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
 
     def locked(self):
-        """check if locked"""
+        """check if locked, an expired lease is not locked"""
 
-        locked = get_tasklockinfo(self.db, self.lockid)['locked']
-        assert locked in (0, 1), "invalid locked type: {}".format(locked)
-        return bool(locked)
+        locked, expire_time = self.db.execute("""SELECT locked, expire_time
+                                                 FROM tasklock WHERE lockid=?""",
+                                              (self.lockid, )).fetchone()
+        assert locked in (0, 1, None), "invalid locked type: {}".format(locked)
+        if not locked:
+            return False
+        return expire_time is None or expire_time >= time.time()
 
     def lock(self):
-        """make a lock"""
+        """make a lock
+
+        Return True if locked by this call, else False.
 
-        self.db.execute("""UPDATE tasklock SET locked=?, current_taskid=?, 
-                            update_time=datetime('now', 'localtime') 
-                           WHERE lockid=?""", (1, self.taskid, self.lockid))
+        """
+
+        now = time.time()
+        expire_time = None if self.ttl is None else now + self.ttl
+        cur = self.db.execute("""UPDATE tasklock SET locked=?, current_taskid=?,
+                                  owner=?, expire_time=?, token=token+1,
+                                  update_time=datetime('now', 'localtime')
+                                 WHERE lockid=? AND (locked=0 OR locked IS NULL
+                                  OR expire_time < ?)""",
+                              (1, self.taskid, self.owner, expire_time,
+                               self.lockid, now))
+        if cur.rowcount != 1:
+            self.db.commit()
+            return False
+        self.token = self.db.execute("""SELECT token FROM tasklock
+                                        WHERE lockid=?""",
+                                     (self.lockid, )).fetchone()[0]
         self.db.commit()
+        return True
+
+    def __enter__(self):
+        if not self.acquire():
+            raise TaskLockBusy("lock {} is locked".format(self.lockid))
+        if self.ttl is not None:
+            self.start_heartbeat()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.locked_by_self:
+            self.release()
+        return False
+
+
+class TaskLockBusy(RuntimeError):
+    """Raise when entering a with statement of a TaskLock locked by other"""
+
+    pass
+
+
+class _Heartbeat(threading.Thread):
+    """Thread renewing a lease with its own database connection"""
+
+    def __init__(self, taskpool, lockid, owner, token, ttl, interval):
+        super().__init__(daemon=True)
+        self.taskpool = taskpool
+        self.lockid = lockid
+        self.owner = owner
+        self.token = token
+        self.ttl = ttl
+        self.interval = interval
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        db = connect(self.taskpool, pooled=False)
+        try:
+            while not self._stop_event.wait(self.interval):
+                if not self.renew(db):
+                    self.lost = True
+                    break
+        finally:
+            db.close()
+
+    def renew(self, db):
+        """Extend the lease, return True if done"""
+
+        return _renew(db, self.lockid, self.owner, self.token, self.ttl)
+
+    def stop(self):
+        self._stop_event.set()
+        if self is not threading.current_thread():
+            self.join()
+
+
+def _renew(db, lockid, owner, token, ttl):
+    """Extend a lease owned by owner with token, return True if done"""
+
+    expire_time = None if ttl is None else time.time() + ttl
+    cur = db.execute("""UPDATE tasklock SET expire_time=?,
+                         update_time=datetime('now', 'localtime')
+                        WHERE lockid=? AND locked=1 AND owner=? AND token=?""",
+                     (expire_time, lockid, owner, token))
+    db.commit()
+    return cur.rowcount == 1
 
 
 def get_tasklockinfo(db, lockid):
     """Get task lock information"""
 
-    ori_row_factory = db.row_factory
-    db.row_factory = sqlite3.Row
-    r = db.execute("""SELECT lockid, locked, current_taskid, desc, update_time 
-                      FROM tasklock WHERE lockid = ? LIMIT 1""", 
-                   (lockid, )).fetchone()
-    db.row_factory = ori_row_factory
-    return r
+    cur = db.cursor()
+    cur.row_factory = sqlite3.Row
+    return cur.execute("""SELECT lockid, locked, current_taskid, desc,
+                            update_time, owner, expire_time, token
+                          FROM tasklock WHERE lockid = ? LIMIT 1""",
+                       (lockid, )).fetchone()
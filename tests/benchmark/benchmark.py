@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark for taskqueue
+
+It measures across queue sizes and process counts:
+
+put - TaskQueue.put of one item, ops/sec and p50/p99 latency
+
+get - TaskQueue.get of one item, ops/sec and p50/p99 latency
+
+queuelock - _QueueLock acquire and release under contention
+
+tracing - TaskTracing cost per item, for column and append modes
+
+do_task - end-to-end do_task throughput, items/sec
+
+codec - encode and decode cost per item of each codec, and the stored size
+
+The results are written as json, which can be compared with the results of
+another commit by --compare, e.g.
+
+    python3 benchmark.py -o new.json --compare old.json
+
+The exit code is 1 if any result regresses more than --threshold.
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname
+sys.path.append(dirname(dirname(dirname(dirname(abspath(__file__))))))
+
+from taskqueue import TaskQueue, do_task
+from taskqueue.helper import setup_taskqueue_tables
+from taskqueue.codec import get_codec
+
+
+def new_taskpool(size):
+    """Create a taskpool with a task of size items, return (path, taskid)"""
+
+    fd, taskpool = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(fd)
+    os.unlink(taskpool)
+    setup_taskqueue_tables(taskpool)
+    db = sqlite3.connect(taskpool)
+    cur = db.execute("""INSERT INTO tasklock(locked, desc) 
+                        VALUES(0, 'benchmark')""")
+    lockid = cur.lastrowid
+    cur = db.execute("""INSERT INTO taskqueue(lockid, qlocked, desc) 
+                        VALUES(?, 0, 'benchmark')""", (lockid, ))
+    taskid = cur.lastrowid
+    db.executemany("""INSERT INTO taskitem(taskid, item) VALUES(?, ?)""", 
+                   ((taskid, json.dumps('item-{}'.format(i))) 
+                    for i in range(size)))
+    db.commit()
+    db.close()
+    return taskpool, taskid
+
+
+def remove_taskpool(taskpool):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        try:
+            os.unlink(taskpool + suffix)
+        except OSError:
+            pass
+
+
+def percentile(latencies, p):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    k = min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))
+    return latencies[k]
+
+
+def summary(name, size, procs, count, elapsed, latencies=None, **extra):
+    r = {'bench': name, 'size': size, 'procs': procs, 'count': count, 
+         'elapsed': elapsed, 
+         'ops_per_sec': count / elapsed if elapsed > 0 else None}
+    if latencies is not None:
+        r['p50_ms'] = percentile(latencies, 50) * 1000
+        r['p99_ms'] = percentile(latencies, 99) * 1000
+    r.update(extra)
+    return r
+
+
+def _run_ops(op, taskpool, taskid, ops, results):
+    q = TaskQueue(taskpool, taskid, lock_timeout=600)
+    latencies = []
+    if op == 'put':
+        func = lambda i: q.put(['bench-{}-{}'.format(os.getpid(), i)])
+    elif op == 'get':
+        func = lambda i: q.get(1)
+    else:
+        def func(i):
+            q._queuelock.acquire()
+            q._queuelock.release()
+    start = time.perf_counter()
+    for i in range(ops):
+        t = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - t)
+    results.put((time.perf_counter() - start, latencies))
+
+
+def bench_ops(op, size, procs, ops):
+    """Run ops of op in each of procs processes against a queue of size"""
+
+    # get needs enough items for every process
+    taskpool, taskid = new_taskpool(max(size, procs * ops) if op == 'get' 
+                                    else size)
+    try:
+        results = multiprocessing.Queue()
+        ps = [multiprocessing.Process(target=_run_ops, 
+                                      args=(op, taskpool, taskid, ops, results)) 
+              for i in range(procs)]
+        start = time.perf_counter()
+        for p in ps:
+            p.start()
+        latencies = []
+        for p in ps:
+            latencies.extend(results.get()[1])
+        for p in ps:
+            p.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        remove_taskpool(taskpool)
+    return summary(op, size, procs, procs * ops, elapsed, latencies)
+
+
+def bench_tracing(size, mode):
+    """Trace size items in mode, return the cost per item"""
+
+    taskpool, taskid = new_taskpool(size)
+    try:
+        q = TaskQueue(taskpool, taskid)
+        items = q.get()
+        start = time.perf_counter()
+        with q.tasktracing(items, mode=mode) as tracing:
+            for i in range(len(items)):
+                tracing.ok(i)
+        elapsed = time.perf_counter() - start
+    finally:
+        remove_taskpool(taskpool)
+    return summary('tracing', size, 1, size, elapsed, mode=mode, 
+                   us_per_item=elapsed / size * 1e6)
+
+
+def bench_codec(size, name):
+    """Encode and decode size items by codec name, return the cost per item"""
+
+    codec = get_codec(name)
+    if name == 'raw':
+        item = os.urandom(256)
+    else:
+        item = {'id': 12345, 'name': 'item', 'tags': ['a', 'b', 'c'], 
+                'values': list(range(32))}
+    start = time.perf_counter()
+    encoded = [codec.dumps(item) for i in range(size)]
+    encode_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    for s in encoded:
+        codec.loads(s)
+    decode_elapsed = time.perf_counter() - start
+    return summary('codec', size, 1, size, encode_elapsed + decode_elapsed, 
+                   mode=name, encode_us=encode_elapsed / size * 1e6, 
+                   decode_us=decode_elapsed / size * 1e6, 
+                   bytes_per_item=len(encoded[0]))
+
+
+def _noop(item):
+    return True
+
+
+def _run_do_task(taskpool, taskid, num, results):
+    done = 0
+    while True:
+        # tasklock would serialize the processes
+        r = do_task(taskpool, taskid, _noop, tasklock=False, 
+                    tracingmode='append', num=num)
+        if not r:
+            break
+        done += r
+    results.put(done)
+
+
+def bench_do_task(size, procs, num):
+    """do_task num items at a time in procs processes until size items done"""
+
+    taskpool, taskid = new_taskpool(size)
+    try:
+        results = multiprocessing.Queue()
+        ps = [multiprocessing.Process(target=_run_do_task, 
+                                      args=(taskpool, taskid, num, results)) 
+              for i in range(procs)]
+        start = time.perf_counter()
+        for p in ps:
+            p.start()
+        done = sum(results.get() for p in ps)
+        for p in ps:
+            p.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        remove_taskpool(taskpool)
+    return summary('do_task', size, procs, done, elapsed)
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=dirname(abspath(__file__)), 
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 
+            'python': platform.python_version(), 
+            'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(), 
+            'cpu_count': os.cpu_count()}
+
+
+def compare(results, baseline, threshold):
+    """Return the results regressing more than threshold against baseline"""
+
+    def key(r):
+        return (r['bench'], r['size'], r['procs'], r.get('mode'))
+
+    base = {key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        b = base.get(key(r))
+        if not b or not b.get('ops_per_sec') or not r.get('ops_per_sec'):
+            continue
+        change = r['ops_per_sec'] / b['ops_per_sec'] - 1
+        if change < -threshold:
+            regressions.append((key(r), b['ops_per_sec'], r['ops_per_sec'], 
+                                change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='taskqueue benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', 
+                        default=[100, 1000, 10000], 
+                        help='queue sizes, up to 1000000')
+    parser.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4], 
+                        help='process counts, up to 32')
+    parser.add_argument('--ops', type=int, default=200, 
+                        help='operations per process')
+    parser.add_argument('--num', type=int, default=100, 
+                        help='items per do_task')
+    parser.add_argument('--bench', nargs='+', 
+                        default=['put', 'get', 'queuelock', 'tracing', 'do_task', 
+                                 'codec'])
+    parser.add_argument('-o', '--output', help='json file of the results, '
+                                               'default stdout')
+    parser.add_argument('--compare', help='json file of the baseline results')
+    parser.add_argument('--threshold', type=float, default=0.2, 
+                        help='max ratio of ops/sec regression')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        for procs in args.procs:
+            for op in ('put', 'get', 'queuelock'):
+                if op in args.bench:
+                    results.append(bench_ops(op, size, procs, args.ops))
+            if 'do_task' in args.bench:
+                results.append(bench_do_task(size, procs, args.num))
+        if 'tracing' in args.bench:
+            for mode in ('column', 'append'):
+                # the column mode is O(n^2)
+                if mode == 'column' and size > 10000:
+                    continue
+                results.append(bench_tracing(size, mode))
+        if 'codec' in args.bench:
+            for name in ('json', 'pickle', 'raw', 'msgpack'):
+                try:
+                    results.append(bench_codec(size, name))
+                except ValueError:
+                    # msgpack not installed
+                    pass
+        sys.stderr.write('size {} done\n'.format(size))
+
+    output = {'meta': metadata(), 'results': results}
+    s = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(s)
+    else:
+        print(s)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(output, baseline, args.threshold)
+        for k, old, new, change in regressions:
+            sys.stderr.write('regression {}: {:.1f} -> {:.1f} ops/sec ({:+.0%})\n'
+                             .format(k, old, new, change))
+        if regressions:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
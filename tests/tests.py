@@ -15,6 +15,42 @@ sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
 import taskqueue
 from taskqueue import TaskQueue, do_task
 
+
+def _stress_producer(dbf, taskid, prefix, num):
+    q = TaskQueue(dbf, taskid)
+    for i in range(0, num, 10):
+        q.put(['{}-{}'.format(prefix, j) for j in range(i, min(i + 10, num))])
+
+
+def _stress_consumer(dbf, taskid, lockmode, results, stop):
+    q = TaskQueue(dbf, taskid, lockmode=lockmode, lock_timeout=60)
+    got = []
+    while not stop.is_set():
+        got.extend(q.get(7))
+    got.extend(q.get())
+    results.put(got)
+
+
+def _delayed_put(dbf, taskid, items, delay):
+    import time
+    time.sleep(delay)
+    TaskQueue(dbf, taskid).put(items)
+
+
+def _even_item(item):
+    return int(item[-1:]) % 2 == 0
+
+
+def _even_batch(items):
+    return [_even_item(item) for item in items]
+
+
+async def _async_even_item(item):
+    import asyncio
+    await asyncio.sleep(0.01)
+    return _even_item(item)
+
+
 class RoutineTest(unittest.TestCase):
     
     def setUp(self):
@@ -58,6 +94,19 @@ class RoutineTest(unittest.TestCase):
         with self.assertRaises(taskqueue.queue.QueueLockTimeOut):
             q.get()
 
+        # the deprecated QUEUE_LOCK_TRY_TIME is still used if set
+        import time
+        from unittest import mock
+
+        with mock.patch.object(taskqueue.queue, 'QUEUE_LOCK_TRY_TIME', 0.1):
+            with self.assertWarns(DeprecationWarning):
+                q = TaskQueue(self.dbf, self.taskid, pooled=False)
+            self.assertEqual(q._queuelock.timeout, 0.1)
+            start = time.monotonic()
+            with self.assertRaises(taskqueue.queue.QueueLockTimeOut):
+                q.get()
+            self.assertLess(time.monotonic() - start, 5)
+
     def test_taskqueue_get2(self):
         """TaskQueue.get should return right result"""
 
@@ -76,6 +125,456 @@ class RoutineTest(unittest.TestCase):
         q2.put(items)
         self.assertEqual(q.get(), items)
 
+    def test_taskqueue_get3(self):
+        """TaskQueue.get should return num of items in order"""
+
+        q = TaskQueue(self.dbf, self.taskid)
+        q.put(['GC-A0004', 'GC-A0005'])
+        # the legacy items column is drained in front of the new rows
+        self.assertEqual(q.get(2), self.items[:2])
+        self.assertEqual(q.get(2), ['GC-A0003', 'GC-A0004'])
+        self.assertFalse(q.empty())
+        self.assertEqual(q.get(), ['GC-A0005'])
+        self.assertTrue(q.empty())
+
+    def test_taskqueue_block_get(self):
+        """Blocking get should wake up soon after a put from another process"""
+
+        import multiprocessing
+        import time
+
+        q = TaskQueue(self.dbf, self.taskid)
+        self.assertEqual(q.get(), self.items)
+        start = time.monotonic()
+        self.assertEqual(q.get(block=True, timeout=0.2), [])
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+        p = multiprocessing.Process(target=_delayed_put, 
+                                    args=(self.dbf, self.taskid, ['GC-A0004'], 0.5))
+        p.start()
+        start = time.monotonic()
+        self.assertEqual(q.get(block=True, timeout=10), ['GC-A0004'])
+        self.assertLess(time.monotonic() - start, 0.9)
+        p.join()
+
+        q.put(self.items)
+        self.assertEqual(list(q.consume(num=2, timeout=0.1)), self.items)
+
+    def test_taskqueue_lease(self):
+        """Leased items should go back to the queue unless acked"""
+
+        import time
+
+        q = TaskQueue(self.dbf, self.taskid, visibility_timeout=0.2)
+        q2 = TaskQueue(self.dbf, self.taskid, visibility_timeout=0.2)
+        items = q.get(2)
+        self.assertEqual(items, self.items[:2])
+        self.assertEqual(q2.get(), self.items[2:])
+        # worker No.2 crashed, its items come back after the timeout
+        self.assertTrue(q.empty())
+        time.sleep(0.3)
+        items2 = q2.get()
+        self.assertEqual(items2, self.items)
+        # the lease of worker No.1 has expired and the items are leased again
+        self.assertEqual(q.ack(items), 0)
+        q2.nack(items2)
+        items = q.get()
+        self.assertEqual(items, self.items)
+        self.assertEqual(q.ack(items, [0, 2]), 2)
+        self.assertEqual(q.nack(items, [1]), 1)
+        self.assertEqual(q2.get(), ['GC-A0002'])
+
+    def test_tasktracing_lease(self):
+        """TaskTracing should ack ok items and nack fail items in one flush"""
+
+        q = TaskQueue(self.dbf, self.taskid, visibility_timeout=60)
+        items = q.get()
+        with q.tasktracing(items, mode='append') as tracing:
+            tracing.ok(0)
+            tracing.fail(1)
+            tracing.ok(2)
+            count = self.db.execute("""SELECT count(*) FROM taskitem""").fetchone()[0]
+            self.assertEqual(count, 3)
+        self.assertEqual(q.get(), ['GC-A0002'])
+
+    def test_taskqueue_delay(self):
+        """Delayed items should not be gotten before they are due"""
+
+        import time
+
+        q = TaskQueue(self.dbf, self.taskid)
+        self.assertEqual(q.get(), self.items)
+        q.put(['GC-A0004'], delay=0.2)
+        q.put(['GC-A0005'], not_before=time.time() - 1)
+        self.assertEqual(q.get(), ['GC-A0005'])
+        self.assertTrue(q.empty())
+        time.sleep(0.3)
+        self.assertEqual(q.get(), ['GC-A0004'])
+
+    def test_taskqueue_retry(self):
+        """Failed items should be retried with backoff and then moved to the dead letter taskid"""
+
+        import time
+        from taskqueue.retry import RetryPolicy
+
+        cur = self.db.execute("""INSERT INTO taskqueue(lockid, qlocked, desc) 
+                                 VALUES(?, 0, 'dead letter')""", (self.lockid, ))
+        dead_taskid = cur.lastrowid
+        self.db.commit()
+        policy = RetryPolicy(max_attempts=2, delay=0.1, backoff=2.0, 
+                             dead_taskid=dead_taskid)
+        self.assertEqual(policy.next_delay(1), 0.1)
+        self.assertEqual(policy.next_delay(2), 0.2)
+        TaskQueue(self.dbf, self.taskid).set_retry_policy(policy)
+
+        for visibility_timeout in (None, 60):
+            q = TaskQueue(self.dbf, self.taskid, 
+                          visibility_timeout=visibility_timeout)
+            self.assertEqual(q.retry_policy.max_attempts, 2)
+            items = q.get()
+            self.assertEqual(items.attempts, [1, 1, 1])
+            self.assertEqual(q.retry(items, [1]), (1, 0))
+            q.ack(items, [0, 2])
+            self.assertTrue(q.empty())
+            time.sleep(0.15)
+            items = q.get()
+            self.assertEqual(items, ['GC-A0002'])
+            self.assertEqual(items.attempts, [2])
+            with q.tasktracing(items, mode='append') as tracing:
+                tracing.fail(0)
+            self.assertTrue(q.empty())
+            dead = TaskQueue(self.dbf, dead_taskid)
+            self.assertEqual(dead.get(), ['GC-A0002'])
+            q.put(self.items)
+
+    def test_taskqueue_priority(self):
+        """Items of higher priority should be gotten first, in order within a priority"""
+
+        import time
+
+        q = TaskQueue(self.dbf, self.taskid)
+        q.put(['GC-B0001', 'GC-B0002'], priority=5)
+        q.put(['GC-C0001'], priority=-1)
+        self.assertEqual(q.get(3), ['GC-B0001', 'GC-B0002', 'GC-A0001'])
+        self.assertEqual(q.get(), ['GC-A0002', 'GC-A0003', 'GC-C0001'])
+        plan = self.db.execute("""EXPLAIN QUERY PLAN SELECT id, item FROM taskitem 
+                                  WHERE taskid=1 AND visible_at=0 
+                                  ORDER BY priority DESC, id LIMIT 10""").fetchall()
+        self.assertNotIn('TEMP B-TREE', str(plan))
+
+        # aging
+        q = TaskQueue(self.dbf, self.taskid, aging=0.1)
+        q.put(['GC-C0002'], priority=-1)
+        time.sleep(0.15)
+        q.put(['GC-A0004'])
+        self.assertEqual(q.get(1), ['GC-C0002'])
+
+    def test_taskqueue_pool(self):
+        """TaskQueue objects should share the connection and the cached metadata"""
+
+        import sqlite3
+        from taskqueue.retry import RetryPolicy
+
+        q = TaskQueue(self.dbf, self.taskid)
+        q2 = TaskQueue(self.dbf, self.taskid)
+        self.assertIs(q.db, q2.db)
+        self.assertIs(q._meta, q2._meta)
+        self.assertEqual(q.db.execute("""PRAGMA journal_mode""").fetchone()[0], 'wal')
+        q3 = TaskQueue(self.dbf, self.taskid, pooled=False)
+        self.assertIsNot(q.db, q3.db)
+        # metadata changed by another connection
+        db = sqlite3.connect(self.dbf)
+        db.execute("""UPDATE taskqueue SET max_attempts=3 WHERE taskid=?""", 
+                   (self.taskid, ))
+        db.commit()
+        q4 = TaskQueue(self.dbf, self.taskid)
+        self.assertIsNot(q4._meta, q._meta)
+        self.assertEqual(q4.retry_policy.max_attempts, 3)
+        self.assertIs(TaskQueue(self.dbf, self.taskid)._meta, q4._meta)
+
+    def test_taskqueue_put_script(self):
+        """taskqueue-put should put the json argument and the ndjson of stdin"""
+
+        import subprocess
+        from os.path import join
+
+        script = join(dirname(dirname(abspath(__file__))), 'taskqueue-put')
+        r = subprocess.run([sys.executable, script, self.dbf, str(self.taskid), 
+                            '["GC-A0004"]'])
+        self.assertEqual(r.returncode, 0)
+        r = subprocess.run([sys.executable, script, '--batch', '2', self.dbf, 
+                            str(self.taskid), '-'], 
+                           input=b'"GC-A0005"\n\n"GC-A0006"\n"GC-A0007"\n')
+        self.assertEqual(r.returncode, 0)
+        r = subprocess.run([sys.executable, script, self.dbf], 
+                           stderr=subprocess.DEVNULL)
+        self.assertEqual(r.returncode, 1)
+        q = TaskQueue(self.dbf, self.taskid)
+        self.assertEqual(q.get(), self.items + ['GC-A0004', 'GC-A0005', 
+                                                'GC-A0006', 'GC-A0007'])
+
+    def test_putd(self):
+        """PutServer should group commit the puts sent to the socket"""
+
+        import os
+        import tempfile
+        import threading
+        from taskqueue.putd import PutServer, socket_put
+
+        address = os.path.join(tempfile.mkdtemp(), 'putd.sock')
+        server = PutServer(self.dbf, address, batch=4, interval=0.05)
+        t = threading.Thread(target=server.serve_forever)
+        t.start()
+        try:
+            results = []
+            ts = [threading.Thread(target=lambda i=i: results.append(
+                      socket_put(address, self.taskid, ['GC-B{}'.format(i)]))) 
+                  for i in range(8)]
+            for c in ts:
+                c.start()
+            for c in ts:
+                c.join()
+            self.assertEqual(results, [1] * 8)
+            with self.assertRaises(RuntimeError):
+                socket_put(address, 9999, ['GC-B9'])
+        finally:
+            server.shutdown()
+            t.join()
+        q = TaskQueue(self.dbf, self.taskid)
+        self.assertEqual(sorted(q.get()), 
+                         self.items + ['GC-B{}'.format(i) for i in range(8)])
+
+    def test_broker(self):
+        """BrokerServer should serve puts and gets from memory, persist them 
+        behind, and TaskQueue should fall back to the taskpool without it"""
+
+        import os
+        import tempfile
+        import threading
+        import time
+        from taskqueue.broker import BrokerServer
+
+        address = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        server = BrokerServer(self.dbf, address, durability=0.05, hot_size=4)
+        t = threading.Thread(target=server.serve_forever)
+        t.start()
+        try:
+            q = TaskQueue(self.dbf, self.taskid, broker=address)
+            # the legacy items are loaded by the first get
+            self.assertEqual(q.get(2), self.items[:2])
+            q.put(['GC-B1', 'GC-B2'], priority=1)
+            self.assertEqual(q.get(1), ['GC-B1'])
+            # the rows in memory are leased by the broker
+            time.sleep(0.2)
+            self.assertEqual(TaskQueue(self.dbf, self.taskid).get(), [])
+            q.put(['GC-B{}'.format(i) for i in range(3, 8)])
+            items = q.get()
+            self.assertEqual(items, ['GC-B2', 'GC-A0003', 'GC-B3', 'GC-B4'])
+            self.assertEqual(items.priorities, [1, 0, 0, 0])
+            with self.assertRaises(RuntimeError):
+                TaskQueue(self.dbf, self.taskid, 
+                          broker=address)._broker.get(9999)
+        finally:
+            server.shutdown()
+            t.join()
+        # the items not gotten are back to the taskpool, and the broker 
+        # down is skipped
+        q.put(['GC-B8'])
+        self.assertEqual(q.get(), ['GC-B{}'.format(i) for i in range(5, 9)])
+        count = self.db.execute("""SELECT count(*) FROM taskitem""").fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_broker_errors(self):
+        """BrokerServer should answer a failed refill with an error and keep 
+        serving"""
+
+        import os
+        import tempfile
+        import threading
+        from taskqueue.broker import BrokerServer
+
+        address = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        server = BrokerServer(self.dbf, address, lock_timeout=0.1)
+        t = threading.Thread(target=server.serve_forever)
+        t.start()
+        try:
+            q = TaskQueue(self.dbf, self.taskid, broker=address)
+            self.db.execute("""UPDATE taskqueue SET qlocked=1 WHERE taskid=?""", 
+                            (self.taskid, ))
+            self.db.commit()
+            with self.assertRaises(taskqueue.queue.QueueLockTimeOut):
+                q.get()
+            self.assertTrue(t.is_alive())
+            self.db.execute("""UPDATE taskqueue SET qlocked=0 WHERE taskid=?""", 
+                            (self.taskid, ))
+            self.db.commit()
+            self.assertEqual(q.get(), self.items)
+        finally:
+            server.shutdown()
+            t.join()
+
+    def test_broker_dedup(self):
+        """the puts through BrokerServer should keep the dedup and codec of 
+        the producer"""
+
+        import os
+        import tempfile
+        import threading
+        from taskqueue.broker import BrokerServer
+
+        address = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        server = BrokerServer(self.dbf, address)
+        t = threading.Thread(target=server.serve_forever)
+        t.start()
+        try:
+            q = TaskQueue(self.dbf, self.taskid, broker=address)
+            self.assertEqual(q.get(), self.items)
+            p = TaskQueue(self.dbf, self.taskid, broker=address, 
+                          dedup_key=lambda item: item[0])
+            self.assertEqual(p.put(['a1', 'a2']), 1)
+            p = TaskQueue(self.dbf, self.taskid, broker=address, dedup=True)
+            self.assertEqual(p.put(['b', 'b']), 1)
+            self.assertEqual(q.put(['b']), 0)
+            self.assertEqual(q.get(), ['a1', 'b', 'b'])
+            p = TaskQueue(self.dbf, self.taskid, broker=address, codec='pickle')
+            p.put([{1, 2}])
+            q = TaskQueue(self.dbf, self.taskid, broker=address, codec='pickle')
+            self.assertEqual(q.get(), [{1, 2}])
+        finally:
+            server.shutdown()
+            t.join()
+
+    def test_broker_lease(self):
+        """the items in memory of BrokerServer should be leased to the 
+        consumers with visibility_timeout, and go back to the taskpool when 
+        no consumer gets them through the broker"""
+
+        import os
+        import tempfile
+        import threading
+        import time
+        from taskqueue.broker import BrokerServer
+
+        address = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        server = BrokerServer(self.dbf, address, durability=0.01, idle=0.3)
+        t = threading.Thread(target=server.serve_forever)
+        t.start()
+        try:
+            q = TaskQueue(self.dbf, self.taskid, broker=address, 
+                          visibility_timeout=60)
+            items = q.get(2)
+            self.assertEqual(items, self.items[:2])
+            self.assertIsNotNone(items.leaseid)
+            q.put(['GC-B1'])
+            q.ack(items, [0])
+            q.nack(items, [1])
+            self.assertEqual(q.get(), [self.items[2], 'GC-B1'])
+            self.assertEqual(self.db.execute("""SELECT count(*) FROM taskitem 
+                                                WHERE leaseid IS NOT NULL""").fetchone()[0], 
+                             2)
+
+            # a consumer reading the taskpool directly gets the items in 
+            # memory after the broker is idle
+            q.put(['GC-B2', 'GC-B3'])
+            direct = TaskQueue(self.dbf, self.taskid)
+            self.assertEqual(direct.get(), [self.items[1]])
+            self.assertEqual(direct.get(block=True, timeout=5), ['GC-B2', 'GC-B3'])
+            # and the puts of an idle taskid go to the taskpool
+            q.put(['GC-B4'])
+            time.sleep(0.1)
+            self.assertEqual(direct.get(), ['GC-B4'])
+        finally:
+            server.shutdown()
+            t.join()
+
+    def test_broker_client_timeout(self):
+        """BrokerClient should fall back only if the request is not sent, and 
+        raise on a timeout after sending it"""
+
+        import os
+        import socket
+        import tempfile
+        from taskqueue.broker import BrokerClient
+
+        address = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        client = BrokerClient(address, timeout=0.2)
+        self.assertIsNone(client.put(self.taskid, ['"GC-B1"']))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+        sock.listen(1)
+        try:
+            # a broker not answering
+            client = BrokerClient(address, timeout=0.2)
+            with self.assertRaises(TimeoutError):
+                client.put(self.taskid, ['"GC-B1"'])
+            conn, _ = sock.accept()
+            conn.close()
+            # a broker closing the connection
+            client = BrokerClient(address, timeout=0.2)
+            client._connect()
+            conn, _ = sock.accept()
+            conn.close()
+            self.assertIsNone(client.get(self.taskid))
+        finally:
+            sock.close()
+
+    def test_migrate_taskqueue_tables(self):
+        """migrate_taskqueue_tables should move legacy items into taskitem rows"""
+
+        from taskqueue.helper import migrate_taskqueue_tables
+
+        self.db.execute("""DROP TABLE taskitem""")
+        self.db.commit()
+        self.assertEqual(migrate_taskqueue_tables(self.dbf), 3)
+        self.assertEqual(migrate_taskqueue_tables(self.dbf), 0)
+        items = self.db.execute("""SELECT items FROM taskqueue WHERE taskid=?""", 
+                                (self.taskid, )).fetchone()[0]
+        self.assertEqual(items, '[]')
+        q = TaskQueue(self.dbf, self.taskid)
+        self.assertEqual(q.get(), self.items)
+
+    def _stress_taskqueue(self, lockmode):
+        import multiprocessing
+        import time
+
+        nproducer, nconsumer, num = 4, 4, 250
+        results = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        producers = [multiprocessing.Process(target=_stress_producer, 
+                                             args=(self.dbf, self.taskid, 
+                                                   'P{}'.format(i), num)) 
+                     for i in range(nproducer)]
+        consumers = [multiprocessing.Process(target=_stress_consumer, 
+                                             args=(self.dbf, self.taskid, 
+                                                   lockmode, results, stop)) 
+                     for i in range(nconsumer)]
+        for p in producers + consumers:
+            p.start()
+        for p in producers:
+            p.join()
+        time.sleep(0.2)
+        stop.set()
+        got = []
+        for i in range(nconsumer):
+            got.extend(results.get(timeout=60))
+        for p in consumers:
+            p.join()
+        expected = self.items + ['P{}-{}'.format(i, j) 
+                                 for i in range(nproducer) for j in range(num)]
+        # nothing lost and nothing duplicated
+        self.assertEqual(len(got), len(expected))
+        self.assertEqual(sorted(got), sorted(expected))
+
+    def test_taskqueue_stress_update(self):
+        """Concurrent processes should never lose or duplicate items, update lockmode"""
+
+        self._stress_taskqueue('update')
+
+    def test_taskqueue_stress_immediate(self):
+        """Concurrent processes should never lose or duplicate items, immediate lockmode"""
+
+        self._stress_taskqueue('immediate')
+
     def test_tasklock1(self):
         """tasklock should Return False when lock is locked"""
 
@@ -106,6 +605,37 @@ class RoutineTest(unittest.TestCase):
         self.assertEqual(tasklock2.acquire(), True)
         tasklock2.release()
 
+    def test_tasklock_lease(self):
+        """An expired lease should be taken over with a larger fencing token"""
+
+        import time
+        from taskqueue.tasklock import TaskLockBusy
+
+        q1 = TaskQueue(self.dbf, self.taskid)
+        tasklock1 = q1.tasklock(ttl=0.2)
+        self.assertTrue(tasklock1.acquire())
+        q2 = TaskQueue(self.dbf, self.taskid)
+        tasklock2 = q2.tasklock(ttl=0.2)
+        self.assertFalse(tasklock2.acquire())
+        # worker No.1 crashed without releasing
+        time.sleep(0.3)
+        self.assertFalse(tasklock1.locked())
+        self.assertTrue(tasklock2.acquire())
+        self.assertEqual(tasklock2.token, tasklock1.token + 1)
+        self.assertFalse(tasklock1.renew())
+        with self.assertRaises(RuntimeError):
+            tasklock1.release()
+        tasklock2.release()
+
+        # heartbeat keeps the lease
+        with q1.tasklock(ttl=0.2) as tasklock:
+            time.sleep(0.5)
+            self.assertTrue(tasklock.locked())
+            with self.assertRaises(TaskLockBusy):
+                with q2.tasklock():
+                    pass
+        self.assertFalse(q1.tasklock().locked())
+
     def test_tasktracing(self):
         q = TaskQueue(self.dbf, self.taskid)
         assert q.tasklock().acquire() is True
@@ -121,6 +651,99 @@ class RoutineTest(unittest.TestCase):
                             (self.taskid, )).fetchone()[0]
         self.assertEqual(r, '0:ok,1:fail,2:ok')
 
+    def test_tasktracing_append(self):
+        """TaskTracing in append mode should buffer outcomes and derive the tracing string"""
+
+        from taskqueue.tracing import get_tracing
+
+        q = TaskQueue(self.dbf, self.taskid)
+        items = q.get()
+        with q.tasktracing(items, mode='append', flush_count=2, 
+                           flush_interval=60) as tracing:
+            tracing.ok(0)
+            count = self.db.execute("""SELECT count(*) FROM tasktracingitem""").fetchone()[0]
+            self.assertEqual(count, 0)
+            tracing.fail(1)
+            count = self.db.execute("""SELECT count(*) FROM tasktracingitem""").fetchone()[0]
+            self.assertEqual(count, 2)
+            tracing.ok(2)
+        self.assertEqual(get_tracing(self.db, tracing.id), '0:ok,1:fail,2:ok')
+        self.assertEqual(tracing.tracing, '0:ok,1:fail,2:ok')
+        r = self.db.execute("""SELECT tracing FROM tasktracing_view 
+                               WHERE taskid=?""", 
+                            (self.taskid, )).fetchone()[0]
+        self.assertEqual(r, '0:ok,1:fail,2:ok')
+
+    def test_tracing_retention(self):
+        """prune_tracing and compact_tracing should bound tasktracing, and the 
+        analytics should read the counts"""
+
+        from taskqueue.retention import prune_tracing, compact_tracing
+        import json
+        from taskqueue.analytics import summary, failures, throughput
+        from taskqueue.tracing import iter_tracing
+
+        q = TaskQueue(self.dbf, self.taskid)
+        items = q.get()
+        with q.tasktracing(items, mode='append') as tracing:
+            tracing.ok(0)
+            tracing.fail(1)
+            tracing.ok(2)
+        r = self.db.execute("""SELECT items, ok_count, fail_count 
+                               FROM tasktracing WHERE id=?""", 
+                            (tracing.id, )).fetchone()
+        self.assertEqual(json.loads(r[0]), self.items)
+        self.assertEqual(r[1:], (2, 1))
+        # the items stored by reference are stored once
+        for i in range(4):
+            t = q.tasktracing(['x'], items_ref=True)
+            t.fail(0)
+        self.assertEqual(self.db.execute("""SELECT items FROM tasktracingitems""")
+                         .fetchall(), [('["x"]', )])
+        self.assertEqual(self.db.execute("""SELECT items FROM tasktracing 
+                                            WHERE id=?""", (t.id, )).fetchone(), 
+                         (None, ))
+        self.assertEqual([json.loads(r[3]) for r in iter_tracing(self.db)], 
+                         [self.items] + [['x']] * 4)
+        # a pending write of the caller is not committed by the summaries
+        self.db.execute("""INSERT INTO tasktracing(taskid, ok_count) 
+                           VALUES(?, 100)""", (self.taskid, ))
+        self.assertEqual(summary(self.db)[0]['ok'], 102)
+        self.db.rollback()
+        self.assertEqual(summary(self.db), 
+                         [{'taskid': self.taskid, 'tracings': 5, 'ok': 2, 
+                           'fail': 5, 'success_rate': 2 / 7.0}])
+        self.assertEqual(failures(self.db), {self.taskid: 5})
+        self.assertEqual(failures(self.db, until=3600), {})
+        self.assertEqual([w[1:] for w in throughput(self.db, 3600)], [(2, 5)])
+
+        self.assertEqual(compact_tracing(self.db, -60, drop_items=True), 5)
+        self.assertEqual(compact_tracing(self.db, -60, drop_items=True), 0)
+        count = self.db.execute("""SELECT count(*) FROM tasktracingitem""").fetchone()[0]
+        self.assertEqual(count, 0)
+        r = self.db.execute("""SELECT items, tracing FROM tasktracing 
+                               WHERE id=?""", (tracing.id, )).fetchone()
+        self.assertEqual(r, (None, '0:ok,1:fail,2:ok'))
+
+        self.assertEqual(prune_tracing(self.db, max_rows=2, batch=2), 2)
+        self.assertEqual(prune_tracing(self.db, max_rows=2, batch=2), 1)
+        self.assertEqual(prune_tracing(self.db, max_rows=2), 0)
+        self.assertEqual(prune_tracing(self.db, max_age=3600), 0)
+        self.assertEqual(prune_tracing(self.db, max_age=-60), 2)
+        count = self.db.execute("""SELECT count(*) FROM tasktracing""").fetchone()[0]
+        self.assertEqual(count, 0)
+        self.assertEqual(self.db.execute("""SELECT count(*) FROM tasktracingitems""")
+                         .fetchone()[0], 0)
+
+        # the items are removed with the last tracing row referencing them
+        for i in range(2):
+            q.tasktracing(['y'], items_ref=True).ok(0)
+        self.assertEqual(prune_tracing(self.db, max_rows=1), 1)
+        self.assertEqual([r[3] for r in iter_tracing(self.db)], ['["y"]'])
+        self.assertEqual(prune_tracing(self.db, max_age=-60), 1)
+        self.assertEqual(self.db.execute("""SELECT count(*) FROM tasktracingitems""")
+                         .fetchone()[0], 0)
+
     def test_tasklock3(self):
         """tasklock should raise RuntimeError if you release a lock not owned by you"""
 
@@ -155,6 +778,666 @@ class RoutineTest(unittest.TestCase):
                                   """, (self.taskid,)).fetchone()[0]
         self.assertEqual(tracing, "0:fail,1:ok,2:fail")
 
+    def test_do_task_executor(self):
+        """do_task should trace the right item index with thread and process pools"""
+
+        from taskqueue.tracing import get_tracing
+
+        q = TaskQueue(self.dbf, self.taskid)
+        expected = ['0:fail', '1:ok', '2:fail']
+        for kwargs in ({'max_workers': 4, 'chunksize': 2, 'max_inflight': 1}, 
+                       {'executor': 'process', 'max_workers': 2}):
+            r = do_task(self.dbf, self.taskid, _even_item, 
+                        tracingmode='append', **kwargs)
+            self.assertEqual(r, 3)
+            tracingid = self.db.execute("""SELECT max(id) FROM tasktracing""").fetchone()[0]
+            tracing = get_tracing(self.db, tracingid).split(',')
+            self.assertEqual(sorted(tracing), expected)
+            self.assertFalse(q.tasklock().locked())
+            q.put(self.items)
+
+        # the tasklock is released if the executor is invalid
+        for lockttl in (None, 60):
+            with self.assertRaises(ValueError):
+                do_task(self.dbf, self.taskid, _even_item, executor='fiber', 
+                        lockttl=lockttl)
+            self.assertFalse(q.tasklock().locked())
+        self.assertEqual(q.get(), self.items)
+
+    def test_do_task_batch(self):
+        """do_task should map the results of a batch back to the item indexes"""
+
+        from taskqueue.tracing import get_tracing
+
+        q = TaskQueue(self.dbf, self.taskid)
+        items = ['GC-A000{}'.format(i) for i in range(8)]
+        q.get()
+        for kwargs in ({}, {'max_workers': 2}, 
+                       {'executor': 'process', 'max_workers': 2}):
+            q.put(items)
+            r = do_task(self.dbf, self.taskid, _even_batch, batch_size=3, 
+                        tracingmode='append', **kwargs)
+            self.assertEqual(r, 8)
+            tracingid = self.db.execute("""SELECT max(id) FROM tasktracing""").fetchone()[0]
+            tracing = get_tracing(self.db, tracingid).split(',')
+            self.assertEqual(sorted(tracing), sorted(
+                '{}:{}'.format(i, 'ok' if i % 2 == 0 else 'fail') for i in range(8)))
+
+        q.put(items)
+        with self.assertRaises(ValueError):
+            do_task(self.dbf, self.taskid, lambda batch: [True], batch_size=3)
+
+    def test_dedup(self):
+        """put should drop the items pending or leased in the queue"""
+
+        import threading
+
+        q = TaskQueue(self.dbf, self.taskid, visibility_timeout=60)
+        q.set_dedup(True)
+        q.get()
+        self.assertEqual(q.put(['GC-A0001', 'GC-A0002', 'GC-A0001']), 1)
+        self.assertEqual(q.put(['GC-A0002', 'GC-A0003']), 1)
+        items = q.get(2)
+        self.assertEqual(items, ['GC-A0001', 'GC-A0002'])
+        # still leased
+        self.assertEqual(q.put(['GC-A0001']), 1)
+        q.ack(items)
+        self.assertEqual(q.put(['GC-A0001']), 0)
+        self.assertEqual(q.get(), ['GC-A0003', 'GC-A0001'])
+
+        # removed by get
+        q = TaskQueue(self.dbf, self.taskid, dedup_key=lambda item: item['id'])
+        self.assertEqual(q.put([{'id': 1, 'v': 'a'}, {'id': 1, 'v': 'b'}]), 1)
+        self.assertEqual(q.get(), [{'id': 1, 'v': 'a'}])
+        self.assertEqual(q.put([{'id': 1, 'v': 'b'}]), 0)
+        q.get()
+
+        dropped = []
+        def producer():
+            dropped.append(TaskQueue(self.dbf, self.taskid).put(
+                ['GC-B{}'.format(i) for i in range(100)]))
+        ts = [threading.Thread(target=producer) for i in range(4)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        self.assertEqual(sum(dropped), 300)
+        self.assertEqual(sorted(q.get()), sorted('GC-B{}'.format(i) for i in range(100)))
+
+    def test_dedup_retry(self):
+        """the items waiting for a retry should keep their dedup key, also 
+        in the dead letter taskid"""
+
+        from taskqueue.retry import RetryPolicy
+
+        cur = self.db.execute("""INSERT INTO taskqueue(lockid, desc, dedup) 
+                                 VALUES(?, 'dead letter', 1)""", (self.lockid, ))
+        dead_taskid = cur.lastrowid
+        self.db.commit()
+        q = TaskQueue(self.dbf, self.taskid, dedup_key=lambda item: item['id'])
+        q.get()
+        q.set_retry_policy(RetryPolicy(max_attempts=2, delay=60, 
+                                       dead_taskid=dead_taskid))
+        q.put([{'id': 1, 'v': 'a'}])
+        items = q.get()
+        self.assertEqual(q.retry(items, [0]), (1, 0))
+        self.assertEqual(q.put([{'id': 1, 'v': 'b'}]), 1)
+
+        # the dead items are deduped by the key of the item
+        for v in ('c', 'd'):
+            q.db.execute("""DELETE FROM taskitem WHERE taskid=?""", 
+                         (self.taskid, ))
+            q.db.commit()
+            q.put([{'id': 2, 'v': v}])
+            items = q.get()
+            items.attempts = [2]
+            self.assertEqual(q.retry(items, [0]), (0, 1))
+        self.assertEqual(TaskQueue(self.dbf, dead_taskid).get(), 
+                         [{'id': 2, 'v': 'c'}])
+
+    def test_multi_queue_worker(self):
+        """MultiQueueWorker should do the ready taskids by weight and skip 
+        the taskids whose lock is held"""
+
+        from taskqueue import MultiQueueWorker
+
+        cur = self.db.execute("""INSERT INTO taskqueue(lockid, qlocked, desc) 
+                                 VALUES(?, 0, 'same lock group')""", (self.lockid, ))
+        taskid2 = cur.lastrowid
+        cur = self.db.execute("""INSERT INTO tasklock(locked, desc) VALUES(0, 'other')""")
+        cur = self.db.execute("""INSERT INTO taskqueue(lockid, qlocked, desc) 
+                                 VALUES(?, 0, 'other lock')""", (cur.lastrowid, ))
+        taskid3 = cur.lastrowid
+        cur = self.db.execute("""INSERT INTO taskqueue(lockid, qlocked, desc) 
+                                 VALUES(?, 0, 'empty')""", (self.lockid, ))
+        self.db.commit()
+        TaskQueue(self.dbf, taskid2).put(['B{}'.format(i) for i in range(10)])
+        TaskQueue(self.dbf, taskid3).put(['C{}'.format(i) for i in range(10)])
+
+        done = []
+        with MultiQueueWorker(self.dbf, done.append, tasktracing=False, 
+                              quantum=2, weights={taskid3: 2}, 
+                              scheduling='wrr') as worker:
+            self.assertEqual(worker.ready_taskids(), [self.taskid, taskid2, taskid3])
+            self.assertEqual(worker.run_once(), 8)
+            self.assertEqual(done[:4], ['C0', 'C1', 'GC-A0001', 'GC-A0002'])
+
+            tlock = TaskQueue(self.dbf, self.taskid).tasklock()
+            tlock.acquire()
+            del done[:]
+            self.assertEqual(worker.run_once(), 4)
+            self.assertEqual(done, ['C4', 'C5', 'C6', 'C7'])
+            tlock.release()
+
+        del done[:]
+        with MultiQueueWorker(self.dbf, done.append, taskids=[self.taskid, taskid2], 
+                              tasktracing=False, quantum=3) as worker:
+            self.assertEqual(worker.run(timeout=0.1), 9)
+        self.assertEqual(done, ['GC-A0003', 'B2', 'B3', 'B4', 
+                                'B5', 'B6', 'B7', 'B8', 'B9'])
+
+    def test_do_task_chunk(self):
+        """do_task with chunk should get, do and trace the items chunk by 
+        chunk, and the tracing history should be read in chunks"""
+
+        from taskqueue.tracing import iter_tracing, iter_tracing_items
+
+        q = TaskQueue(self.dbf, self.taskid)
+        q.put(['GC-A{:04d}'.format(i) for i in range(4, 11)])
+        self.assertEqual([list(c) for c in q.iter_get(chunk=4, num=6)], 
+                         [self.items + ['GC-A0004'], ['GC-A0005', 'GC-A0006']])
+        r = do_task(self.dbf, self.taskid, _even_item, chunk=2, 
+                    tracingmode='append')
+        self.assertEqual(r, 4)
+        self.assertTrue(TaskQueue(self.dbf, self.taskid).empty())
+        rows = list(iter_tracing(self.db, chunk=1))
+        self.assertEqual([r[4] for r in rows], ['0:fail,1:ok', '0:fail,1:ok'])
+        self.assertEqual([r[0] for r in iter_tracing(self.db, self.taskid, 
+                                                      chunk=1)], 
+                         [r[0] for r in rows])
+        self.assertEqual(list(iter_tracing_items(self.db, rows[0][0], chunk=1)), 
+                         [(0, False), (1, True)])
+        # a pending write of the caller is not committed by the reads
+        self.db.execute("""INSERT INTO tasktracing(taskid, start_time) 
+                           VALUES(?, datetime('now', 'localtime'))""", 
+                        (self.taskid, ))
+        self.assertEqual(len(list(iter_tracing(self.db, self.taskid, chunk=1))), 3)
+        self.assertEqual(len(list(iter_tracing_items(self.db, rows[0][0]))), 2)
+        self.db.rollback()
+        self.assertEqual(len(list(iter_tracing(self.db))), 2)
+
+    def test_partition(self):
+        """get_partition should give the items of a key to one consumer at a 
+        time, in order, and do_task should do the partitions in parallel"""
+
+        q = TaskQueue(self.dbf, self.taskid, partition_key=lambda item: item[:4], 
+                      partitions=8)
+        self.assertEqual(q.get(), self.items)
+        q.put(['GC-B{}'.format(i) for i in range(3)] + ['GC-C0', 'GC-B3', 'GC-C1'])
+        with self.assertRaises(ValueError):
+            q.set_partitions(16)
+        q2 = TaskQueue(self.dbf, self.taskid)
+        items = q.get_partition(2)
+        self.assertEqual(items, ['GC-B0', 'GC-B1'])
+        # a plain get skips the partitions leased
+        q3 = TaskQueue(self.dbf, self.taskid, visibility_timeout=60)
+        items3 = q3.get(1)
+        self.assertEqual(items3, ['GC-C0'])
+        q3.nack(items3)
+        # the partition of GC-B is leased
+        items2 = q2.get_partition()
+        self.assertEqual(items2, ['GC-C0', 'GC-C1'])
+        self.assertEqual(q2.get_partition(), [])
+        self.assertTrue(items.partition_lease.release())
+        items2.partition_lease.release()
+        # the failed item goes back into its partition, in its place
+        q2.requeue(items, [1])
+        items = q2.get_partition()
+        self.assertEqual(items, ['GC-B1', 'GC-B2', 'GC-B3'])
+        items.partition_lease.release()
+
+        q.put(['GC-B{}'.format(i) for i in range(4)] + ['GC-C{}'.format(i) for i in range(4)])
+        # the tasklock of the lock group is kept unless tasklock is False
+        q.tasklock().acquire()
+        self.assertFalse(do_task(self.dbf, self.taskid, _even_item, 
+                                 partitioned=True))
+        r = do_task(self.dbf, self.taskid, _even_item, partitioned=True, 
+                    tasklock=False, chunk=3, num=5, tracingmode='append')
+        self.assertEqual(r, 5)
+        q.tasklock().release()
+        count = self.db.execute("""SELECT count(*) FROM taskpartition 
+                                   WHERE owner IS NOT NULL""").fetchone()[0]
+        self.assertEqual(count, 0)
+        items = q2.get()
+        self.assertEqual(items, ['GC-C1', 'GC-C2', 'GC-C3'])
+        # the items of a plain get go back into their partition
+        q2.requeue(items)
+        count = self.db.execute("""SELECT count(*) FROM taskitem 
+                                   WHERE partition_id IS NOT NULL""").fetchone()[0]
+        self.assertEqual(count, 3)
+
+    def test_do_task_stop(self):
+        """do_task should put back the items not done when stopped"""
+
+        import threading
+
+        for kwargs in ({}, {'visibility_timeout': 60}):
+            stop = threading.Event()
+            done = []
+            def workfunc(item):
+                done.append(item)
+                if len(done) == 2:
+                    stop.set()
+                return True
+            r = do_task(self.dbf, self.taskid, workfunc, stop=stop, **kwargs)
+            self.assertEqual(r, 2)
+            q = TaskQueue(self.dbf, self.taskid)
+            self.assertEqual(q.get(), ['GC-A0003'])
+            self.assertFalse(q.tasklock().locked())
+            q.put(self.items)
+
+    def test_taskqueue_worker_script(self):
+        """taskqueue-worker should do the items with the workers, and stop 
+        them on SIGTERM"""
+
+        import signal
+        import subprocess
+        import time
+        from os.path import join
+
+        q = TaskQueue(self.dbf, self.taskid)
+        q.put(['GC-B{}'.format(i) for i in range(20)])
+        script = join(dirname(dirname(abspath(__file__))), 'taskqueue-worker')
+        p = subprocess.Popen([sys.executable, script, self.dbf, str(self.taskid), 
+                              'tests:_even_item', '-c', '2', '--max-items', '5', 
+                              '--num', '3', '--no-tasklock'], 
+                             cwd=dirname(abspath(__file__)))
+        try:
+            deadline = time.monotonic() + 20
+            while (not TaskQueue(self.dbf, self.taskid).empty() 
+                   and time.monotonic() < deadline):
+                time.sleep(0.1)
+            self.assertTrue(TaskQueue(self.dbf, self.taskid).empty())
+        finally:
+            p.send_signal(signal.SIGTERM)
+            self.assertEqual(p.wait(30), 0)
+        # the items not done when stopped are put back
+        r = self.db.execute("""SELECT (SELECT count(*) FROM tasktracingitem) + 
+                                (SELECT count(*) FROM taskitem)""").fetchone()
+        self.assertEqual(r[0], 23)
+
+    def test_metrics(self):
+        """the metrics should be recorded only when enabled, and exported"""
+
+        import os
+        import tempfile
+        from urllib.request import urlopen
+        from taskqueue import metrics
+
+        q = TaskQueue(self.dbf, self.taskid)
+        q.get(1)
+        self.assertIsNone(metrics.REGISTRY)
+        registry = metrics.enable()
+        try:
+            registry.add_collector(metrics.depth_collector(self.dbf))
+            q.put(['GC-A0004'])
+            self.assertEqual(q.get(2), ['GC-A0002', 'GC-A0003'])
+            self.assertEqual(do_task(self.dbf, self.taskid, _even_item), 1)
+            self.db.execute("""UPDATE taskqueue SET qlocked=1""")
+            self.db.commit()
+            q.put(['GC-A0005'])
+            with self.assertRaises(taskqueue.queue.QueueLockTimeOut):
+                TaskQueue(self.dbf, self.taskid, lock_timeout=0.05).get()
+
+            taskid = str(self.taskid)
+            self.assertEqual(registry.counter('taskqueue_items_put_total', 
+                                              taskid=taskid), 2)
+            self.assertEqual(registry.counter('taskqueue_items_gotten_total', 
+                                              taskid=taskid), 3)
+            self.assertEqual(registry.counter('taskqueue_queuelock_timeouts_total', 
+                                              taskid=taskid), 1)
+            self.assertTrue(registry.counter('taskqueue_queuelock_retries_total', 
+                                             taskid=taskid) > 1)
+            # the get timed out is not recorded
+            self.assertEqual(registry.histogram('taskqueue_get_seconds', 
+                                                taskid=taskid)[0], 2)
+            self.assertEqual(registry.histogram('taskqueue_workfunc_seconds', 
+                                                taskid=taskid)[0], 1)
+
+            text = registry.render()
+            self.assertIn('# TYPE taskqueue_get_seconds histogram', text)
+            self.assertIn('taskqueue_get_seconds_bucket{{taskid="{}",le="+Inf"}} 2'
+                          .format(taskid), text)
+            self.assertIn('taskqueue_depth{{state="ready",taskid="{}"}} 1'
+                          .format(taskid), text)
+            path = os.path.join(tempfile.mkdtemp(), 'taskqueue.prom')
+            metrics.write_textfile(path)
+            with open(path) as f:
+                self.assertIn('taskqueue_items_put_total', f.read())
+            server = metrics.serve(0)
+            try:
+                body = urlopen('http://127.0.0.1:{}/metrics'.format(
+                    server.server_address[1])).read().decode()
+                self.assertIn('taskqueue_queuelock_wait_seconds_count', body)
+            finally:
+                server.shutdown()
+                server.server_close()
+        finally:
+            metrics.disable()
+
+    def test_sharded_taskqueue(self):
+        """ShardedTaskQueue should spread the items over the shards and steal 
+        them from the other shards"""
+
+        import os
+        import sqlite3
+        from taskqueue import ShardedTaskQueue
+        from taskqueue.helper import shard_paths, setup_sharded_taskpool, \
+            add_sharded_task
+
+        paths = shard_paths(self.dbf, 3)
+        setup_sharded_taskpool(paths)
+        taskid = add_sharded_task(paths, desc='a sharded task')
+        q = ShardedTaskQueue(paths, taskid, home=0, visibility_timeout=60)
+        items = ['item-{}'.format(i) for i in range(30)]
+        q.put(items)
+        counts = [sqlite3.connect(p).execute(
+                      """SELECT count(*) FROM taskitem""").fetchone()[0] 
+                  for p in paths]
+        self.assertEqual(sum(counts), 30)
+        self.assertTrue(all(counts))
+        # an item always goes to the same shard, in order
+        q.put(['item-1'])
+        got = []
+        shards = []
+        while True:
+            batch = q.get(100)
+            if not batch:
+                break
+            shards.append(batch.shard)
+            got.extend(batch)
+            q.ack(batch)
+        self.assertEqual(shards, [0, 1, 2])
+        self.assertEqual(sorted(got), sorted(items + ['item-1']))
+        self.assertTrue(q.empty())
+
+        rr = ShardedTaskQueue(paths, taskid, sharding='round_robin', home=2)
+        for i in range(3):
+            rr.put([i])
+        self.assertEqual(sorted(len(TaskQueue(p, taskid).get()) for p in paths), 
+                         [1, 1, 1])
+        self.assertEqual(rr.get(block=True, timeout=0.1), [])
+        self.assertTrue(rr.tasklock().acquire())
+        self.assertFalse(q.tasklock().acquire())
+        rr.tasklock().release()
+
+        # the handles of the items put into many shards are in their order
+        from taskqueue import do_task, results
+
+        for shard in q.shards:
+            shard.set_result_ttl(60)
+        items = ['item-{}'.format(i) for i in range(6)]
+        handles = q.put(items, result=True)
+        self.assertEqual([h.queue for h in handles], 
+                         [q.shards[q.shard_of(item)] for item in items])
+        for p in paths:
+            do_task(p, taskid, lambda item: item + '!', tasklock=False)
+        self.assertTrue(results.wait(handles, timeout=1))
+        self.assertEqual([h.result() for h in handles], 
+                         [item + '!' for item in items])
+        rr.close()
+        for p in paths:
+            os.unlink(p)
+
+    def test_async_taskqueue(self):
+        """AsyncTaskQueue should not block the loop, and async_do_task should 
+        trace every item"""
+
+        import asyncio
+        from taskqueue import AsyncTaskQueue, async_do_task
+        from taskqueue.tracing import get_tracing
+
+        async def routine():
+            async with AsyncTaskQueue(self.dbf, self.taskid) as q:
+                ticks = []
+
+                async def tick():
+                    while True:
+                        ticks.append(1)
+                        await asyncio.sleep(0.01)
+
+                t = asyncio.ensure_future(tick())
+                got = asyncio.ensure_future(q.get(block=True, timeout=5))
+                self.assertEqual(await q.get(), self.items)
+                await asyncio.sleep(0.2)
+                await q.put(['GC-A0004'])
+                self.assertEqual(await got, ['GC-A0004'])
+                t.cancel()
+                # the loop keeps running while get is blocking
+                self.assertTrue(len(ticks) > 5)
+                self.assertTrue(await q.empty())
+
+                async with q.tasklock() as tlock:
+                    self.assertTrue(await tlock.locked())
+                    self.assertFalse(TaskQueue(self.dbf, self.taskid).tasklock().acquire())
+                self.assertFalse(await tlock.locked())
+
+                await q.put(self.items)
+            r = await async_do_task(self.dbf, self.taskid, _async_even_item, 
+                                    tracingmode='append', concurrency=2)
+            self.assertEqual(r, 3)
+            return r
+
+        asyncio.run(routine())
+        tracingid = self.db.execute("""SELECT max(id) FROM tasktracing""").fetchone()[0]
+        self.assertEqual(sorted(get_tracing(self.db, tracingid).split(',')), 
+                         ['0:fail', '1:ok', '2:fail'])
+        with self.assertRaises(KeyError):
+            asyncio.run(AsyncTaskQueue(self.dbf, 9999).get())
+
+        # async_do_task saves the results read by the handles of put
+        from taskqueue.aio import async_wait
+        from taskqueue.results import ResultError
+
+        TaskQueue(self.dbf, self.taskid).set_result_ttl(60)
+
+        async def negate(item):
+            if item < 0:
+                raise ValueError('negative {}'.format(item))
+            return -item
+
+        async def results():
+            async with AsyncTaskQueue(self.dbf, self.taskid) as q:
+                handles = await q.put([1, -2, 3], result=True)
+                self.assertFalse(await handles[0].ready())
+                self.assertFalse(await async_wait(handles, timeout=0.01))
+                r = await async_do_task(self.dbf, self.taskid, negate)
+                self.assertEqual(r, 3)
+                self.assertTrue(await async_wait(handles, timeout=1))
+                self.assertEqual(await handles[0].result(), -1)
+                self.assertTrue(handles[0].ok)
+                with self.assertRaises(ResultError):
+                    await handles[1].result()
+                self.assertEqual(await handles[2].result(timeout=1), -3)
+
+        asyncio.run(results())
+
+    def test_codec(self):
+        """the codec stored in taskqueue table should serialize the items"""
+
+        from taskqueue.codec import register_codec
+
+        q = TaskQueue(self.dbf, self.taskid)
+        with self.assertRaises(ValueError):
+            q.set_codec('pickle')
+        self.assertEqual(q.get(), self.items)
+        with self.assertRaises(ValueError):
+            q.set_codec('no-such-codec')
+        q.set_codec('pickle')
+        items = [b'\x00\xff', {'a': (1, 2)}, {3, 4}]
+        q.put(items)
+        q = TaskQueue(self.dbf, self.taskid)
+        self.assertEqual(q.codec.name, 'pickle')
+        got = q.get()
+        self.assertEqual(got, items)
+        with q.tasktracing(got) as tracing:
+            tracing.ok(0)
+
+        q.set_codec('raw')
+        with self.assertRaises(TypeError):
+            q.put(['not bytes'])
+        q.put([b'GC-A0001'])
+        self.assertEqual(TaskQueue(self.dbf, self.taskid).get(), [b'GC-A0001'])
+
+        register_codec('upper', lambda item: item.upper(), 
+                       lambda s: s.lower())
+        q.set_codec('upper')
+        q.put(['gc-a0002'])
+        self.assertEqual(self.db.execute("""SELECT item FROM taskitem""").fetchone()[0], 
+                         'GC-A0002')
+        self.assertEqual(q.get(), ['gc-a0002'])
+        q.set_codec(None)
+        self.assertEqual(self.db.execute("""SELECT codec FROM taskqueue""").fetchone()[0], 
+                         None)
+
+    def test_codec_tracing(self):
+        """do_task should trace the items of a raw codec queue, and not lose 
+        them if the tracing fails"""
+
+        import sqlite3
+        from unittest import mock
+        from taskqueue.codec import loads_items
+        from taskqueue.retry import RetryPolicy
+
+        q = TaskQueue(self.dbf, self.taskid)
+        self.assertEqual(q.get(), self.items)
+        q.set_codec('raw')
+        q.put([b'\x00\xff', b'GC-A0001'])
+        with mock.patch.object(TaskQueue, 'tasktracing', 
+                               side_effect=sqlite3.OperationalError('locked')):
+            with self.assertRaises(sqlite3.OperationalError):
+                do_task(self.dbf, self.taskid, lambda item: True)
+        self.assertEqual(self.db.execute("""SELECT count(*) FROM taskitem""").fetchone()[0], 
+                         2)
+
+        # the failed items go to a dead letter task of its own codec
+        cur = self.db.execute("""INSERT INTO taskqueue(lockid, desc, codec) 
+                                 VALUES(?, 'dead letter', 'pickle')""", 
+                              (self.lockid, ))
+        dead_taskid = cur.lastrowid
+        self.db.commit()
+        q.set_retry_policy(RetryPolicy(max_attempts=1, dead_taskid=dead_taskid))
+        self.assertEqual(do_task(self.dbf, self.taskid, 
+                                 lambda item: item == b'GC-A0001'), 2)
+        items = self.db.execute("""SELECT items FROM tasktracing 
+                                   ORDER BY id DESC""").fetchone()[0]
+        self.assertEqual(loads_items(items), [b'\x00\xff', b'GC-A0001'])
+        self.assertEqual(TaskQueue(self.dbf, dead_taskid).get(), [b'\x00\xff'])
+
+    def test_results(self):
+        """do_task should save the results read by the handles of put"""
+
+        from taskqueue import do_task
+        from taskqueue import results
+        from taskqueue.results import ResultError, expire_results
+
+        # the results left for the ids given to the legacy items are deleted
+        self.db.execute("""INSERT INTO taskresult(itemid, taskid, status, 
+                            result, expire_at) VALUES(1, ?, 1, '1', 1e12)""", 
+                        (self.taskid, ))
+        self.db.commit()
+        q = TaskQueue(self.dbf, self.taskid)
+        self.assertEqual(q.get(), self.items)
+        self.assertEqual(self.db.execute("""SELECT count(*) FROM taskresult""")
+                         .fetchone()[0], 0)
+        with self.assertRaises(ValueError):
+            q.put([1], result=True)
+        q.set_result_ttl(60)
+
+        def workfunc(item):
+            if item < 0:
+                raise ValueError('negative {}'.format(item))
+            return {'square': item * item} if item else 0
+
+        handles = q.put([2, 0, -1], result=True)
+        self.assertEqual(len(handles), 3)
+        self.assertFalse(handles[0].ready())
+        self.assertFalse(results.wait(handles, timeout=0.01))
+        with self.assertRaises(TimeoutError):
+            handles[0].result(timeout=0)
+
+        self.assertEqual(do_task(self.dbf, self.taskid, workfunc), 3)
+        self.assertEqual(results.fetch(handles), 3)
+        self.assertEqual(handles[0].result(), {'square': 4})
+        self.assertTrue(handles[0].ok)
+        self.assertEqual(handles[1].result(), 0)
+        self.assertFalse(handles[1].ok)
+        with self.assertRaises(ResultError) as cm:
+            handles[2].result()
+        self.assertIn('negative -1', str(cm.exception))
+        tracing = self.db.execute("""SELECT tracing FROM tasktracing 
+                                     ORDER BY id DESC""").fetchone()[0]
+        self.assertEqual(tracing.count('fail'), 2)
+
+        # batches raising fail all of their items, the dropped items have 
+        # no handle
+        q.set_dedup(True)
+        handles = q.put([3, 3, -2], result=True)
+        self.assertIsNone(handles[1])
+        do_task(self.dbf, self.taskid, 
+                lambda items: [workfunc(i) for i in items], batch_size=2)
+        self.assertTrue(results.wait([handles[0], handles[2]], timeout=1))
+        self.assertRaises(ResultError, handles[0].result)
+        self.assertRaises(ResultError, handles[2].result)
+
+        self.assertEqual(expire_results(self.db), 0)
+        self.db.execute("""UPDATE taskresult SET expire_at=0""")
+        self.db.commit()
+        self.assertEqual(expire_results(self.db, batch=2), 2)
+        self.assertEqual(expire_results(self.db), 3)
+
+        # an item retried without visibility_timeout keeps its id, the 
+        # result of the last attempt replaces the failed one
+        from taskqueue.retry import RetryPolicy
+
+        q.set_retry_policy(RetryPolicy(max_attempts=3))
+        calls = []
+
+        def flaky(item):
+            calls.append(item)
+            if len(calls) < 2:
+                raise ValueError('flaky')
+            return item + 1
+
+        handle = q.put([5], result=True)[0]
+        self.assertEqual(do_task(self.dbf, self.taskid, flaky), 1)
+        self.assertRaises(ResultError, handle.result, timeout=1)
+        self.assertEqual(self.db.execute("""SELECT id FROM taskitem 
+                                            WHERE taskid=?""", 
+                                         (self.taskid, )).fetchall(), 
+                         [(handle.itemid, )])
+        self.assertEqual(do_task(self.dbf, self.taskid, flaky), 1)
+        handle = results.ResultHandle(q, handle.itemid)
+        self.assertEqual(handle.result(timeout=1), 6)
+
+        # the items requeued by a stopped do_task keep their ids, so every 
+        # handle gets its result
+        import threading
+
+        stop = threading.Event()
+
+        def stopping(item):
+            stop.set()
+            return item
+
+        handles = q.put([7, 8, 9], result=True)
+        self.assertEqual(do_task(self.dbf, self.taskid, stopping, stop=stop), 1)
+        self.assertTrue(handles[0].ready())
+        self.assertFalse(results.wait(handles, timeout=0.01))
+        self.assertEqual(do_task(self.dbf, self.taskid, lambda item: item), 2)
+        self.assertTrue(results.wait(handles, timeout=1))
+        self.assertEqual([h.result() for h in handles], [7, 8, 9])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,20 +5,66 @@ Task tracing module
 This module is for tracing the working status of each item in taskqueue.
 It is optional.
 
+Two tracing modes are supported:
+
+'column' - the legacy mode, the whole 'markname:ok,markname:fail' string
+           is rewritten into tasktracing.tracing column and committed for
+           every item.
+
+'append' - every item outcome is a row of tasktracingitem table, the rows
+           are buffered in memory and flushed by count, by time interval or
+           on close. The tracing string is derived from the rows, by
+           TaskTracing.tracing, get_tracing or the tasktracing_view view.
+
+If the items are taskqueue.lease.LeasedItems gotten from a TaskQueue, with
+the markname as the index of the item, the leased item is acked by ok, and
+the failed item is retried by retry_policy, or nacked if leased and no
+retry_policy. The acks and retries are written together with the tracing,
+so they are committed once per flush in append mode.
+
+The items are copied into tasktracing.items column, or with items_ref
+stored once in tasktracingitems table by the sha1 of their serialized
+text, referenced by tasktracing.items_hash, so the tracings of the same
+items share one copy. tasktracing_view resolves the reference.
+
 
 Class:
 
 TaskTracing
 
 
+Function:
+
+get_tracing
+
+iter_tracing
+
+iter_tracing_items
+
 """
 
-import json
+import hashlib
+import time
+from .lease import LeasedItems, ack, nack
+from .retry import retry
+from .codec import get_codec, dumps_items
+
+
+# Default amount of buffered outcomes to flush in append mode
+TRACING_FLUSH_COUNT = 100
+
+# Default max seconds to keep outcomes buffered in append mode, checked
+# when a new outcome comes
+TRACING_FLUSH_INTERVAL = 1.0
+
+# Default amount of rows read at a time by iter_tracing and
+# iter_tracing_items
+TRACING_READ_CHUNK = 1000
 
 
 class TaskTracing(object):
     """For tracing task doing
-    
+
     Args:
 
     tracedb - taskpool database connection
@@ -27,47 +73,265 @@ class TaskTracing(object):
 
     items - a list of task items to be finish
 
+    mode - (key-word), 'column' or 'append', see the module document
+
+    durability - (key-word), only for append mode, 'item' flushes and
+                 commits every outcome at once, 'batch' buffers outcomes
+                 and commits once per flush
+
+    flush_count - (key-word), flush when this amount of outcomes buffered,
+                  default TRACING_FLUSH_COUNT
+
+    flush_interval - (key-word), flush when the oldest buffered outcome is
+                     older than this seconds, default TRACING_FLUSH_INTERVAL
+
+    retry_policy - (key-word), taskqueue.retry.RetryPolicy object to retry
+                   the failed items
+
+    codec - (key-word), name of the codec of the items, which serializes
+            them into tasktracing.items column by
+            taskqueue.codec.dumps_items, default 'json'
+
+    items_ref - (key-word), if True, the items are stored by reference, see
+                the module document
+
 
     Methods:
 
     def ok(self, markname)
-        Update the tracing column in tasktracing table, indicate this 
+        Update the tracing column in tasktracing table, indicate this
         markname item is done ok.
 
     def fail(self, markname)
-        Update the tracing column in tasktracing table, indicate this 
+        Update the tracing column in tasktracing table, indicate this
         markname item is done fail.
 
+    def flush(self)
+        Write the buffered outcomes into tasktracingitem table
+
+    def close(self)
+        Flush the buffered outcomes, it is called when leaving the with
+        statement.
+
     """
 
-    def __init__(self, tracedb, taskid, items):
+    def __init__(self, tracedb, taskid, items, mode='column',
+                 durability='batch', flush_count=None, flush_interval=None,
+                 retry_policy=None, codec=None, items_ref=False):
         if not items:
             raise KeyError('empty items.')
+        if mode not in ('column', 'append'):
+            raise ValueError("invalid tracing mode: {}".format(mode))
+        if durability not in ('item', 'batch'):
+            raise ValueError("invalid tracing durability: {}".format(durability))
         self.db = tracedb
         self.taskid = taskid
+        self.mode = mode
+        self.durability = durability
+        self.flush_count = TRACING_FLUSH_COUNT if flush_count is None else flush_count
+        self.flush_interval = (TRACING_FLUSH_INTERVAL if flush_interval is None
+                               else flush_interval)
+        self.codec = get_codec(codec)
+        stored = dumps_items(self.codec, items)
+        items_hash = None
         self.cur = cur = self.db.cursor()
-        cur.execute("""INSERT INTO tasktracing(taskid, start_time, items) 
-                       VALUES(?, datetime('now', 'localtime'), ?)""", 
-                    (self.taskid, json.dumps(items)))
+        if items_ref:
+            items_hash = hashlib.sha1(stored.encode('utf-8')).hexdigest()
+            cur.execute("""INSERT OR IGNORE INTO tasktracingitems(hash, items)
+                           VALUES(?, ?)""", (items_hash, stored))
+            stored = None
+        cur.execute("""INSERT INTO tasktracing(taskid, start_time, items,
+                        items_hash, ok_count, fail_count)
+                       VALUES(?, datetime('now', 'localtime'), ?, ?, 0, 0)""",
+                    (self.taskid, stored, items_hash))
         self.db.commit()
         self.items = items
         self.id = cur.lastrowid
         self.tracing_items = []
+        self.ok_count = 0
+        self.fail_count = 0
+        self._buffer = []
+        self._buffered_time = None
+        self.gotten = items if isinstance(items, LeasedItems) else None
+        self.lease = None
+        if self.gotten is not None and self.gotten.leaseid is not None:
+            self.lease = self.gotten
+        self.retry_policy = None
+        if self.gotten is not None and self.gotten.attempts is not None:
+            self.retry_policy = retry_policy
+        self._acks = []
+        self._nacks = []
+        self._retries = []
 
     def ok(self, markname):
         """Indicates the item is done ok"""
 
-        self._tracing('{}:ok'.format(markname))
+        self.ok_count += 1
+        if self.lease is not None:
+            self._acks.append(self.lease.ids[markname])
+        if self.mode == 'append':
+            self._append(markname, 1)
+        else:
+            self._tracing('{}:ok'.format(markname))
 
     def fail(self, markname):
         """Indicates the item is done fail"""
 
-        self._tracing('{}:fail'.format(markname))
+        self.fail_count += 1
+        if self.retry_policy is not None:
+            self._retries.append(markname)
+        elif self.lease is not None:
+            self._nacks.append(self.lease.ids[markname])
+        if self.mode == 'append':
+            self._append(markname, 0)
+        else:
+            self._tracing('{}:fail'.format(markname))
+
+    def flush(self):
+        """Write the buffered outcomes into tasktracingitem table and commit"""
+
+        if not self._buffer:
+            return
+        self.cur.executemany("""INSERT INTO tasktracingitem(tracingid, markname,
+                                 status) VALUES(?, ?, ?)""",
+                             ((self.id, m, st) for m, st in self._buffer))
+        self.cur.execute("""UPDATE tasktracing SET ok_count=?, fail_count=?
+                            WHERE id=?""",
+                         (self.ok_count, self.fail_count, self.id))
+        self._write_lease()
+        self.db.commit()
+        self._buffer = []
+        self._buffered_time = None
+
+    def close(self):
+        """Flush the buffered outcomes"""
+
+        self.flush()
+
+    @property
+    def tracing(self):
+        """The 'markname:ok,markname:fail' string of this tracing"""
+
+        if self.mode == 'column':
+            return ','.join(self.tracing_items)
+        self.flush()
+        return get_tracing(self.db, self.id)
 
     def _tracing(self, s):
         """Upate tracing table"""
 
         self.tracing_items.append(s)
-        self.cur.execute("""UPDATE tasktracing SET tracing=? WHERE id=?""", 
-                         (','.join(self.tracing_items), self.id))
+        self.cur.execute("""UPDATE tasktracing SET tracing=?, ok_count=?,
+                            fail_count=? WHERE id=?""",
+                         (','.join(self.tracing_items), self.ok_count,
+                          self.fail_count, self.id))
+        self._write_lease()
         self.db.commit()
+
+    def _write_lease(self):
+        """Ack, nack and retry the items traced, without commit"""
+
+        if self._acks:
+            ack(self.db, self.lease.leaseid, self._acks)
+            self._acks = []
+        if self._nacks:
+            nack(self.db, self.lease.leaseid, self._nacks)
+            self._nacks = []
+        if self._retries:
+            retry(self.db, self.taskid, self.gotten, self._retries,
+                  self.retry_policy, codec=self.codec)
+            self._retries = []
+
+    def _append(self, markname, status):
+        """Buffer an outcome, flush if needed"""
+
+        self._buffer.append((markname, status))
+        if self._buffered_time is None:
+            self._buffered_time = time.monotonic()
+        if (self.durability == 'item'
+                or len(self._buffer) >= self.flush_count
+                or time.monotonic() - self._buffered_time >= self.flush_interval):
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def get_tracing(db, tracingid):
+    """Get the 'markname:ok,markname:fail' string of a tasktracing row
+
+    Both tracing modes are supported, return None if no such tracing.
+
+    """
+
+    r = db.execute("""SELECT tracing FROM tasktracing_view WHERE id=?""",
+                   (tracingid, )).fetchone()
+    if r is None:
+        return None
+    return r[0]
+
+
+def iter_tracing(db, taskid=None, chunk=None):
+    """Iterate over the tasktracing rows, chunk rows read at a time
+
+    Yield (id, taskid, start_time, items, tracing) in the order traced, with
+    tracing as get_tracing and items as stored, resolved if stored by
+    reference. The rows are read by the
+    primary key, or by the tasktracing_taskid index if taskid is given, from
+    where the last chunk ends, so every chunk costs the same and only one
+    chunk is in memory. The chunks are plain reads, no transaction is left
+    open between them and the connection is not committed.
+
+    """
+
+    if chunk is None:
+        chunk = TRACING_READ_CHUNK
+    last = (0, '')
+    while True:
+        if taskid is None:
+            rows = db.execute("""SELECT id, taskid, start_time, items, tracing
+                                 FROM tasktracing_view WHERE id>?
+                                 ORDER BY id LIMIT ?""",
+                              (last[0], chunk)).fetchall()
+        else:
+            rows = db.execute("""SELECT id, taskid, start_time, items, tracing
+                                 FROM tasktracing_view
+                                 WHERE taskid=? AND start_time>=? AND
+                                  (start_time>? OR id>?)
+                                 ORDER BY start_time, id LIMIT ?""",
+                              (taskid, last[1], last[1], last[0],
+                               chunk)).fetchall()
+        for r in rows:
+            yield r
+        if len(rows) < chunk:
+            return
+        last = (rows[-1][0], rows[-1][2])
+
+
+def iter_tracing_items(db, tracingid, chunk=None):
+    """Iterate over the outcomes of a tracing, chunk rows read at a time
+
+    Yield (markname, ok) of the tasktracingitem rows of append mode, in the
+    order traced, ok is True or False. Unlike get_tracing, the outcomes are
+    not joined into a string, so a tracing of millions of items is read in
+    fixed memory.
+
+    """
+
+    if chunk is None:
+        chunk = TRACING_READ_CHUNK
+    last = 0
+    while True:
+        rows = db.execute("""SELECT rowid, markname, status FROM tasktracingitem
+                             WHERE tracingid=? AND rowid>?
+                             ORDER BY rowid LIMIT ?""",
+                          (tracingid, last, chunk)).fetchall()
+        for r in rows:
+            yield r[1], r[2] == 1
+        if len(rows) < chunk:
+            return
+        last = rows[-1][0]
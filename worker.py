@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Worker module
+
+A MultiQueueWorker does the items of many taskids in one process. Each
+round it finds the taskids having ready items with one query, then pulls
+items from them by the scheduling:
+
+'wrr' - smooth weighted round robin, a taskid of weight w is picked w times
+        a round, interleaved with the others, quantum items each pick.
+
+'deficit' - deficit round robin, a taskid of weight w is credited w times
+            quantum items a round, and pulls as many items as its credit.
+            The credit not used because of a short get is carried to the
+            next round, and dropped when the queue becomes empty.
+
+The items of a taskid are done by do_task, so the tasklock of the taskid is
+respected: a taskid whose lock is held, e.g. by another taskid of the same
+lock group, is skipped in the round.
+
+
+Class:
+
+MultiQueueWorker
+
+"""
+
+import select
+import time
+
+from .executor import get_executor
+from .notify import Waiter, NOTIFY_BACKOFF
+from .pool import connect
+
+
+# Default amount of items a taskid of weight 1 is given each round
+WORKER_QUANTUM = 100
+
+# Condition of a taskqueue row having ready items, in the legacy items
+# column or in taskitem table
+_READY = """(que.items IS NOT NULL AND que.items NOT IN ('', '[]')) OR EXISTS (
+             SELECT 1 FROM taskitem WHERE taskid=que.taskid AND visible_at<=?)"""
+
+
+class MultiQueueWorker(object):
+    """Worker doing the items of many taskids
+
+    Args:
+
+    taskpool - an sqlite3 database path to store the task information
+
+    workfunc - a callback function to finish the task one item one time,
+               see do_task
+
+    taskids - (key-word), taskids to do, all of taskids in taskqueue table
+              if None, which is read again every round
+
+    weights - (key-word), dict of taskid to its weight, default 1
+
+    scheduling - (key-word), 'wrr' or 'deficit', see the module document
+
+    quantum - (key-word), amount of items of weight 1, default
+              WORKER_QUANTUM
+
+    stop - (key-word), a threading.Event or the like to stop the worker,
+           the items not done when it is set are put back, see do_task
+
+    Other key-word arguments are passed to do_task. An executor constructed
+    for 'thread' or 'process' is shared by all of the taskids.
+
+
+    Method:
+
+    def ready_taskids(self)
+        Return the taskids having ready items
+
+    def run_once(self)
+        Do one round over the ready taskids
+
+    def run(self, timeout=None, stop=None)
+        Do rounds until no items for timeout seconds or stop is set
+
+    def close(self)
+        Shut down the executor and the waiters
+
+    """
+
+    def __init__(self, taskpool, workfunc, taskids=None, weights=None,
+                 scheduling='deficit', quantum=None, stop=None, **kwargs):
+        if scheduling not in ('wrr', 'deficit'):
+            raise ValueError("invalid scheduling: {}".format(scheduling))
+        self.taskpool = taskpool
+        self.workfunc = workfunc
+        self.taskids = None if taskids is None else list(taskids)
+        self.weights = dict(weights or {})
+        self.scheduling = scheduling
+        self.quantum = WORKER_QUANTUM if quantum is None else quantum
+        self.stop = stop
+        self.pool, self._owned = get_executor(kwargs.pop('executor', None),
+                                              kwargs.pop('max_workers', None))
+        self.kwargs = kwargs
+        self.deficits = {}
+        self.db = connect(taskpool)
+        self._waiters = {}
+        self._delay = NOTIFY_BACKOFF[0]
+
+    def weight(self, taskid):
+        """Weight of taskid, default 1"""
+
+        return self.weights.get(taskid, 1)
+
+    def ready_taskids(self):
+        """Return the taskids having ready items, in taskid order
+
+        The ready items of every taskid are probed by the taskitem_ready
+        index, so it costs one index lookup a taskid. Items left in the
+        legacy taskqueue.items column are ready as well.
+
+        """
+
+        now = time.time()
+        if self.taskids is None:
+            rows = self.db.execute("""SELECT taskid FROM taskqueue AS que
+                                      WHERE {}
+                                      ORDER BY taskid""".format(_READY), (now, ))
+        else:
+            rows = self.db.execute("""SELECT taskid FROM taskqueue AS que
+                                      WHERE taskid IN ({}) AND ({})
+                                      ORDER BY taskid""".format(
+                                          ','.join('?' * len(self.taskids)),
+                                          _READY),
+                                   list(self.taskids) + [now])
+        taskids = [r[0] for r in rows]
+        # a read transaction must not be left open
+        self.db.commit()
+        return taskids
+
+    def run_once(self):
+        """Do one round over the ready taskids, return the amount of items"""
+
+        ready = self.ready_taskids()
+        for taskid in list(self.deficits):
+            if taskid not in ready:
+                del self.deficits[taskid]
+        if self.scheduling == 'wrr':
+            return self._wrr(ready)
+        return self._deficit(ready)
+
+    def run(self, timeout=None, stop=None):
+        """Do rounds until no items done for timeout seconds
+
+        timeout None means forever, stop is a threading.Event or the like
+        to stop the worker, default the stop of the worker. While idle, the worker sleeps
+        until items are put into any of the taskids, see taskqueue.notify.
+        Return the amount of items done.
+
+        """
+
+        if stop is None:
+            stop = self.stop
+        total = 0
+        idle_since = None
+        while stop is None or not stop.is_set():
+            done = self.run_once()
+            total += done
+            if done:
+                idle_since = None
+                self._delay = NOTIFY_BACKOFF[0]
+                continue
+            now = time.monotonic()
+            if idle_since is None:
+                idle_since = now
+            remaining = None
+            if timeout is not None:
+                remaining = idle_since + timeout - now
+                if remaining <= 0:
+                    break
+            self._wait(remaining)
+        return total
+
+    def close(self):
+        """Shut down the executor constructed, and close the waiters"""
+
+        if self._owned:
+            self.pool.shutdown()
+            self._owned = False
+        for waiter in self._waiters.values():
+            waiter.close()
+        self._waiters = {}
+
+    def _do(self, taskid, num):
+        """do_task num items of taskid, return the amount, None if empty,
+        False if the tasklock is held"""
+
+        from . import do_task
+
+        if self._stopped():
+            return None
+        return do_task(self.taskpool, taskid, self.workfunc,
+                       executor=self.pool, num=num, stop=self.stop,
+                       **self.kwargs)
+
+    def _stopped(self):
+        return self.stop is not None and self.stop.is_set()
+
+    def _wrr(self, ready):
+        """Smooth weighted round robin over ready"""
+
+        total = 0
+        current = dict((t, 0) for t in ready)
+        picks = sum(self.weight(t) for t in ready)
+        while current and picks > 0:
+            picks -= 1
+            weights = sum(self.weight(t) for t in current)
+            for t in current:
+                current[t] += self.weight(t)
+            taskid = max(current, key=lambda t: current[t])
+            current[taskid] -= weights
+            r = self._do(taskid, self.quantum)
+            if not r:
+                del current[taskid]
+                continue
+            total += r
+            if r < self.quantum:
+                # drained
+                del current[taskid]
+        return total
+
+    def _deficit(self, ready):
+        """Deficit round robin over ready"""
+
+        total = 0
+        for taskid in ready:
+            deficit = self.deficits.get(taskid, 0) + self.weight(taskid) * self.quantum
+            num = int(deficit)
+            r = self._do(taskid, num) if num > 0 else 0
+            if r is None or r is False:
+                # empty, or locked by another worker
+                self.deficits.pop(taskid, None)
+                continue
+            total += r
+            if r < num:
+                # drained, the credit is not carried
+                self.deficits.pop(taskid, None)
+            else:
+                self.deficits[taskid] = deficit - r
+        return total
+
+    def _wait(self, timeout=None):
+        """Sleep until items are put into the taskids or timeout"""
+
+        taskids = self.taskids
+        if taskids is None:
+            taskids = [r[0] for r in self.db.execute(
+                """SELECT taskid FROM taskqueue""")]
+            self.db.commit()
+        for taskid in taskids:
+            if taskid not in self._waiters:
+                self._waiters[taskid] = Waiter(self.taskpool, taskid)
+        socks = [w.sock for w in self._waiters.values() if w.sock is not None]
+        if socks:
+            delay = NOTIFY_BACKOFF[1]
+        else:
+            delay = self._delay
+            self._delay = min(self._delay * 2, NOTIFY_BACKOFF[1])
+        if timeout is not None:
+            delay = min(delay, timeout)
+        if not socks:
+            time.sleep(max(delay, 0))
+            return
+        r, _, _ = select.select(socks, [], [], max(delay, 0))
+        for waiter in self._waiters.values():
+            if waiter.sock in r:
+                waiter.drain()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False